@@ -0,0 +1,293 @@
+"""
+Cold-start benchmark and import-time profile of the function app.
+
+Every measurement runs in a fresh interpreter, like a worker on a new
+instance:
+
+- import: the time to import function_app, with the warm-up off and nothing
+  listening on the configured endpoints (importing must not connect to
+  anything). One more run under `python -X importtime` gives the profile: the
+  cumulative time of each of the app's modules and the own time of each
+  third-party package.
+- first request: function_app is imported against the local Azure OpenAI and
+  Cosmos DB stand-ins of the load test, then, after --gap-ms (the time from
+  the host loading the app to the first request arriving), one chat is created
+  and asked a question. This is measured with the background warm-up off and
+  on, so the table shows what the first user waits for in each case.
+
+Medians over --runs are reported.
+
+    cd backend-azure && python -m benchmarks.cold_start
+    cd backend-azure && python -m benchmarks.cold_start --runs 3 --gap-ms 1500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PACKAGES = ("config", "core", "services", "utils", "function_app")
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+# Nothing listens here; the import must not try
+UNREACHABLE_DEPLOYMENTS = [
+    {
+        "name": "chat-0",
+        "kind": "chat",
+        "endpoint": "http://127.0.0.1:9",
+        "deployment": "gpt-4o",
+    },
+    {
+        "name": "embeddings-0",
+        "kind": "embeddings",
+        "endpoint": "http://127.0.0.1:9",
+        "deployment": "embeddings",
+    },
+]
+
+
+def _child_result(result: Dict[str, Any]) -> None:
+    print("RESULT " + json.dumps(result), flush=True)
+
+
+def import_environment(workdir: str) -> Dict[str, str]:
+    """Settings for the import runs, passed in so the child imports nothing else."""
+    return {
+        "AZURE_OPENAI_DEPLOYMENTS": json.dumps(UNREACHABLE_DEPLOYMENTS),
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_API_VERSION": "2024-10-21",
+        "AZURE_COSMOS_DB_ENDPOINT": "https://127.0.0.1:9/",
+        "AZURE_COSMOS_DB_KEY": "YmVuY2htYXJr",
+        "INGESTION_CACHE_PATH": os.path.join(workdir, "ingestion-cache.sqlite3"),
+        "LOCAL_VECTOR_INDEX_DIR": os.path.join(workdir, "vectors"),
+        "STARTUP_WARMUP": "false",
+    }
+
+
+def child_import() -> None:
+    started = time.perf_counter()
+    import function_app  # noqa: F401
+
+    _child_result({"import_ms": (time.perf_counter() - started) * 1000})
+
+
+async def child_first_request(gap_ms: float) -> None:
+    from benchmarks import fake_cosmos
+    from benchmarks.load_test import (
+        Settings,
+        build_request,
+        configure_environment,
+        read_response,
+        route_handlers,
+        start_openai_pool,
+    )
+
+    settings = Settings()
+    openai_fakes, deployments = await start_openai_pool(settings)
+    configure_environment(deployments, tempfile.mkdtemp())
+    fake_cosmos.install(
+        fake_cosmos.FakeCosmosAccount(
+            fake_cosmos.FaultProfile(
+                latency_ms=settings.cosmos_latency_ms,
+                jitter_ms=0.0,
+                throttle_rate=0.0,
+            ),
+            seed=settings.seed,
+        )
+    )
+    result: Dict[str, Any] = {}
+    try:
+        started = time.perf_counter()
+        import function_app
+        from core.warmup import warmup
+
+        result["import_ms"] = (time.perf_counter() - started) * 1000
+        handlers = route_handlers(function_app.app)
+        await asyncio.sleep(gap_ms / 1000)
+
+        request_started = time.perf_counter()
+        response = await handlers["create_chat"](
+            build_request("POST", "create_chat", "user-0")
+        )
+        chat_id = json.loads(response.body)["id"]
+        result["create_chat_ms"] = (time.perf_counter() - request_started) * 1000
+
+        request_started = time.perf_counter()
+        response = await handlers["request_gpt"](
+            build_request(
+                "POST",
+                "request_gpt",
+                "user-0",
+                json={"q": "What do the documents say?", "chatId": chat_id},
+            )
+        )
+        body, first_chunk_at = await read_response(response)
+        if response.status_code != 200 or b"data: ERROR" in body:
+            result["error"] = body[:200].decode("utf-8", "replace")
+        result["request_gpt_ttft_ms"] = (first_chunk_at - request_started) * 1000
+        result["request_gpt_ms"] = (time.perf_counter() - request_started) * 1000
+        result["first_answer_ms"] = (time.perf_counter() - started) * 1000
+
+        if warmup.wait(timeout=60):
+            result["warmup_ms"] = warmup.timings_ms["total"]
+    finally:
+        for fake in openai_fakes:
+            await fake.stop()
+    _child_result(result)
+
+
+def run_child(
+    mode: str, extra_env: Dict[str, str], args: List[str] = (), importtime=False
+) -> Tuple[Dict[str, Any], str]:
+    """Runs this module in a fresh interpreter; returns its result and stderr."""
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-m", "benchmarks.cold_start", "--child", mode, *args]
+    completed = subprocess.run(
+        command,
+        cwd=BACKEND_DIR,
+        env={**os.environ, **extra_env},
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    for line in completed.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT ") :]), completed.stderr
+    raise RuntimeError(
+        f"Child '{mode}' failed ({completed.returncode}):\n{completed.stderr[-2000:]}"
+    )
+
+
+def import_profile(stderr: str) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    From `-X importtime` output: cumulative ms of the app's modules under
+    function_app, and own ms per third-party top-level package.
+    """
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            entries.append((int(own), int(cumulative), len(indent) // 2, name))
+
+    # A module's line comes after those of the modules it imported, so the
+    # subtree of function_app is the run of deeper lines right before it
+    end = next(
+        (i for i, entry in enumerate(entries) if entry[3] == "function_app"), None
+    )
+    if end is None:
+        return {}, {}
+    start = end
+    while start > 0 and entries[start - 1][2] > entries[end][2]:
+        start -= 1
+
+    app_modules: Dict[str, float] = {}
+    packages: Dict[str, float] = defaultdict(float)
+    for own, cumulative, _, name in entries[start : end + 1]:
+        top = name.split(".")[0]
+        if top in APP_PACKAGES:
+            app_modules[name] = cumulative / 1000
+        else:
+            packages[top] += own / 1000
+    return app_modules, dict(packages)
+
+
+def _median(results: List[Dict[str, Any]], key: str) -> Optional[float]:
+    values = [result[key] for result in results if key in result]
+    return statistics.median(values) if values else None
+
+
+def _format(value: Optional[float]) -> str:
+    return f"{value:10.0f}" if value is not None else f"{'-':>10}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--gap-ms",
+        type=float,
+        default=0.0,
+        help="time between loading the app and the first request",
+    )
+    parser.add_argument("--top", type=int, default=15, help="rows of the profile")
+    parser.add_argument("--output", help="write the results as JSON here")
+    parser.add_argument("--child", choices=["import", "first-request"])
+    args = parser.parse_args()
+
+    if args.child == "import":
+        child_import()
+        return
+    if args.child == "first-request":
+        asyncio.run(child_first_request(args.gap_ms))
+        return
+
+    environment = import_environment(tempfile.mkdtemp(prefix="cold-start-"))
+    imports = [run_child("import", environment)[0] for _ in range(args.runs)]
+    _, stderr = run_child("import", environment, importtime=True)
+    app_modules, packages = import_profile(stderr)
+    first_requests = {
+        warmup: [
+            run_child(
+                "first-request",
+                {"STARTUP_WARMUP": warmup},
+                ["--gap-ms", str(args.gap_ms)],
+            )[0]
+            for _ in range(args.runs)
+        ]
+        for warmup in ("false", "true")
+    }
+
+    print(f"\nimport function_app: {_median(imports, 'import_ms'):.0f} ms (median)")
+    print(f"\n{'app module (cumulative)':45} {'ms':>8}")
+    for name, ms in sorted(app_modules.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"{name:45} {ms:8.1f}")
+    print(f"\n{'third-party package (own)':45} {'ms':>8}")
+    for name, ms in sorted(packages.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"{name:45} {ms:8.1f}")
+
+    print(f"\nfirst request, {args.gap_ms:.0f} ms after import (median ms)")
+    print(f"{'':24} {'warm-up off':>10} {'warm-up on':>10}")
+    for key in (
+        "import_ms",
+        "create_chat_ms",
+        "request_gpt_ttft_ms",
+        "request_gpt_ms",
+        "first_answer_ms",
+        "warmup_ms",
+    ):
+        print(
+            f"{key:24} {_format(_median(first_requests['false'], key))} "
+            f"{_format(_median(first_requests['true'], key))}"
+        )
+    errors = [r["error"] for rs in first_requests.values() for r in rs if "error" in r]
+    if errors:
+        print(f"\n{len(errors)} first requests failed, e.g. {errors[0]}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "imports": imports,
+                    "app_modules_ms": app_modules,
+                    "packages_ms": packages,
+                    "first_request": first_requests,
+                },
+                file,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
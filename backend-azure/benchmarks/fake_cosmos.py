@@ -0,0 +1,819 @@
+"""
+In-process stand-in for Cosmos DB, for benchmarks and local runs.
+
+Holds databases, containers and items in memory and serves the sync and async
+(azure.cosmos.aio) SDK calls the app makes: point reads, creates, upserts,
+patches, deletes, transactional batches and the queries of the chat history
+and vector store, including VectorDistance and FullTextScore ranking. Every
+round trip can be given latency and throttling (429s, retried after
+Retry-After the way the SDK does) and reports a request charge to the
+`response_hook`, so per-request RU accounting works as against a real account.
+
+`install` swaps the SDK clients for these fakes; call it before the app's
+modules are imported.
+"""
+
+import asyncio
+import copy
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import azure.cosmos
+import azure.cosmos.aio
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosBatchOperationError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+# Request charge model, roughly what Cosmos DB bills for small items
+READ_RU = 1.0
+WRITE_RU = 5.5
+QUERY_RU = 2.5
+RU_PER_KB_READ = 0.2
+RU_PER_KB_WRITTEN = 1.0
+RU_PER_ITEM_SCANNED = 0.02
+RU_PER_VECTOR_COMPARED = 0.05
+
+
+@dataclass
+class FaultProfile:
+    """Latency and throttling applied to every round trip."""
+
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after_ms: float = 10.0
+    # The SDK retries throttled requests this many times before raising
+    max_throttle_retries: int = 9
+
+    def delay(self, rng: random.Random) -> float:
+        return max(0.0, self.latency_ms + rng.uniform(-1, 1) * self.jitter_ms) / 1000
+
+
+# --- Query engine --------------------------------------------------------------
+#
+# The subset of the Cosmos DB SQL grammar the app uses:
+#
+#   SELECT [TOP n|@p] <projection> FROM c
+#   [WHERE <condition> [AND <condition> ...]]
+#   [ORDER BY <path> [ASC|DESC] | VectorDistance(<path>, @p)
+#             | RANK FullTextScore(<path>, ['term', ...])]
+#
+# Paths are c.a.b or c[@param]; conditions compare a path with a parameter or a
+# literal, or test IS_DEFINED / NOT IS_DEFINED.
+
+_UNDEFINED = object()
+_QUERY = re.compile(
+    r"^\s*SELECT\s+(?:TOP\s+(?P<top>@\w+|\d+)\s+)?(?P<projection>.+?)\s+FROM\s+c\b"
+    r"(?:\s+WHERE\s+(?P<where>.+?))?"
+    r"(?:\s+ORDER\s+BY\s+(?P<order>.+?))?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_PATH_PART = re.compile(r"\.(\w+)|\[\s*(@\w+|'[^']*'|\"[^\"]*\")\s*\]")
+_COMPARISON = re.compile(
+    r"^(?P<path>c\S*)\s*(?P<op>=|!=|<>|>=|<=|>|<)\s*(?P<value>.+)$"
+)
+_DEFINED = re.compile(r"^(?P<not>NOT\s+)?IS_DEFINED\((?P<path>[^)]+)\)$", re.IGNORECASE)
+_VECTOR_DISTANCE = re.compile(
+    r"^VectorDistance\((?P<path>[^,]+),\s*(?P<vector>@\w+)\)$", re.IGNORECASE
+)
+_FULL_TEXT_SCORE = re.compile(
+    r"^RANK\s+FullTextScore\((?P<path>[^,]+),\s*\[(?P<terms>.*)\]\)$",
+    re.IGNORECASE | re.DOTALL,
+)
+_ALIAS = re.compile(r"^(?P<expr>.+?)\s+AS\s+(?P<alias>\w+)$", re.IGNORECASE)
+_WORD = re.compile(r"\w+")
+
+
+def _split_top_level(text: str, separator: str) -> List[str]:
+    """Splits on `separator` outside of parentheses and brackets."""
+    parts, depth, current = [], 0, ""
+    for char in text:
+        if char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += char
+    parts.append(current.strip())
+    return parts
+
+
+def _literal(text: str, parameters: Dict[str, Any]) -> Any:
+    text = text.strip()
+    if text.startswith("@"):
+        return parameters[text]
+    if text[:1] in "'\"":
+        return text[1:-1]
+    if text.lower() in ("true", "false"):
+        return text.lower() == "true"
+    if text.lower() == "null":
+        return None
+    return float(text) if "." in text else int(text)
+
+
+def _path(expr: str, parameters: Dict[str, Any]) -> List[str]:
+    expr = expr.strip()
+    if not expr.startswith("c"):
+        raise ValueError(f"Unsupported expression: {expr}")
+    keys = []
+    for attribute, index in _PATH_PART.findall(expr[1:]):
+        keys.append(attribute or str(_literal(index, parameters)))
+    return keys
+
+
+def _resolve(item: Dict[str, Any], keys: List[str]) -> Any:
+    value: Any = item
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return _UNDEFINED
+        value = value[key]
+    return value
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def _matches(item: Dict[str, Any], condition: str, parameters: Dict[str, Any]) -> bool:
+    defined = _DEFINED.match(condition)
+    if defined:
+        present = _resolve(item, _path(defined["path"], parameters)) is not _UNDEFINED
+        return not present if defined["not"] else present
+    comparison = _COMPARISON.match(condition)
+    if not comparison:
+        raise ValueError(f"Unsupported condition: {condition}")
+    left = _resolve(item, _path(comparison["path"], parameters))
+    right = _literal(comparison["value"], parameters)
+    if left is _UNDEFINED:
+        return False
+    op = comparison["op"]
+    try:
+        if op == "=":
+            return left == right
+        if op in ("!=", "<>"):
+            return left != right
+        if op == ">":
+            return left > right
+        if op == "<":
+            return left < right
+        if op == ">=":
+            return left >= right
+        return left <= right
+    except TypeError:
+        return False
+
+
+def _full_text_scores(
+    items: List[Dict[str, Any]], keys: List[str], terms: List[str]
+) -> List[float]:
+    """BM25 over the candidate items, like Cosmos DB's FullTextScore."""
+    documents = [
+        Counter(_WORD.findall(str(_resolve(item, keys)).lower())) for item in items
+    ]
+    if not documents:
+        return []
+    average_length = sum(sum(d.values()) for d in documents) / len(documents) or 1.0
+    scores = []
+    for counts in documents:
+        length = sum(counts.values())
+        score = 0.0
+        for term in terms:
+            if not counts[term]:
+                continue
+            frequency = sum(1 for d in documents if d[term])
+            idf = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+            norm = 1.2 * (0.25 + 0.75 * length / average_length)
+            score += idf * counts[term] * 2.2 / (counts[term] + norm)
+        scores.append(score)
+    return scores
+
+
+def run_query(
+    items: List[Dict[str, Any]], query: str, parameters: List[Dict[str, Any]]
+) -> Tuple[List[Dict[str, Any]], float]:
+    """Evaluates `query` over `items`; returns the rows and their request charge."""
+    match = _QUERY.match(query)
+    if not match:
+        raise ValueError(f"Unsupported query: {query}")
+    params = {p["name"]: p["value"] for p in parameters or []}
+    charge = QUERY_RU + RU_PER_ITEM_SCANNED * len(items)
+
+    conditions = (
+        re.split(r"\s+AND\s+", match["where"], flags=re.IGNORECASE)
+        if match["where"]
+        else []
+    )
+    rows = [
+        item for item in items if all(_matches(item, c, params) for c in conditions)
+    ]
+
+    similarities: Dict[int, float] = {}
+    order = (match["order"] or "").strip()
+    if order:
+        vector = _VECTOR_DISTANCE.match(order)
+        full_text = _FULL_TEXT_SCORE.match(order)
+        if vector:
+            keys, target = _path(vector["path"], params), params[vector["vector"]]
+            for row in rows:
+                similarities[id(row)] = _cosine(_resolve(row, keys), target)
+            rows.sort(key=lambda row: -similarities[id(row)])
+            charge += RU_PER_VECTOR_COMPARED * len(rows)
+        elif full_text:
+            terms = [t.lower() for t in re.findall(r"'([^']*)'", full_text["terms"])]
+            scores = _full_text_scores(rows, _path(full_text["path"], params), terms)
+            ranked = sorted(zip(scores, range(len(rows))), key=lambda s: -s[0])
+            rows = [rows[index] for score, index in ranked if score > 0]
+        else:
+            expr, _, direction = order.partition(" ")
+            keys = _path(expr, params)
+            descending = direction.strip().upper() == "DESC"
+
+            # Undefined sorts before every value, like in Cosmos DB
+            def sort_key(row):
+                value = _resolve(row, keys)
+                return (0, 0) if value is _UNDEFINED else (1, value)
+
+            rows.sort(key=sort_key, reverse=descending)
+
+    if match["top"]:
+        rows = rows[: int(_literal(match["top"], params))]
+
+    projection = match["projection"].strip()
+    if projection in ("*", "c"):
+        return [copy.deepcopy(row) for row in rows], charge
+    columns = []
+    for column in _split_top_level(projection, ","):
+        aliased = _ALIAS.match(column)
+        expr = aliased["expr"].strip() if aliased else column
+        vector = _VECTOR_DISTANCE.match(expr)
+        if vector:
+            columns.append((aliased["alias"] if aliased else "$1", None))
+        else:
+            keys = _path(expr, params)
+            columns.append((aliased["alias"] if aliased else keys[-1], keys))
+    projected = []
+    for row in rows:
+        out = {}
+        for name, keys in columns:
+            value = (
+                similarities.get(id(row), 0.0) if keys is None else _resolve(row, keys)
+            )
+            if value is not _UNDEFINED:
+                out[name] = copy.deepcopy(value)
+        projected.append(out)
+    return projected, charge
+
+
+# --- Storage -------------------------------------------------------------------
+
+
+def _size_kb(item: Dict[str, Any]) -> float:
+    return len(json.dumps(item, default=str)) / 1024
+
+
+def _partition_key_path(partition_key: Any) -> str:
+    if isinstance(partition_key, dict):
+        return partition_key.get("paths", ["/id"])[0]
+    return getattr(partition_key, "path", None) or str(partition_key)
+
+
+class FakeContainerStore:
+    """Items of one container, keyed by partition key value and id."""
+
+    def __init__(self, account: "FakeCosmosAccount", name: str, partition_path: str):
+        self.account = account
+        self.name = name
+        self.partition_keys = [key for key in partition_path.split("/") if key]
+        self.items: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.lock = threading.RLock()
+
+    def partition_of(self, body: Dict[str, Any]) -> str:
+        value = _resolve(body, self.partition_keys)
+        return json.dumps(None if value is _UNDEFINED else value)
+
+    @staticmethod
+    def _key(item_id: str, partition_key: Any) -> Tuple[str, str]:
+        return json.dumps(partition_key), str(item_id)
+
+    @staticmethod
+    def _stamp(body: Dict[str, Any]) -> Dict[str, Any]:
+        item = copy.deepcopy(body)
+        item["_etag"] = f'"{uuid.uuid4()}"'
+        item["_ts"] = int(time.time())
+        return item
+
+    @staticmethod
+    def _check_etag(
+        existing: Optional[Dict[str, Any]],
+        etag: Optional[str],
+        match_condition: Optional[MatchConditions],
+    ) -> None:
+        if (
+            match_condition == MatchConditions.IfNotModified
+            and existing is not None
+            and existing.get("_etag") != etag
+        ):
+            raise CosmosAccessConditionFailedError(
+                status_code=412, message="Precondition failed"
+            )
+
+    def read(self, item_id: str, partition_key: Any) -> Tuple[Dict[str, Any], float]:
+        with self.lock:
+            item = self.items.get(self._key(item_id, partition_key))
+            if item is None:
+                raise CosmosResourceNotFoundError(
+                    status_code=404, message=f"Item {item_id} not found"
+                )
+            return copy.deepcopy(item), READ_RU + RU_PER_KB_READ * _size_kb(item)
+
+    def write(
+        self,
+        body: Dict[str, Any],
+        mode: str,
+        etag: Optional[str] = None,
+        match_condition: Optional[MatchConditions] = None,
+    ) -> Tuple[Dict[str, Any], float]:
+        key = (self.partition_of(body), str(body["id"]))
+        with self.lock:
+            existing = self.items.get(key)
+            if mode == "create" and existing is not None:
+                raise CosmosResourceExistsError(
+                    status_code=409, message=f"Item {body['id']} exists"
+                )
+            if mode == "replace" and existing is None:
+                raise CosmosResourceNotFoundError(
+                    status_code=404, message=f"Item {body['id']} not found"
+                )
+            self._check_etag(existing, etag, match_condition)
+            item = self._stamp(body)
+            self.items[key] = item
+            return copy.deepcopy(item), WRITE_RU + RU_PER_KB_WRITTEN * _size_kb(item)
+
+    def patch(
+        self,
+        item_id: str,
+        partition_key: Any,
+        operations: List[Dict[str, Any]],
+        etag: Optional[str] = None,
+        match_condition: Optional[MatchConditions] = None,
+    ) -> Tuple[Dict[str, Any], float]:
+        key = self._key(item_id, partition_key)
+        with self.lock:
+            existing = self.items.get(key)
+            if existing is None:
+                raise CosmosResourceNotFoundError(
+                    status_code=404, message=f"Item {item_id} not found"
+                )
+            self._check_etag(existing, etag, match_condition)
+            item = copy.deepcopy(existing)
+            for operation in operations:
+                *parents, leaf = [p for p in operation["path"].split("/") if p]
+                target = item
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                if operation["op"] == "remove":
+                    target.pop(leaf, None)
+                elif operation["op"] == "incr":
+                    target[leaf] = target.get(leaf, 0) + operation["value"]
+                else:
+                    target[leaf] = copy.deepcopy(operation["value"])
+            item = self._stamp(item)
+            self.items[key] = item
+            return copy.deepcopy(item), WRITE_RU + RU_PER_KB_WRITTEN * _size_kb(item)
+
+    def delete(self, item_id: str, partition_key: Any) -> float:
+        with self.lock:
+            if self.items.pop(self._key(item_id, partition_key), None) is None:
+                raise CosmosResourceNotFoundError(
+                    status_code=404, message=f"Item {item_id} not found"
+                )
+        return WRITE_RU
+
+    def batch(
+        self, operations: List[Tuple[str, tuple]], partition_key: Any
+    ) -> Tuple[List[Dict[str, Any]], float]:
+        """Runs a transactional batch: all operations apply, or none."""
+        results, charge = [], 0.0
+        with self.lock:
+            snapshot = dict(self.items)
+            for index, (kind, args) in enumerate(operations):
+                try:
+                    if kind == "delete":
+                        charge += self.delete(args[0], partition_key)
+                        results.append({"statusCode": 204})
+                    elif kind == "read":
+                        item, cost = self.read(args[0], partition_key)
+                        charge += cost
+                        results.append({"statusCode": 200, "resourceBody": item})
+                    else:
+                        body = args[-1] if kind == "replace" else args[0]
+                        item, cost = self.write(body, kind)
+                        charge += cost
+                        results.append({"statusCode": 200, "resourceBody": item})
+                except CosmosHttpResponseError as e:
+                    self.items = snapshot
+                    raise CosmosBatchOperationError(
+                        error_index=index,
+                        headers={},
+                        status_code=e.status_code,
+                        message=f"Batch operation {index} failed: {e}",
+                        operation_responses=results,
+                    )
+        return results, charge
+
+    def query(
+        self,
+        query: str,
+        parameters: Optional[List[Dict[str, Any]]],
+        partition_key: Any = None,
+    ) -> Tuple[List[Dict[str, Any]], float]:
+        with self.lock:
+            if partition_key is None:
+                items = list(self.items.values())
+            else:
+                scope = json.dumps(partition_key)
+                items = [item for (pk, _), item in self.items.items() if pk == scope]
+        return run_query(items, query, parameters or [])
+
+
+class FakeCosmosAccount:
+    """
+    The databases and containers of one fake account, shared by every sync and
+    async client created after `install`. `stats` counts operations, throttled
+    attempts and request units.
+    """
+
+    def __init__(self, faults: Optional[FaultProfile] = None, seed: int = 0):
+        self.faults = faults or FaultProfile()
+        self.containers: Dict[Tuple[str, str], FakeContainerStore] = {}
+        self.stats: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def container(
+        self, database: str, name: str, partition_path: str = "/id"
+    ) -> FakeContainerStore:
+        with self._lock:
+            key = (database, name)
+            if key not in self.containers:
+                self.containers[key] = FakeContainerStore(self, name, partition_path)
+            return self.containers[key]
+
+    def _attempt(self) -> Tuple[float, bool]:
+        """Latency of one attempt and whether it is throttled."""
+        with self._lock:
+            delay = self.faults.delay(self._rng)
+            throttled = self._rng.random() < self.faults.throttle_rate
+        return delay, throttled
+
+    def _count(self, operation: str, charge: float, throttles: int) -> Dict[str, str]:
+        with self._lock:
+            self.stats[f"cosmos_{operation}"] += 1
+            self.stats["cosmos_request_units"] += charge
+            self.stats["cosmos_throttled"] += throttles
+        return {
+            "x-ms-request-charge": f"{charge:.2f}",
+            "x-ms-retry-after-ms": str(self.faults.retry_after_ms),
+            "x-ms-throttle-retry-count": str(throttles),
+        }
+
+    def _throttle_error(self) -> CosmosHttpResponseError:
+        return CosmosHttpResponseError(
+            status_code=429, message="Request rate is large (injected)"
+        )
+
+    async def round_trip(
+        self,
+        operation: str,
+        run: Callable[[], Tuple[Any, float]],
+        response_hook: Optional[Callable] = None,
+    ) -> Any:
+        throttles = 0
+        while True:
+            delay, throttled = self._attempt()
+            await asyncio.sleep(delay)
+            if not throttled:
+                break
+            throttles += 1
+            if throttles > self.faults.max_throttle_retries:
+                self._count(operation, 0.0, throttles)
+                raise self._throttle_error()
+            await asyncio.sleep(self.faults.retry_after_ms / 1000)
+        result, charge = run()
+        headers = self._count(operation, charge, throttles)
+        if response_hook is not None:
+            response_hook(headers, result)
+        return result
+
+    def round_trip_sync(
+        self,
+        operation: str,
+        run: Callable[[], Tuple[Any, float]],
+        response_hook: Optional[Callable] = None,
+    ) -> Any:
+        throttles = 0
+        while True:
+            delay, throttled = self._attempt()
+            time.sleep(delay)
+            if not throttled:
+                break
+            throttles += 1
+            if throttles > self.faults.max_throttle_retries:
+                self._count(operation, 0.0, throttles)
+                raise self._throttle_error()
+            time.sleep(self.faults.retry_after_ms / 1000)
+        result, charge = run()
+        headers = self._count(operation, charge, throttles)
+        if response_hook is not None:
+            response_hook(headers, result)
+        return result
+
+
+# --- Async SDK surface ---------------------------------------------------------
+
+
+class _AsyncPage:
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self._rows = rows
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for row in self._rows:
+            yield row
+
+
+class _AsyncPager:
+    """Pages of a query, like the SDK's AsyncPageIterator."""
+
+    def __init__(self, fetch, page_size: Optional[int], continuation: Optional[str]):
+        self._fetch = fetch
+        self._page_size = page_size
+        self._offset = int(continuation) if continuation else 0
+        self._rows: Optional[List[Dict[str, Any]]] = None
+        self.continuation_token: Optional[str] = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> _AsyncPage:
+        if self._rows is None:
+            self._rows = await self._fetch()
+        elif self.continuation_token is None:
+            raise StopAsyncIteration
+        if self._offset >= len(self._rows) and self._offset:
+            raise StopAsyncIteration
+        end = self._offset + (self._page_size or len(self._rows))
+        page = self._rows[self._offset : end]
+        self._offset = end
+        self.continuation_token = str(end) if end < len(self._rows) else None
+        return _AsyncPage(page)
+
+
+class _AsyncItemPaged:
+    def __init__(self, fetch, page_size: Optional[int]):
+        self._fetch = fetch
+        self._page_size = page_size
+
+    def by_page(self, continuation_token: Optional[str] = None) -> _AsyncPager:
+        return _AsyncPager(self._fetch, self._page_size, continuation_token)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        async for page in self.by_page():
+            async for row in page:
+                yield row
+
+
+class FakeAsyncContainer:
+    def __init__(self, store: FakeContainerStore):
+        self._store = store
+        self._account = store.account
+        self.id = store.name
+
+    async def read_item(self, item, partition_key, response_hook=None, **kwargs):
+        return await self._account.round_trip(
+            "read", lambda: self._store.read(item, partition_key), response_hook
+        )
+
+    async def create_item(self, body, response_hook=None, **kwargs):
+        return await self._account.round_trip(
+            "write", lambda: self._store.write(body, "create"), response_hook
+        )
+
+    async def upsert_item(
+        self, body, etag=None, match_condition=None, response_hook=None, **kwargs
+    ):
+        return await self._account.round_trip(
+            "write",
+            lambda: self._store.write(body, "upsert", etag, match_condition),
+            response_hook,
+        )
+
+    async def replace_item(
+        self, item, body, etag=None, match_condition=None, response_hook=None, **kw
+    ):
+        return await self._account.round_trip(
+            "write",
+            lambda: self._store.write(body, "replace", etag, match_condition),
+            response_hook,
+        )
+
+    async def patch_item(
+        self,
+        item,
+        partition_key,
+        patch_operations,
+        etag=None,
+        match_condition=None,
+        response_hook=None,
+        **kwargs,
+    ):
+        return await self._account.round_trip(
+            "write",
+            lambda: self._store.patch(
+                item, partition_key, patch_operations, etag, match_condition
+            ),
+            response_hook,
+        )
+
+    async def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        await self._account.round_trip(
+            "delete",
+            lambda: (None, self._store.delete(item, partition_key)),
+            response_hook,
+        )
+
+    async def execute_item_batch(
+        self, batch_operations, partition_key, response_hook=None, **kwargs
+    ):
+        return await self._account.round_trip(
+            "batch",
+            lambda: self._store.batch(batch_operations, partition_key),
+            response_hook,
+        )
+
+    def query_items(
+        self,
+        query,
+        parameters=None,
+        partition_key=None,
+        max_item_count=None,
+        response_hook=None,
+        **kwargs,
+    ) -> _AsyncItemPaged:
+        async def fetch():
+            return await self._account.round_trip(
+                "query",
+                lambda: self._store.query(query, parameters, partition_key),
+                response_hook,
+            )
+
+        return _AsyncItemPaged(fetch, max_item_count)
+
+    def read_all_items(self, max_item_count=None, response_hook=None, **kwargs):
+        return self.query_items(
+            "SELECT * FROM c",
+            max_item_count=max_item_count,
+            response_hook=response_hook,
+        )
+
+
+class FakeAsyncDatabase:
+    def __init__(self, account: FakeCosmosAccount, name: str):
+        self._account = account
+        self.id = name
+
+    async def create_container_if_not_exists(self, id, partition_key, **kwargs):
+        return self.get_container_client(id, partition_key)
+
+    def get_container_client(self, container, partition_key=None):
+        store = self._account.container(
+            self.id, container, _partition_key_path(partition_key or "/id")
+        )
+        return FakeAsyncContainer(store)
+
+
+class FakeAsyncCosmosClient:
+    """Replaces azure.cosmos.aio.CosmosClient."""
+
+    account: FakeCosmosAccount
+
+    def __init__(self, url=None, credential=None, **kwargs):
+        pass
+
+    async def create_database_if_not_exists(self, id, **kwargs):
+        return FakeAsyncDatabase(self.account, id)
+
+    def get_database_client(self, database):
+        return FakeAsyncDatabase(self.account, database)
+
+    async def close(self) -> None:
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+# --- Sync SDK surface ----------------------------------------------------------
+
+
+class FakeSyncContainer:
+    def __init__(self, store: FakeContainerStore):
+        self._store = store
+        self._account = store.account
+        self.id = store.name
+
+    def read_item(self, item, partition_key, response_hook=None, **kwargs):
+        return self._account.round_trip_sync(
+            "read", lambda: self._store.read(item, partition_key), response_hook
+        )
+
+    def create_item(self, body, response_hook=None, **kwargs):
+        return self._account.round_trip_sync(
+            "write", lambda: self._store.write(body, "create"), response_hook
+        )
+
+    def upsert_item(self, body, response_hook=None, **kwargs):
+        return self._account.round_trip_sync(
+            "write", lambda: self._store.write(body, "upsert"), response_hook
+        )
+
+    def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        self._account.round_trip_sync(
+            "delete",
+            lambda: (None, self._store.delete(item, partition_key)),
+            response_hook,
+        )
+
+    def query_items(
+        self, query, parameters=None, partition_key=None, response_hook=None, **kwargs
+    ) -> Iterator[Dict[str, Any]]:
+        rows = self._account.round_trip_sync(
+            "query",
+            lambda: self._store.query(query, parameters, partition_key),
+            response_hook,
+        )
+        return iter(rows)
+
+
+class FakeSyncDatabase:
+    def __init__(self, account: FakeCosmosAccount, name: str):
+        self._account = account
+        self.id = name
+
+    def create_container_if_not_exists(self, id, partition_key, **kwargs):
+        return self.get_container_client(id, partition_key)
+
+    def get_container_client(self, container, partition_key=None):
+        store = self._account.container(
+            self.id, container, _partition_key_path(partition_key or "/id")
+        )
+        return FakeSyncContainer(store)
+
+
+class FakeSyncCosmosClient:
+    """Replaces azure.cosmos.CosmosClient."""
+
+    account: FakeCosmosAccount
+
+    def __init__(self, url=None, credential=None, **kwargs):
+        pass
+
+    def create_database_if_not_exists(self, id, **kwargs):
+        return FakeSyncDatabase(self.account, id)
+
+    def get_database_client(self, database):
+        return FakeSyncDatabase(self.account, database)
+
+
+def install(account: FakeCosmosAccount) -> None:
+    """Makes the Cosmos SDK clients created from now on use `account`."""
+    FakeAsyncCosmosClient.account = account
+    FakeSyncCosmosClient.account = account
+    azure.cosmos.CosmosClient = FakeSyncCosmosClient
+    azure.cosmos.aio.CosmosClient = FakeAsyncCosmosClient
@@ -0,0 +1,284 @@
+"""
+Local stand-in for Azure OpenAI, for benchmarks and local runs.
+
+Serves the chat completions (streamed and not) and embeddings routes of the
+Azure OpenAI REST API on 127.0.0.1, so the app's real clients, router and
+streaming code run against it unchanged. Latency is modelled as a delay
+before the first token plus a delay per streamed token; a share of requests,
+or every request over a tokens-per-minute quota, is answered with 429 and
+Retry-After. Responses carry x-ratelimit-remaining-* headers like the real
+service. Embeddings are a deterministic hashed bag of words, so similar texts
+get similar vectors and retrieval behaves plausibly.
+
+Start one FakeAzureOpenAI per deployment to get a pool for the router.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import struct
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+from aiohttp import web
+
+DIMENSIONS = 1536
+ANSWER_WORDS = (
+    "the answer draws on the uploaded documents and the earlier turns of this "
+    "conversation to explain the requested details step by step with examples"
+).split()
+
+
+@dataclass
+class OpenAIProfile:
+    """Behaviour of one fake deployment."""
+
+    first_token_ms: float = 300.0
+    token_interval_ms: float = 15.0
+    answer_tokens: int = 120
+    completion_ms: float = 400.0
+    embedding_ms: float = 40.0
+    jitter: float = 0.2
+    throttle_rate: float = 0.0
+    retry_after_ms: float = 1000.0
+    tokens_per_minute: Optional[int] = None
+    requests_per_minute: Optional[int] = None
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def embed_text(
+    text: Union[str, List[int]], dimensions: int = DIMENSIONS
+) -> List[float]:
+    """Unit vector of hashed word stems (or token ids)."""
+    tokens = [str(t) for t in text] if isinstance(text, list) else _words(text)
+    vector = [0.0] * dimensions
+    for token in tokens:
+        digest = hashlib.md5(token[:5].encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += (
+            1.0 if digest[4] % 2 else -1.0
+        )
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class FakeAzureOpenAI:
+    """One fake Azure OpenAI endpoint; any deployment name is accepted."""
+
+    def __init__(self, profile: Optional[OpenAIProfile] = None, seed: int = 0):
+        self.profile = profile or OpenAIProfile()
+        self.stats: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self._window_started = time.monotonic()
+        self._window_tokens = 0
+        self._window_requests = 0
+        self.endpoint: Optional[str] = None
+
+    async def start(self) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(
+            "/openai/deployments/{deployment}/chat/completions", self._chat
+        )
+        app.router.add_post("/openai/deployments/{deployment}/embeddings", self._embed)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.endpoint = f"http://127.0.0.1:{port}"
+        return self.endpoint
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _sleep_seconds(self, ms: float) -> float:
+        jitter = self.profile.jitter
+        return max(0.0, ms * (1 + self._rng.uniform(-jitter, jitter))) / 1000
+
+    def _rate_limit(self, tokens: int) -> Dict[str, str]:
+        """Spends quota for a request; raises 429 when it is out or injected."""
+        now = time.monotonic()
+        if now - self._window_started >= 60:
+            self._window_started = now
+            self._window_tokens = self._window_requests = 0
+        tpm, rpm = self.profile.tokens_per_minute, self.profile.requests_per_minute
+        over_quota = (tpm is not None and self._window_tokens + tokens > tpm) or (
+            rpm is not None and self._window_requests + 1 > rpm
+        )
+        if over_quota or self._rng.random() < self.profile.throttle_rate:
+            self.stats["throttled"] += 1
+            retry_after = self.profile.retry_after_ms
+            if over_quota:
+                retry_after = max(
+                    retry_after, (60 - (now - self._window_started)) * 1000
+                )
+            raise web.HTTPTooManyRequests(
+                text=json.dumps(
+                    {
+                        "error": {
+                            "code": "429",
+                            "message": "Rate limit is exceeded (injected).",
+                        }
+                    }
+                ),
+                content_type="application/json",
+                headers={
+                    "retry-after-ms": str(int(retry_after)),
+                    "retry-after": str(math.ceil(retry_after / 1000)),
+                    **self._quota_headers(),
+                },
+            )
+        self._window_tokens += tokens
+        self._window_requests += 1
+        return self._quota_headers()
+
+    def _quota_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.profile.tokens_per_minute is not None:
+            headers["x-ratelimit-remaining-tokens"] = str(
+                max(0, self.profile.tokens_per_minute - self._window_tokens)
+            )
+        if self.profile.requests_per_minute is not None:
+            headers["x-ratelimit-remaining-requests"] = str(
+                max(0, self.profile.requests_per_minute - self._window_requests)
+            )
+        return headers
+
+    def _answer(self, max_tokens: Optional[int]) -> List[str]:
+        count = min(
+            self.profile.answer_tokens, max_tokens or self.profile.answer_tokens
+        )
+        return [
+            (" " if i else "") + ANSWER_WORDS[i % len(ANSWER_WORDS)]
+            for i in range(count)
+        ]
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        prompt_tokens = sum(
+            _estimate_tokens(str(m.get("content") or "")) + 4
+            for m in body.get("messages", [])
+        )
+        headers = self._rate_limit(prompt_tokens)
+        self.stats["chat_requests"] += 1
+        tokens = self._answer(
+            body.get("max_tokens") or body.get("max_completion_tokens")
+        )
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.match_info["deployment"]
+
+        if not body.get("stream"):
+            await asyncio.sleep(self._sleep_seconds(self.profile.completion_ms))
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(tokens),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+                headers=headers,
+            )
+
+        response = web.StreamResponse(
+            headers={**headers, "Content-Type": "text/event-stream"}
+        )
+        await response.prepare(request)
+
+        def chunk(delta: Dict[str, Any], finish_reason=None, **extra) -> bytes:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+                **extra,
+            }
+            return f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+
+        await asyncio.sleep(self._sleep_seconds(self.profile.first_token_ms))
+        await response.write(chunk({"role": "assistant", "content": ""}))
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self._sleep_seconds(self.profile.token_interval_ms))
+            await response.write(chunk({"content": token}))
+        await response.write(chunk({}, finish_reason="stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [],
+                "usage": usage,
+            }
+            await response.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _embed(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        tokens = sum(
+            len(text) if isinstance(text, list) else _estimate_tokens(text)
+            for text in inputs
+        )
+        headers = self._rate_limit(tokens)
+        self.stats["embedding_requests"] += 1
+        self.stats["embedding_inputs"] += len(inputs)
+        await asyncio.sleep(self._sleep_seconds(self.profile.embedding_ms))
+
+        dimensions = body.get("dimensions") or DIMENSIONS
+        as_base64 = body.get("encoding_format") == "base64"
+        data = []
+        for index, text in enumerate(inputs):
+            vector = embed_text(text, dimensions)
+            if as_base64:
+                packed = struct.pack(f"<{len(vector)}f", *vector)
+                vector = base64.b64encode(packed).decode("ascii")
+            data.append({"object": "embedding", "index": index, "embedding": vector})
+        return web.json_response(
+            {
+                "object": "list",
+                "model": request.match_info["deployment"],
+                "data": data,
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            },
+            headers=headers,
+        )
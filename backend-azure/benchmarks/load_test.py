@@ -0,0 +1,1235 @@
+"""
+End-to-end load test of the function app against local stand-ins.
+
+Starts fake Azure OpenAI deployments (benchmarks/fake_openai.py) and an
+in-process Cosmos DB (benchmarks/fake_cosmos.py), imports function_app with
+its settings pointed at them, seeds chats with history and indexed documents,
+and runs a trace of requests through the real route handlers: request_gpt,
+fetch_chat, fetch_chats, delete_chat and upload (polling upload_status until
+the ingestion job finishes). Reports per route throughput, latency
+percentiles, time to first token of streamed answers, server-side stage
+timings from the tracing spans, request units and peak memory.
+
+Traces are JSON lines, one request per line, e.g.
+
+    {"at": 0.25, "route": "request_gpt", "chat": 3, "user": "user-3", "q": "..."}
+
+where `at` is seconds from the start of the run and `chat` indexes the seeded
+chats. Presets generate synthetic traces; --record writes the trace of a run
+out and --trace replays one, open loop at its timestamps or closed loop with
+--concurrency.
+
+A run's report can be saved as the baseline of its preset or trace and later
+runs compared against it; a regression beyond --tolerance fails the run.
+Baselines are only comparable on the machine that recorded them.
+
+The isolation preset checks that parsing stays off the event loop: it runs
+half of a chat trace alone, then the other half while a large upload is
+being ingested, and fails if the request_gpt p95 of the second half exceeds
+the first by more than --tolerance.
+
+The history preset runs no trace: it appends turns to a new chat in each
+chat history storage mode, as request_gpt saves them, and reports the
+request units and latency of a turn's writes against the chat's length.
+
+    cd backend-azure
+    python -m benchmarks.load_test --preset chat
+    python -m benchmarks.load_test --preset chat --save-baseline
+    python -m benchmarks.load_test --preset chat --compare
+    python -m benchmarks.load_test --preset throttled --openai-throttle 0.5,0
+    python -m benchmarks.load_test --preset ingest --trace-memory
+    python -m benchmarks.load_test --preset isolation
+    python -m benchmarks.load_test --preset history --history-write-turns 500
+    python -m benchmarks.load_test --trace trace.jsonl --concurrency 16
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import httpx
+from starlette.requests import Request
+
+from benchmarks import fake_cosmos
+from benchmarks.fake_cosmos import FakeCosmosAccount, FaultProfile
+from benchmarks.fake_openai import FakeAzureOpenAI, OpenAIProfile
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+ROUTES = ("request_gpt", "fetch_chat", "fetch_chats", "upload", "delete_chat")
+JOB_POLL_SECONDS = 0.1
+JOB_TIMEOUT_SECONDS = 600
+# Latency changes smaller than this are noise, whatever their share
+NOISE_FLOOR_MS = 10.0
+SETTLE_TIMEOUT_SECONDS = 30
+HISTORY_STORAGE_MODES = ("document", "segmented")
+HISTORY_WRITE_BUCKETS = 5
+
+PRESETS: Dict[str, Dict[str, Any]] = {
+    # Steady chat traffic against chats with documents and some history
+    "chat": {"requests": 200, "rate": 20.0, "mix": {"request_gpt": 1.0}},
+    # What the frontend does: answers, chat loads, listings, uploads, deletes
+    "mixed": {
+        "requests": 300,
+        "rate": 30.0,
+        "mix": {
+            "request_gpt": 0.6,
+            "fetch_chat": 0.2,
+            "fetch_chats": 0.14,
+            "upload": 0.03,
+            "delete_chat": 0.03,
+        },
+    },
+    # A burst beyond the admission limits
+    "burst": {"requests": 300, "rate": 300.0, "mix": {"request_gpt": 1.0}},
+    # Chat traffic while one of two deployments is throttled
+    "throttled": {
+        "requests": 200,
+        "rate": 20.0,
+        "mix": {"request_gpt": 1.0},
+        "openai_throttle": "0.5,0",
+    },
+    # Large PDF uploads, for ingestion time and peak memory
+    "ingest": {
+        "requests": 4,
+        "rate": 0.5,
+        "mix": {"upload": 1.0},
+        "upload_pages": 120,
+    },
+    # Chat traffic alone, then while a large upload is parsed
+    "isolation": {
+        "requests": 400,
+        "rate": 20.0,
+        "mix": {"request_gpt": 1.0},
+        "background_upload_pages": 300,
+    },
+    # Write cost of a turn as the history grows, document vs segmented mode
+    "history": {"requests": 0, "chats": 0, "history_write_turns": 200},
+}
+
+# Seeded documents and questions are drawn from per-chat topic words, so a
+# question finds the chunks of its chat
+SYLLABLES = ["ka", "lo", "mi", "ra", "to", "ve", "zu", "ne", "pa", "si", "do", "fe"]
+VOCABULARY = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in ("n", "r", "")]
+FILLER = "the of and to in is for that with on as by this are from at".split()
+
+
+@dataclass
+class Settings:
+    preset: Optional[str] = "chat"
+    trace: Optional[str] = None
+    record: Optional[str] = None
+    requests: int = 200
+    rate: float = 20.0
+    concurrency: Optional[int] = None
+    mix: Dict[str, float] = field(default_factory=lambda: {"request_gpt": 1.0})
+    chats: int = 20
+    users: int = 5
+    history_turns: int = 6
+    documents_per_chat: int = 40
+    repeat_rate: float = 0.1
+    upload_pages: int = 20
+    background_upload_pages: int = 0
+    history_write_turns: int = 0
+    openai_pool: int = 1
+    openai_throttle: str = "0"
+    first_token_ms: float = 300.0
+    token_interval_ms: float = 15.0
+    answer_tokens: int = 120
+    embedding_ms: float = 40.0
+    cosmos_latency_ms: float = 5.0
+    cosmos_throttle: float = 0.0
+    trace_memory: bool = False
+    seed: int = 7
+
+
+@dataclass
+class Result:
+    route: str
+    status: int
+    latency_ms: float
+    ttft_ms: Optional[float] = None
+    ingest_ms: Optional[float] = None
+    # Chunks an upload's ingestion job indexed
+    chunks: Optional[int] = None
+    busy: bool = False
+    error: Optional[str] = None
+
+
+# --- Workload ------------------------------------------------------------------
+
+
+def chat_topic(seed: int, chat: int) -> List[str]:
+    return random.Random(f"{seed}-{chat}").sample(VOCABULARY, 40)
+
+
+def synthetic_text(rng: random.Random, topic: List[str], words: int) -> str:
+    return " ".join(
+        rng.choice(topic) if rng.random() < 0.5 else rng.choice(FILLER)
+        for _ in range(words)
+    )
+
+
+def synthetic_question(rng: random.Random, topic: List[str]) -> str:
+    return f"What do the documents say about {' '.join(rng.sample(topic, 4))}?"
+
+
+def synthetic_trace(settings: Settings) -> List[Dict[str, Any]]:
+    """Poisson arrivals at `rate`, routes drawn from `mix`."""
+    rng = random.Random(settings.seed)
+    routes, weights = zip(*settings.mix.items())
+    asked: Dict[int, List[str]] = {}
+    events, at = [], 0.0
+    for _ in range(settings.requests):
+        at += rng.expovariate(settings.rate) if settings.rate else 0.0
+        chat = rng.randrange(settings.chats)
+        event = {
+            "at": round(at, 4),
+            "route": rng.choices(routes, weights)[0],
+            "chat": chat,
+            "user": f"user-{chat % settings.users}",
+        }
+        if event["route"] == "request_gpt":
+            if asked.get(chat) and rng.random() < settings.repeat_rate:
+                event["q"] = rng.choice(asked[chat])
+            else:
+                event["q"] = synthetic_question(rng, chat_topic(settings.seed, chat))
+                asked.setdefault(chat, []).append(event["q"])
+        elif event["route"] == "fetch_chat":
+            event["limit"] = 50
+        elif event["route"] == "upload":
+            event["pages"] = settings.upload_pages
+        events.append(event)
+    return events
+
+
+def load_trace(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as file:
+        events = [json.loads(line) for line in file if line.strip()]
+    return sorted(events, key=lambda event: event.get("at", 0.0))
+
+
+def save_trace(path: str, events: List[Dict[str, Any]]) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        for event in events:
+            file.write(json.dumps(event) + "\n")
+
+
+def synthetic_pdf(pages: int, rng: random.Random, topic: List[str]) -> bytes:
+    """A PDF of `pages` pages of text, made without a PDF library."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # the page tree, once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_refs = []
+    for _ in range(pages):
+        lines = [synthetic_text(rng, topic, 12) for _ in range(45)]
+        text = " Tj T* ".join(f"({line})" for line in lines)
+        stream = f"BT /F1 10 Tf 14 TL 50 760 Td {text} Tj ET".encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        page_refs.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(page_refs),
+        pages,
+    )
+
+    pdf, offsets = bytearray(b"%PDF-1.4\n"), []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return bytes(pdf)
+
+
+# --- Driving the handlers ------------------------------------------------------
+
+
+def route_handlers(app) -> Dict[str, Callable]:
+    """The user functions of the app's HTTP routes, by first path segment."""
+    handlers = {}
+    for function in app.get_functions():
+        trigger = vars(function.get_trigger())
+        route = trigger.get("route") or function.get_function_name()
+        handlers[route.split("/")[0]] = function.get_user_function()
+    return handlers
+
+
+def build_request(
+    method: str,
+    path: str,
+    user: str,
+    path_params: Optional[Dict[str, str]] = None,
+    **content,
+) -> Request:
+    """A Starlette request like the one the Functions host passes to a handler."""
+    outgoing = httpx.Request(
+        method,
+        f"http://localhost/api/{path}",
+        headers={"x-ms-client-principal-id": user},
+        **content,
+    )
+    body = outgoing.read()
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": outgoing.url.path,
+        "raw_path": outgoing.url.path.encode("ascii"),
+        "root_path": "",
+        "query_string": outgoing.url.query,
+        "headers": outgoing.headers.raw,
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 80),
+        "path_params": path_params or {},
+    }
+    delivered = False
+
+    async def receive():
+        nonlocal delivered
+        if delivered:
+            return {"type": "http.disconnect"}
+        delivered = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+async def read_response(response) -> Tuple[bytes, Optional[float]]:
+    """Consumes a response; returns its body and when its first chunk came."""
+    iterator = getattr(response, "body_iterator", None)
+    if iterator is None:
+        return response.body, None
+    first_chunk_at, chunks = None, []
+    async for chunk in iterator:
+        if first_chunk_at is None:
+            first_chunk_at = time.perf_counter()
+        chunks.append(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8"))
+    return b"".join(chunks), first_chunk_at
+
+
+class LoadTest:
+    def __init__(
+        self,
+        settings: Settings,
+        handlers: Dict[str, Callable],
+        chat_ids: List[str],
+        spare_chat_ids: List[str],
+    ):
+        self.settings = settings
+        self.handlers = handlers
+        self.chat_ids = chat_ids
+        # Deletes take seeded chats nothing else uses, so later requests of the
+        # trace do not hit deleted chats
+        self.spare_chat_ids = spare_chat_ids
+
+    def chat_id(self, event: Dict[str, Any]) -> str:
+        return self.chat_ids[event.get("chat", 0) % len(self.chat_ids)]
+
+    async def run_event(self, event: Dict[str, Any]) -> Result:
+        route = event["route"]
+        user = event.get("user", "user-0")
+        started = time.perf_counter()
+        try:
+            if route == "request_gpt":
+                result = await self._request_gpt(event, user, started)
+            elif route == "upload":
+                result = await self._upload(event, user, started)
+            else:
+                if route == "fetch_chat":
+                    params = {"chat_id": self.chat_id(event)}
+                    if event.get("limit"):
+                        params["limit"] = event["limit"]
+                    request = build_request("GET", route, user, params=params)
+                elif route == "fetch_chats":
+                    request = build_request("GET", route, user)
+                elif route == "delete_chat":
+                    chat_id = self.spare_chat_ids.pop()
+                    request = build_request(
+                        "DELETE",
+                        f"{route}/{chat_id}",
+                        user,
+                        path_params={"chat_id": chat_id},
+                    )
+                else:
+                    raise ValueError(f"Unknown route {route}")
+                response = await self.handlers[route](request)
+                body, _ = await read_response(response)
+                result = Result(
+                    route,
+                    response.status_code,
+                    (time.perf_counter() - started) * 1000,
+                    error=body[:200].decode() if response.status_code >= 400 else None,
+                )
+        except Exception as e:
+            result = Result(
+                route, 599, (time.perf_counter() - started) * 1000, error=repr(e)
+            )
+        return result
+
+    async def _request_gpt(
+        self, event: Dict[str, Any], user: str, started: float
+    ) -> Result:
+        request = build_request(
+            "POST",
+            "request_gpt",
+            user,
+            json={"q": event["q"], "chatId": self.chat_id(event)},
+        )
+        response = await self.handlers["request_gpt"](request)
+        body, first_chunk_at = await read_response(response)
+        busy = response.status_code == 503 or b"event: busy" in body
+        error = None
+        if (response.status_code >= 400 and not busy) or b"data: ERROR" in body:
+            error = body[:200].decode("utf-8", "replace")
+        return Result(
+            "request_gpt",
+            response.status_code,
+            (time.perf_counter() - started) * 1000,
+            ttft_ms=(
+                (first_chunk_at - started) * 1000
+                if first_chunk_at and not busy and not error
+                else None
+            ),
+            busy=busy,
+            error=error,
+        )
+
+    async def _upload(self, event: Dict[str, Any], user: str, started: float) -> Result:
+        rng = random.Random(f"{self.settings.seed}-{event.get('at')}-upload")
+        chat = event.get("chat", 0)
+        content = synthetic_pdf(
+            event.get("pages", self.settings.upload_pages),
+            rng,
+            chat_topic(self.settings.seed, chat),
+        )
+        request = build_request(
+            "POST",
+            "upload",
+            user,
+            data={"chatId": self.chat_id(event)},
+            files={"file": (f"upload-{chat}.pdf", content, "application/pdf")},
+        )
+        response = await self.handlers["upload"](request)
+        body, _ = await read_response(response)
+        accepted_ms = (time.perf_counter() - started) * 1000
+        if response.status_code != 202:
+            return Result(
+                "upload", response.status_code, accepted_ms, error=body[:200].decode()
+            )
+
+        # Ingestion runs in the background; follow it like the frontend does
+        job_id = json.loads(body)["job_id"]
+        deadline = time.perf_counter() + JOB_TIMEOUT_SECONDS
+        while True:
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            status_request = build_request(
+                "GET", f"upload_status/{job_id}", user, path_params={"job_id": job_id}
+            )
+            status_body, _ = await read_response(
+                await self.handlers["upload_status"](status_request)
+            )
+            job = json.loads(status_body)
+            if job.get("status") in ("completed", "failed"):
+                break
+            if time.perf_counter() > deadline:
+                job = {"status": "failed", "error": "benchmark timeout"}
+                break
+        return Result(
+            "upload",
+            response.status_code,
+            accepted_ms,
+            ingest_ms=(time.perf_counter() - started) * 1000,
+            chunks=job.get("chunks_indexed"),
+            error=job.get("error") if job.get("status") == "failed" else None,
+        )
+
+    async def run(self, events: List[Dict[str, Any]]) -> List[Result]:
+        """Open loop at the events' timestamps, or closed loop with `concurrency`."""
+        if self.settings.concurrency:
+            queue: asyncio.Queue = asyncio.Queue()
+            for event in events:
+                queue.put_nowait(event)
+            results: List[Result] = []
+
+            async def worker() -> None:
+                while not queue.empty():
+                    # Each request in its own task, as the host runs them
+                    event = queue.get_nowait()
+                    results.append(await asyncio.create_task(self.run_event(event)))
+
+            await asyncio.gather(*(worker() for _ in range(self.settings.concurrency)))
+            return results
+
+        started = time.perf_counter()
+        tasks = []
+        for event in events:
+            delay = started + event.get("at", 0.0) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.run_event(event)))
+        return list(await asyncio.gather(*tasks))
+
+    async def run_during_upload(
+        self, events: List[Dict[str, Any]], pages: int
+    ) -> List[Result]:
+        """Runs the events while an upload of `pages` pages is being ingested."""
+        upload = asyncio.create_task(
+            self.run_event({"route": "upload", "chat": 0, "pages": pages})
+        )
+        results = await self.run(events)
+        return results + [await upload]
+
+
+# --- Setup ---------------------------------------------------------------------
+
+
+async def start_openai_pool(
+    settings: Settings,
+) -> Tuple[List[FakeAzureOpenAI], List[Dict[str, Any]]]:
+    """Fake endpoints, one chat and one embeddings deployment on each."""
+    throttles = [float(rate) for rate in settings.openai_throttle.split(",")]
+    size = max(settings.openai_pool, len(throttles))
+    fakes, deployments = [], []
+    for index in range(size):
+        fake = FakeAzureOpenAI(
+            OpenAIProfile(
+                first_token_ms=settings.first_token_ms,
+                token_interval_ms=settings.token_interval_ms,
+                answer_tokens=settings.answer_tokens,
+                embedding_ms=settings.embedding_ms,
+                throttle_rate=throttles[index] if index < len(throttles) else 0.0,
+            ),
+            seed=settings.seed + index,
+        )
+        endpoint = await fake.start()
+        fakes.append(fake)
+        for kind, model in (("chat", "gpt-4o"), ("embeddings", "embeddings")):
+            deployments.append(
+                {
+                    "name": f"{kind}-{index}",
+                    "kind": kind,
+                    "endpoint": endpoint,
+                    "deployment": model,
+                }
+            )
+    return fakes, deployments
+
+
+def configure_environment(deployments: List[Dict[str, Any]], workdir: str) -> None:
+    """Points the app's settings at the fakes; must run before it is imported."""
+    os.environ["AZURE_OPENAI_DEPLOYMENTS"] = json.dumps(deployments)
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "benchmark")
+    os.environ.setdefault("AZURE_OPENAI_API_VERSION", "2024-10-21")
+    os.environ.setdefault("AZURE_COSMOS_DB_ENDPOINT", "https://localhost:8081/")
+    os.environ.setdefault("AZURE_COSMOS_DB_KEY", "YmVuY2htYXJr")
+    # Fresh caches, so a run does not reuse the embeddings of the previous one
+    os.environ.setdefault(
+        "INGESTION_CACHE_PATH", os.path.join(workdir, "ingestion-cache.sqlite3")
+    )
+    os.environ.setdefault("LOCAL_VECTOR_INDEX_DIR", os.path.join(workdir, "vectors"))
+
+
+async def seed_chats(
+    settings: Settings, handlers: Dict[str, Callable], count: int
+) -> List[str]:
+    """Creates the chats through create_chat and gives them history and files."""
+    from langchain_core.documents import Document
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    from services.chat_history import chat_history_service
+    from services.vector_store import vector_store_service
+
+    chat_ids = []
+    for chat in range(count):
+        response = await handlers["create_chat"](
+            build_request("POST", "create_chat", f"user-{chat % settings.users}")
+        )
+        chat_id = json.loads(response.body)["id"]
+        chat_ids.append(chat_id)
+
+        rng = random.Random(f"{settings.seed}-{chat}-seed")
+        topic = chat_topic(settings.seed, chat)
+        documents = [
+            Document(
+                page_content=synthetic_text(rng, topic, 150),
+                metadata={
+                    "chat_id": chat_id,
+                    "filename": "seed.pdf",
+                    "page_number": index // 3 + 1,
+                },
+            )
+            for index in range(settings.documents_per_chat)
+        ]
+        if documents:
+            await vector_store_service.add_documents_to_vector_store(documents)
+            vector_store_service.flush_chat(chat_id)
+        history = await chat_history_service.get_history_instance(chat_id)
+        messages = []
+        for _ in range(settings.history_turns):
+            messages.append(HumanMessage(content=synthetic_question(rng, topic)))
+            messages.append(AIMessage(content=synthetic_text(rng, topic, 80)))
+        if messages:
+            await history.aadd_messages(messages)
+        if documents:
+            await history.aadd_files(["seed.pdf"])
+    return chat_ids
+
+
+async def settle_background_tasks() -> None:
+    """Waits for title generation and other fire-and-forget work to finish."""
+    from utils.background import _background_tasks
+
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=SETTLE_TIMEOUT_SECONDS)
+
+
+# --- Measuring -----------------------------------------------------------------
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _max_rss_bytes(who: int) -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemorySampler:
+    """Peak resident memory of this process while a run is going on."""
+
+    def __init__(self, interval_seconds: float = 0.05):
+        self.interval_seconds = interval_seconds
+        self.start_bytes = _rss_bytes()
+        self.peak_bytes = self.start_bytes or 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _sample(self) -> None:
+        while True:
+            self.peak_bytes = max(self.peak_bytes, _rss_bytes() or 0)
+            await asyncio.sleep(self.interval_seconds)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._sample())
+
+    def stop(self) -> Dict[str, Optional[float]]:
+        self._task.cancel()
+        self.peak_bytes = max(self.peak_bytes, _rss_bytes() or 0)
+        megabytes = 1024 * 1024
+        if self.start_bytes is None:
+            # No /proc: fall back to the lifetime peak
+            peak = _max_rss_bytes(resource.RUSAGE_SELF) if resource else None
+            return {"peak_rss_mb": peak / megabytes if peak else None}
+        return {
+            "peak_rss_mb": self.peak_bytes / megabytes,
+            "rss_growth_mb": (self.peak_bytes - self.start_bytes) / megabytes,
+        }
+
+
+async def measure_history_writes(
+    settings: Settings, handlers: Dict[str, Callable], cosmos: FakeCosmosAccount
+) -> Dict[str, Any]:
+    """
+    Appends `history_write_turns` turns, a question and an answer each, to a
+    new chat in every storage mode. Returns the mean request units and
+    milliseconds of a turn's writes per mode, overall and in buckets of turns.
+    """
+    from services.chat_history import chat_history_service
+
+    turns = settings.history_write_turns
+    bucket_size = math.ceil(turns / HISTORY_WRITE_BUCKETS)
+    configured_mode = chat_history_service.storage_mode
+    modes: Dict[str, Any] = {}
+    try:
+        for mode in HISTORY_STORAGE_MODES:
+            chat_history_service.storage_mode = mode
+            response = await handlers["create_chat"](
+                build_request("POST", "create_chat", "user-0")
+            )
+            chat_id = json.loads(response.body)["id"]
+            await settle_background_tasks()
+            history = await chat_history_service.get_history_instance(chat_id)
+            rng = random.Random(f"{settings.seed}-history")
+            topic = chat_topic(settings.seed, 0)
+            costs: List[Tuple[float, float]] = []
+            for _ in range(turns):
+                question = synthetic_question(rng, topic)
+                answer = synthetic_text(rng, topic, 80)
+                units = cosmos.stats["cosmos_request_units"]
+                started = time.perf_counter()
+                await history.aadd_user_message(question)
+                await history.aadd_ai_message(answer)
+                costs.append(
+                    (
+                        cosmos.stats["cosmos_request_units"] - units,
+                        (time.perf_counter() - started) * 1000,
+                    )
+                )
+            buckets = []
+            for first in range(0, turns, bucket_size):
+                bucket = costs[first : first + bucket_size]
+                buckets.append(
+                    {
+                        "first_turn": first + 1,
+                        "last_turn": first + len(bucket),
+                        "ru_per_turn": statistics.mean(ru for ru, _ in bucket),
+                        "ms_per_turn": statistics.mean(ms for _, ms in bucket),
+                    }
+                )
+            modes[mode] = {
+                "ru_per_turn": statistics.mean(ru for ru, _ in costs),
+                "ms_per_turn": statistics.mean(ms for _, ms in costs),
+                "buckets": buckets,
+            }
+    finally:
+        chat_history_service.storage_mode = configured_mode
+    return modes
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """Nearest-rank p50/p95/p99 and the mean."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "mean": statistics.mean(ordered),
+    }
+
+
+def stage_breakdown(spans) -> Dict[str, Dict[str, float]]:
+    """Mean milliseconds per stage for each route, from the finished traces."""
+    per_route: Dict[str, Dict[str, List[float]]] = {}
+    for span in spans:
+        if span.parent_span_id is not None or span.trace_id is None:
+            continue
+        stages = per_route.setdefault(span.name.lstrip("/"), {})
+        stages.setdefault("total", []).append(span.duration_ms)
+        for name, ms in span.stage_durations().items():
+            stages.setdefault(name, []).append(ms)
+    for span in spans:
+        first_token = span.attributes.get("time_to_first_token_ms")
+        if span.name == "llm_stream" and first_token is not None:
+            per_route.setdefault("request_gpt", {}).setdefault(
+                "llm_first_token", []
+            ).append(first_token)
+    return {
+        route: {name: statistics.mean(values) for name, values in stages.items()}
+        for route, stages in per_route.items()
+    }
+
+
+def build_report(
+    settings: Settings,
+    results: List[Result],
+    duration_seconds: float,
+    spans,
+    memory: Dict[str, Optional[float]],
+    cosmos: FakeCosmosAccount,
+    openai_fakes: List[FakeAzureOpenAI],
+    counters: Dict[str, float],
+) -> Dict[str, Any]:
+    routes = {}
+    stages = stage_breakdown(spans)
+    for route in sorted({result.route for result in results}):
+        mine = [result for result in results if result.route == route]
+        ok = [r for r in mine if not r.busy and r.error is None]
+        entry: Dict[str, Any] = {
+            "requests": len(mine),
+            "ok": len(ok),
+            "busy": sum(r.busy for r in mine),
+            "errors": sum(r.error is not None for r in mine),
+            "throughput_rps": len(ok) / duration_seconds if duration_seconds else 0.0,
+            "latency_ms": percentiles([r.latency_ms for r in ok]),
+        }
+        ttft = [r.ttft_ms for r in ok if r.ttft_ms is not None]
+        if ttft:
+            entry["ttft_ms"] = percentiles(ttft)
+        ingest = [r.ingest_ms for r in ok if r.ingest_ms is not None]
+        if ingest:
+            entry["ingest_ms"] = percentiles(ingest)
+        ingested = [r for r in ok if r.chunks is not None and r.ingest_ms]
+        if ingested:
+            entry["chunks"] = sum(r.chunks for r in ingested)
+            entry["chunks_per_s"] = percentiles(
+                [r.chunks / (r.ingest_ms / 1000) for r in ingested]
+            )
+        if route in stages:
+            entry["stages_ms"] = stages[route]
+        errors = [r.error for r in mine if r.error]
+        if errors:
+            entry["first_error"] = errors[0]
+        routes[route] = entry
+
+    if "ingestion_job" in stages:
+        routes.setdefault("upload", {})["job_stages_ms"] = stages["ingestion_job"]
+    parser_peak = (
+        _max_rss_bytes(resource.RUSAGE_CHILDREN) if resource is not None else None
+    )
+    if parser_peak and "upload" in routes:
+        memory["parser_peak_rss_mb"] = parser_peak / (1024 * 1024)
+
+    ok_total = sum(entry.get("ok", 0) for entry in routes.values())
+    openai_stats: Dict[str, float] = {}
+    for fake in openai_fakes:
+        for name, value in fake.stats.items():
+            openai_stats[name] = openai_stats.get(name, 0) + value
+    return {
+        "preset": settings.preset,
+        "trace": settings.trace,
+        "settings": asdict(settings),
+        "duration_s": duration_seconds,
+        "totals": {
+            "requests": len(results),
+            "ok": ok_total,
+            "throughput_rps": ok_total / duration_seconds if duration_seconds else 0.0,
+            "cosmos_ru_per_request": (
+                cosmos.stats["cosmos_request_units"] / len(results) if results else 0.0
+            ),
+        },
+        "routes": routes,
+        "memory": memory,
+        "cosmos": dict(cosmos.stats),
+        "openai": {
+            **openai_stats,
+            "failovers": counters.get("openai_failovers", 0),
+            "circuit_opened": counters.get("openai_circuit_opened", 0),
+            "prompt_tokens": counters.get("openai_prompt_tokens", 0),
+            "completion_tokens": counters.get("openai_completion_tokens", 0),
+        },
+        "counters": counters,
+    }
+
+
+def print_history_writes(report: Dict[str, Any]) -> None:
+    modes = report["history_writes"]
+    print(
+        f"\nWrites per turn (question and answer), "
+        f"{report['settings']['history_write_turns']} turns per mode"
+    )
+    print(
+        f"\n{'turns':>11}" + "".join(f" {mode + ' RU':>14} {'ms':>6}" for mode in modes)
+    )
+    buckets = zip(*(entry["buckets"] for entry in modes.values()))
+    for row in buckets:
+        turns = f"{row[0]['first_turn']}-{row[0]['last_turn']}"
+        print(
+            f"{turns:>11}"
+            + "".join(
+                f" {bucket['ru_per_turn']:14.1f} {bucket['ms_per_turn']:6.1f}"
+                for bucket in row
+            )
+        )
+    print(
+        f"{'all':>11}"
+        + "".join(
+            f" {entry['ru_per_turn']:14.1f} {entry['ms_per_turn']:6.1f}"
+            for entry in modes.values()
+        )
+    )
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    if "history_writes" in report:
+        print_history_writes(report)
+        return
+    print(
+        f"\n{report['totals']['requests']} requests in {report['duration_s']:.1f}s, "
+        f"{report['totals']['throughput_rps']:.1f} ok/s, "
+        f"{report['totals']['cosmos_ru_per_request']:.1f} RU/request"
+    )
+    print(
+        f"\n{'route':12} {'ok':>5} {'busy':>5} {'err':>4} {'rps':>6} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ttft p50':>9} {'ttft p95':>9}"
+    )
+    for route, entry in report["routes"].items():
+        if "requests" not in entry:
+            continue
+        latency = entry["latency_ms"]
+        ttft = entry.get("ttft_ms") or entry.get("ingest_ms") or {}
+        print(
+            f"{route:12} {entry['ok']:5d} {entry['busy']:5d} {entry['errors']:4d} "
+            f"{entry['throughput_rps']:6.1f} {latency.get('p50', 0):8.0f} "
+            f"{latency.get('p95', 0):8.0f} {latency.get('p99', 0):8.0f} "
+            f"{ttft.get('p50', 0):9.0f} {ttft.get('p95', 0):9.0f}"
+        )
+    print("(ttft columns show ingestion time for upload)")
+    for route, entry in report["routes"].items():
+        if entry.get("chunks_per_s"):
+            rate = entry["chunks_per_s"]
+            print(
+                f"{route} ingestion: {entry['chunks']} chunks, "
+                f"{rate['mean']:.0f} chunks/s per upload (p50 {rate['p50']:.0f})"
+            )
+    for route, entry in report["routes"].items():
+        for key in ("stages_ms", "job_stages_ms"):
+            if entry.get(key):
+                stages = ", ".join(f"{n} {ms:.0f}" for n, ms in entry[key].items())
+                print(f"{route} {key[:-3].replace('_', ' ')} (mean ms): {stages}")
+        if entry.get("first_error"):
+            print(f"{route} first error: {entry['first_error']}")
+    memory = ", ".join(
+        f"{name} {value:.0f}" for name, value in report["memory"].items() if value
+    )
+    print(f"memory (MB): {memory}")
+    openai = report["openai"]
+    print(
+        f"openai: {openai.get('chat_requests', 0)} chat / "
+        f"{openai.get('embedding_requests', 0)} embedding requests, "
+        f"{openai.get('throttled', 0)} throttled, {openai['failovers']:.0f} failovers; "
+        f"cosmos: {report['cosmos'].get('cosmos_throttled', 0)} throttled"
+    )
+
+
+# --- Baselines -----------------------------------------------------------------
+
+# (path in the report, whether higher is better)
+COMPARED_METRICS: List[Tuple[Tuple[str, ...], bool]] = (
+    [
+        (("totals", "throughput_rps"), True),
+        (("totals", "cosmos_ru_per_request"), False),
+        (("memory", "peak_rss_mb"), False),
+        (("memory", "python_peak_mb"), False),
+        (("routes", "upload", "chunks_per_s", "mean"), True),
+    ]
+    + [
+        (("history_writes", mode, "ru_per_turn"), False)
+        for mode in HISTORY_STORAGE_MODES
+    ]
+    + [
+        (("routes", route, metric, "p95"), False)
+        for route in ROUTES
+        for metric in ("latency_ms", "ttft_ms", "ingest_ms")
+    ]
+)
+
+
+def _lookup(report: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    value: Any = report
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(
+    baseline: Dict[str, Any], report: Dict[str, Any], tolerance: float
+) -> List[str]:
+    """Prints the change of each metric; returns the ones that regressed."""
+    regressions = []
+    print(f"\n{'metric':40} {'baseline':>10} {'current':>10} {'change':>8}")
+    for path, higher_is_better in COMPARED_METRICS:
+        before, after = _lookup(baseline, path), _lookup(report, path)
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        worse = -change if higher_is_better else change
+        noise = path[-1] == "p95" and abs(after - before) < NOISE_FLOOR_MS
+        flag = " REGRESSION" if worse > tolerance and not noise else ""
+        name = ".".join(path)
+        print(f"{name:40} {before:10.1f} {after:10.1f} {change:+8.0%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def split_trace(
+    events: List[Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """The two halves of a trace, the second one shifted to start at 0."""
+    half = len(events) // 2
+    offset = events[half].get("at", 0.0) if half < len(events) else 0.0
+    second = [{**event, "at": event.get("at", 0.0) - offset} for event in events[half:]]
+    return events[:half], second
+
+
+def isolation_summary(
+    alone: List[Result], during: List[Result], events: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """request_gpt latencies without and with the upload, and how they overlapped."""
+
+    def latencies(results: List[Result]) -> Dict[str, Dict[str, float]]:
+        ok = [
+            r
+            for r in results
+            if r.route == "request_gpt" and not r.busy and r.error is None
+        ]
+        return {
+            "latency_ms": percentiles([r.latency_ms for r in ok]),
+            "ttft_ms": percentiles([r.ttft_ms for r in ok if r.ttft_ms is not None]),
+        }
+
+    upload = next(r for r in during if r.route == "upload")
+    overlapped = sum(
+        upload.ingest_ms is not None and event.get("at", 0.0) * 1000 < upload.ingest_ms
+        for event in events
+    )
+    return {
+        "alone": latencies(alone),
+        "during_upload": latencies(during),
+        "upload_ingest_ms": upload.ingest_ms,
+        "upload_error": upload.error,
+        "overlapped_share": overlapped / len(events) if events else 0.0,
+    }
+
+
+def isolation_check(report: Dict[str, Any], tolerance: float) -> List[str]:
+    """Prints request_gpt p95 without and with the upload; returns the failures."""
+    isolation = report["isolation"]
+    failures = []
+    print(f"\n{'request_gpt p95':40} {'alone':>10} {'upload':>10} {'change':>8}")
+    for metric in ("latency_ms", "ttft_ms"):
+        before = isolation["alone"][metric].get("p95")
+        after = isolation["during_upload"][metric].get("p95")
+        if not before or after is None:
+            continue
+        change = (after - before) / before
+        noise = abs(after - before) < NOISE_FLOOR_MS
+        flag = " REGRESSION" if change > tolerance and not noise else ""
+        print(f"{metric:40} {before:10.1f} {after:10.1f} {change:+8.0%}{flag}")
+        if flag:
+            failures.append(metric)
+    if isolation["upload_error"]:
+        print(f"upload failed: {isolation['upload_error']}")
+        failures.append("upload")
+    else:
+        print(
+            f"upload ingested in {isolation['upload_ingest_ms']:.0f} ms, "
+            f"during {isolation['overlapped_share']:.0%} of the requests"
+        )
+    return failures
+
+
+def baseline_path(settings: Settings, directory: str = BASELINE_DIR) -> str:
+    name = settings.preset
+    if settings.trace:
+        name = os.path.splitext(os.path.basename(settings.trace))[0]
+    return os.path.join(directory, f"{name}.json")
+
+
+# --- Entry point ---------------------------------------------------------------
+
+
+async def run(settings: Settings, verbose: bool = False) -> Dict[str, Any]:
+    openai_fakes, deployments = await start_openai_pool(settings)
+    cosmos = FakeCosmosAccount(
+        FaultProfile(
+            latency_ms=settings.cosmos_latency_ms,
+            jitter_ms=settings.cosmos_latency_ms / 2,
+            throttle_rate=settings.cosmos_throttle,
+        ),
+        seed=settings.seed,
+    )
+    workdir = tempfile.mkdtemp(prefix="load-test-")
+    configure_environment(deployments, workdir)
+    fake_cosmos.install(cosmos)
+    try:
+        app_module = importlib.import_module("function_app")
+        # The app configures INFO logging on import; keep the report readable
+        logging.getLogger().setLevel(logging.INFO if verbose else logging.WARNING)
+        from core.parse_executor import parse_executor
+        from utils.metrics import counters_snapshot
+        from utils.tracing import InMemorySpanExporter, tracer
+
+        # get_functions() builds the functions; it can only be called once
+        handlers = route_handlers(app_module.app)
+        if settings.history_write_turns:
+            return {
+                "preset": settings.preset,
+                "trace": settings.trace,
+                "settings": asdict(settings),
+                "history_writes": await measure_history_writes(
+                    settings, handlers, cosmos
+                ),
+            }
+        events = (
+            load_trace(settings.trace) if settings.trace else synthetic_trace(settings)
+        )
+        if settings.record:
+            save_trace(settings.record, events)
+        deletes = sum(event["route"] == "delete_chat" for event in events)
+        chat_ids = await seed_chats(settings, handlers, settings.chats + deletes)
+        await settle_background_tasks()
+        load_test = LoadTest(
+            settings, handlers, chat_ids[: settings.chats], chat_ids[settings.chats :]
+        )
+        reference_results = None
+        if settings.background_upload_pages:
+            # The first half of the trace, alone, is what the rest is held to
+            reference, events = split_trace(events)
+            reference_results = await load_test.run(reference)
+            await settle_background_tasks()
+        # Measure the run only, not seeding
+        before = counters_snapshot()
+        cosmos.stats.clear()
+        for fake in openai_fakes:
+            fake.stats.clear()
+        exporter = InMemorySpanExporter()
+        tracer.add_exporter(exporter)
+        memory = MemorySampler()
+        if settings.trace_memory:
+            tracemalloc.start()
+        memory.start()
+
+        started = time.perf_counter()
+        if settings.background_upload_pages:
+            results = await load_test.run_during_upload(
+                events, settings.background_upload_pages
+            )
+        else:
+            results = await load_test.run(events)
+        duration = time.perf_counter() - started
+        await settle_background_tasks()
+
+        memory_report = memory.stop()
+        if settings.trace_memory:
+            memory_report["python_peak_mb"] = tracemalloc.get_traced_memory()[1] / (
+                1024 * 1024
+            )
+            tracemalloc.stop()
+        tracer.remove_exporter(exporter)
+        counters = {
+            name: value - before.get(name, 0)
+            for name, value in counters_snapshot().items()
+        }
+        parse_executor.shutdown()
+        report = build_report(
+            settings,
+            results,
+            duration,
+            exporter.spans(),
+            memory_report,
+            cosmos,
+            openai_fakes,
+            counters,
+        )
+        if reference_results is not None:
+            report["isolation"] = isolation_summary(reference_results, results, events)
+        return report
+    finally:
+        for fake in openai_fakes:
+            await fake.stop()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Tuple[Settings, argparse.Namespace]:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="chat")
+    parser.add_argument("--trace", help="replay this JSON lines trace")
+    parser.add_argument("--record", help="write the trace of this run here")
+    parser.add_argument("--requests", type=int)
+    parser.add_argument("--rate", type=float, help="arrivals per second")
+    parser.add_argument("--concurrency", type=int, help="closed loop with N clients")
+    parser.add_argument("--chats", type=int)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--history-turns", type=int)
+    parser.add_argument("--documents-per-chat", type=int)
+    parser.add_argument("--repeat-rate", type=float)
+    parser.add_argument("--upload-pages", type=int)
+    parser.add_argument("--history-write-turns", type=int)
+    parser.add_argument("--openai-pool", type=int, help="fake deployments per kind")
+    parser.add_argument(
+        "--openai-throttle", help="share of 429s per deployment, e.g. 0.5,0"
+    )
+    parser.add_argument("--first-token-ms", type=float)
+    parser.add_argument("--token-interval-ms", type=float)
+    parser.add_argument("--answer-tokens", type=int)
+    parser.add_argument("--embedding-ms", type=float)
+    parser.add_argument("--cosmos-latency-ms", type=float)
+    parser.add_argument("--cosmos-throttle", type=float, help="share of 429s")
+    parser.add_argument("--trace-memory", action="store_true", default=None)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--baseline-dir", default=BASELINE_DIR)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    values = dict(PRESETS[args.preset])
+    for name in Settings.__dataclass_fields__:
+        if getattr(args, name, None) is not None:
+            values[name] = getattr(args, name)
+    return Settings(**values), args
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    settings, args = parse_args(argv)
+    report = asyncio.run(run(settings, args.verbose))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    path = baseline_path(settings, args.baseline_dir)
+    status = 0
+    if args.compare:
+        if not os.path.exists(path):
+            print(f"\nNo baseline at {path}; record one with --save-baseline.")
+        else:
+            with open(path, encoding="utf-8") as file:
+                regressions = compare(json.load(file), report, args.tolerance)
+            if regressions:
+                print(
+                    f"\n{len(regressions)} metrics regressed beyond {args.tolerance:.0%}"
+                )
+                status = 1
+    if report.get("isolation"):
+        failures = isolation_check(report, args.tolerance)
+        if failures:
+            print(f"\nChat latency is not isolated from ingestion: {failures}")
+            status = 1
+    if args.save_baseline:
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nSaved baseline {path}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Offline relevance and latency benchmark for context retrieval.
+
+Compares plain vector ranking with hybrid (vector + full-text, fused with
+reciprocal rank fusion) followed by adaptive selection and overlap dedupe, on
+a small fixed corpus. Embeddings are a deterministic hashed bag of words and
+full-text ranking is a local BM25, so the numbers compare the ranking and
+selection logic in core/retrieval.py, not Azure OpenAI or Cosmos DB.
+
+    cd backend-azure && python -m benchmarks.retrieval_benchmark
+"""
+
+import hashlib
+import math
+import re
+import statistics
+import time
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from langchain_core.documents import Document
+
+from core.retrieval import (
+    Candidate,
+    dedupe_overlapping,
+    reciprocal_rank_fusion,
+    search_terms,
+    select_adaptive,
+)
+
+DIMENSIONS = 256
+
+# (id, filename, text). Neighbouring chunks of a file share an overlap, like
+# the output of RecursiveCharacterTextSplitter.
+CORPUS: List[Tuple[str, str, str]] = [
+    (
+        "h1",
+        "handbook.pdf",
+        "Employees accrue 25 days of annual leave per calendar year. Unused leave of up to 5 days can be carried over to the next year.",
+    ),
+    (
+        "h2",
+        "handbook.pdf",
+        "Unused leave of up to 5 days can be carried over to the next year. Carry-over days expire on 31 March.",
+    ),
+    (
+        "h3",
+        "handbook.pdf",
+        "Sick leave requires a doctor's note after three consecutive days of absence.",
+    ),
+    (
+        "h4",
+        "handbook.pdf",
+        "Remote work is allowed up to three days per week with manager approval.",
+    ),
+    (
+        "h5",
+        "handbook.pdf",
+        "The office opens at 8:00 and closes at 19:00 on weekdays. Badge access is required after hours.",
+    ),
+    (
+        "h6",
+        "handbook.pdf",
+        "Expense claims must be filed within 30 days with itemised receipts in the finance portal.",
+    ),
+    (
+        "h7",
+        "handbook.pdf",
+        "Travel above 500 EUR needs pre-approval from the department head and finance.",
+    ),
+    (
+        "h8",
+        "handbook.pdf",
+        "Parental leave is 16 weeks, paid at full salary, and can be split into two blocks.",
+    ),
+    (
+        "s1",
+        "spec.pdf",
+        "The ingestion service splits documents into chunks of 1000 characters with an overlap of 150 characters.",
+    ),
+    (
+        "s2",
+        "spec.pdf",
+        "Chunks are embedded with text-embedding-ada-002 and stored in Cosmos DB with a diskANN vector index.",
+    ),
+    (
+        "s3",
+        "spec.pdf",
+        "Error code E1042 means the embedding request was throttled; the client retries with exponential backoff.",
+    ),
+    (
+        "s4",
+        "spec.pdf",
+        "Error code E2001 indicates a malformed PDF that the parser could not open.",
+    ),
+    (
+        "s5",
+        "spec.pdf",
+        "The API rate limit is 60 requests per minute per user. Bursts above the limit receive HTTP 429.",
+    ),
+    (
+        "s6",
+        "spec.pdf",
+        "Backups of the chat database run nightly at 02:00 UTC and are kept for 35 days.",
+    ),
+    (
+        "s7",
+        "spec.pdf",
+        "The frontend polls upload_status every second until the ingestion job completes or fails.",
+    ),
+    (
+        "s8",
+        "spec.pdf",
+        "Full-text search uses a BM25 index on the text field with the en-US analyzer.",
+    ),
+]
+
+# (query, ids of the relevant chunks)
+QUERIES: List[Tuple[str, List[str]]] = [
+    ("How many vacation days do I get?", ["h1"]),
+    ("Can I carry over unused leave days?", ["h1", "h2"]),
+    ("What does error E1042 mean?", ["s3"]),
+    ("What is the rate limit of the API?", ["s5"]),
+    ("How long is parental leave?", ["h8"]),
+    ("When are backups taken and how long are they retained?", ["s6"]),
+    ("What chunk size and overlap does ingestion use?", ["s1"]),
+    ("Do I need a doctor's note when I'm sick?", ["h3"]),
+]
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def embed(text: str) -> List[float]:
+    vector = [0.0] * DIMENSIONS
+    for token in tokenize(text):
+        # Stems of 5 characters stand in for a model's tolerance of word forms
+        digest = hashlib.md5(token[:5].encode("utf-8")).digest()
+        vector[digest[0] % DIMENSIONS] += 1.0 if digest[1] % 2 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+class BM25:
+    def __init__(self, documents: Dict[str, str], k1: float = 1.2, b: float = 0.75):
+        self.k1, self.b = k1, b
+        self.terms = {
+            doc_id: Counter(tokenize(text)) for doc_id, text in documents.items()
+        }
+        self.lengths = {doc_id: sum(c.values()) for doc_id, c in self.terms.items()}
+        self.average_length = statistics.mean(self.lengths.values())
+        frequencies = Counter(t for counts in self.terms.values() for t in counts)
+        total = len(documents)
+        self.idf = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for term, df in frequencies.items()
+        }
+
+    def rank(self, terms: List[str], k: int) -> List[str]:
+        scores = {}
+        for doc_id, counts in self.terms.items():
+            norm = self.k1 * (
+                1 - self.b + self.b * self.lengths[doc_id] / self.average_length
+            )
+            score = sum(
+                self.idf.get(t, 0.0) * counts[t] * (self.k1 + 1) / (counts[t] + norm)
+                for t in terms
+                if t in counts
+            )
+            if score > 0:
+                scores[doc_id] = score
+        return sorted(scores, key=lambda doc_id: -scores[doc_id])[:k]
+
+
+def retrieve(
+    mode: str, query: str, vectors: Dict[str, List[float]], bm25: BM25
+) -> List[Candidate]:
+    texts = {doc_id: (filename, text) for doc_id, filename, text in CORPUS}
+
+    def document(doc_id: str) -> Document:
+        filename, text = texts[doc_id]
+        return Document(
+            page_content=text, metadata={"id": doc_id, "filename": filename}
+        )
+
+    query_vector = embed(query)
+    similarities = {doc_id: cosine(query_vector, v) for doc_id, v in vectors.items()}
+    vector_ranking = sorted(similarities, key=lambda d: -similarities[d])[:10]
+
+    if mode == "vector":
+        candidates = [
+            Candidate(document(d), similarities[d], similarities[d])
+            for d in vector_ranking
+        ]
+    else:
+        text_ranking = bm25.rank(search_terms(query, 16), k=10)
+        fused = reciprocal_rank_fusion([vector_ranking, text_ranking], k=60)
+        candidates = [
+            Candidate(
+                document(d), score, similarities[d] if d in vector_ranking else None
+            )
+            for d, score in fused.items()
+        ]
+    selected = select_adaptive(candidates, 2, 6, 0.4, 0.3)
+    return dedupe_overlapping(selected, min_overlap=50, max_overlap=200)
+
+
+def main() -> None:
+    vectors = {doc_id: embed(text) for doc_id, _, text in CORPUS}
+    bm25 = BM25({doc_id: text for doc_id, _, text in CORPUS})
+
+    print(
+        f"{'mode':8} {'recall':>7} {'MRR':>6} {'chunks':>7} {'chars':>6} {'p50 ms':>7}"
+    )
+    for mode in ("vector", "hybrid"):
+        recalls, reciprocal_ranks, chunks, chars, latencies = [], [], [], [], []
+        for query, relevant in QUERIES:
+            started = time.perf_counter()
+            selected = retrieve(mode, query, vectors, bm25)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+            selected_text = [c.document.page_content for c in selected]
+            relevant_text = [text for doc_id, _, text in CORPUS if doc_id in relevant]
+            found = [r for r in relevant_text if any(r in s for s in selected_text)]
+            recalls.append(len(found) / len(relevant))
+            rank = next(
+                (
+                    i
+                    for i, s in enumerate(selected_text, start=1)
+                    if any(r in s for r in relevant_text)
+                ),
+                None,
+            )
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+            chunks.append(len(selected))
+            chars.append(sum(len(s) for s in selected_text))
+
+        print(
+            f"{mode:8} {statistics.mean(recalls):7.2f} "
+            f"{statistics.mean(reciprocal_ranks):6.2f} "
+            f"{statistics.mean(chunks):7.1f} {statistics.mean(chars):6.0f} "
+            f"{statistics.median(latencies):7.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
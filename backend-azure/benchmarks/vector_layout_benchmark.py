@@ -0,0 +1,106 @@
+"""
+Query RU and latency of chat-scoped vector search in both partition layouts.
+
+Runs the same top-k vector query, filtered to a chat, against an
+id-partitioned and a chat-partitioned container holding the same documents
+(see tools/migrate_vector_layout.py). Needs the Cosmos DB settings of a real
+account; the query vectors are random since RU and latency do not depend on
+what is searched for.
+
+    cd backend-azure
+    python -m benchmarks.vector_layout_benchmark --chat-id 123 --chat-id 456 \\
+        --id-container langchain_python_container \\
+        --chat-container langchain_python_container_by_chat
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import Dict, List
+
+from core.cosmos_client import close_async_client
+from core.vector_stores import (
+    VECTOR_LAYOUT_CHAT,
+    VECTOR_LAYOUT_ID,
+    get_async_vector_container,
+    vector_embedding_policy,
+)
+
+QUERY = (
+    "SELECT TOP @k c.id, VectorDistance(c.embedding, @embedding) AS SimilarityScore "
+    "FROM c WHERE c.metadata.chat_id = @chat_id "
+    "ORDER BY VectorDistance(c.embedding, @embedding)"
+)
+
+
+def random_vector(dimensions: int) -> List[float]:
+    vector = [random.gauss(0, 1) for _ in range(dimensions)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+
+async def run_layout(
+    name: str, layout: str, chat_ids: List[str], queries: int, k: int
+) -> Dict[str, float]:
+    container = await get_async_vector_container(name, layout)
+    dimensions = vector_embedding_policy["vectorEmbeddings"][0]["dimensions"]
+    latencies, charges = [], []
+
+    for i in range(queries):
+        chat_id = chat_ids[i % len(chat_ids)]
+        charge = 0.0
+
+        def hook(headers, _result) -> None:
+            nonlocal charge
+            charge += float(headers.get("x-ms-request-charge", 0) or 0)
+
+        scope = {"partition_key": chat_id} if layout == VECTOR_LAYOUT_CHAT else {}
+        started = time.perf_counter()
+        items = container.query_items(
+            query=QUERY,
+            parameters=[
+                {"name": "@k", "value": k},
+                {"name": "@embedding", "value": random_vector(dimensions)},
+                {"name": "@chat_id", "value": chat_id},
+            ],
+            response_hook=hook,
+            **scope,
+        )
+        _ = [item async for item in items]
+        latencies.append((time.perf_counter() - started) * 1000)
+        charges.append(charge)
+
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+        "mean_ru": statistics.mean(charges),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        print(f"{'layout':8} {'p50 ms':>8} {'p95 ms':>8} {'mean RU':>8}")
+        for name, layout in (
+            (args.id_container, VECTOR_LAYOUT_ID),
+            (args.chat_container, VECTOR_LAYOUT_CHAT),
+        ):
+            result = await run_layout(name, layout, args.chat_id, args.queries, args.k)
+            print(
+                f"{layout:8} {result['p50_ms']:8.1f} {result['p95_ms']:8.1f} "
+                f"{result['mean_ru']:8.2f}"
+            )
+    finally:
+        await close_async_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--id-container", required=True)
+    parser.add_argument("--chat-container", required=True)
+    parser.add_argument("--chat-id", action="append", required=True)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("-k", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
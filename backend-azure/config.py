@@ -1,5 +1,6 @@
 import os
 import logging
+import tempfile
 from dotenv import load_dotenv
 
 logging.basicConfig(
@@ -18,7 +19,26 @@ class Config:
     COSMOS_DATABASE_NAME = "chat_messages_db"
     COSMOS_CONTAINER_NAME = "chat_messages_container"
     COSMOS_VECTOR_DB_NAME = "langchain_python_db"
-    COSMOS_VECTOR_CONTAINER_NAME = "langchain_python_container"
+    # "id" partitions vector documents by their own id, "chat" by
+    # metadata.chat_id so a chat's search and delete stay in one partition.
+    # A container's partition key is fixed, so each layout has its own container
+    VECTOR_PARTITION_LAYOUT = os.environ.get("VECTOR_PARTITION_LAYOUT", "id")
+    COSMOS_VECTOR_CONTAINER_NAME = os.environ.get(
+        "COSMOS_VECTOR_CONTAINER_NAME",
+        (
+            "langchain_python_container"
+            if VECTOR_PARTITION_LAYOUT == "id"
+            else f"langchain_python_container_by_{VECTOR_PARTITION_LAYOUT}"
+        ),
+    )
+    # "document" keeps a chat in one item, "segmented" stores one item per message
+    CHAT_HISTORY_STORAGE_MODE = os.environ.get("CHAT_HISTORY_STORAGE_MODE", "segmented")
+    # Chat listing: page size for /fetch_chats and how long pages are cached
+    CHAT_LIST_PAGE_SIZE = int(os.environ.get("CHAT_LIST_PAGE_SIZE", "50"))
+    CHAT_LIST_MAX_PAGE_SIZE = int(os.environ.get("CHAT_LIST_MAX_PAGE_SIZE", "100"))
+    CHAT_LIST_CACHE_TTL_SECONDS = int(
+        os.environ.get("CHAT_LIST_CACHE_TTL_SECONDS", "10")
+    )
 
     OPENAI_EMBEDDINGS_MODEL_NAME = os.environ.get(
         "OPENAI_EMBEDDINGS_MODEL_NAME", "text-embedding-ada-002"
@@ -29,6 +49,169 @@ class Config:
     OPENAI_EMBEDDINGS_API_VERSION = os.environ.get(
         "OPENAI_EMBEDDINGS_API_VERSION", "2024-12-01-preview"
     )
+    # Pool of Azure OpenAI deployments calls are spread over, as a JSON list of
+    # {"name", "kind": "chat" | "embeddings", "endpoint", "deployment",
+    # "api_version", "api_key_env", "tpm", "rpm"}. Unset, the single deployment
+    # settings above are used. Failing deployments are taken out of rotation
+    # after OPENAI_CIRCUIT_FAILURE_THRESHOLD consecutive errors
+    AZURE_OPENAI_DEPLOYMENTS = os.environ.get("AZURE_OPENAI_DEPLOYMENTS", "")
+    OPENAI_CIRCUIT_FAILURE_THRESHOLD = int(
+        os.environ.get("OPENAI_CIRCUIT_FAILURE_THRESHOLD", "3")
+    )
+    OPENAI_CIRCUIT_COOLDOWN_SECONDS = float(
+        os.environ.get("OPENAI_CIRCUIT_COOLDOWN_SECONDS", "30")
+    )
+
+    # Retrieval uses async embeddings + async Cosmos queries; when disabled the
+    # sync search runs on a bounded thread pool instead of the event loop
+    VECTOR_SEARCH_NATIVE_ASYNC = (
+        os.environ.get("VECTOR_SEARCH_NATIVE_ASYNC", "true").lower() == "true"
+    )
+    VECTOR_SEARCH_MAX_WORKERS = int(os.environ.get("VECTOR_SEARCH_MAX_WORKERS", "4"))
+
+    # "hybrid" fuses vector and full-text rankings with reciprocal rank fusion,
+    # "vector" is plain vector search. Both take RETRIEVAL_CANDIDATES per
+    # ranking and keep between MIN_K and MAX_K chunks depending on their scores
+    RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "hybrid")
+    RETRIEVAL_CANDIDATES = int(os.environ.get("RETRIEVAL_CANDIDATES", "10"))
+    RETRIEVAL_MIN_K = int(os.environ.get("RETRIEVAL_MIN_K", "2"))
+    RETRIEVAL_MAX_K = int(os.environ.get("RETRIEVAL_MAX_K", "6"))
+    RETRIEVAL_RELATIVE_SCORE = float(os.environ.get("RETRIEVAL_RELATIVE_SCORE", "0.4"))
+    RETRIEVAL_MIN_SIMILARITY = float(os.environ.get("RETRIEVAL_MIN_SIMILARITY", "0.75"))
+    RETRIEVAL_RRF_K = int(os.environ.get("RETRIEVAL_RRF_K", "60"))
+    # Upper bound for retrieved context in the system prompt
+    CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "3000"))
+
+    # Streamed tokens are grouped into SSE frames of up to this many bytes or
+    # this many milliseconds, whichever is reached first
+    SSE_FLUSH_BYTES = int(os.environ.get("SSE_FLUSH_BYTES", "256"))
+    SSE_FLUSH_INTERVAL_MS = int(os.environ.get("SSE_FLUSH_INTERVAL_MS", "20"))
+
+    # Upload embedding: batch limits, embedding requests and Cosmos writes in
+    # flight, and retries for throttled (429/5xx) embedding batches
+    EMBEDDING_BATCH_MAX_TOKENS = int(
+        os.environ.get("EMBEDDING_BATCH_MAX_TOKENS", "8000")
+    )
+    EMBEDDING_BATCH_MAX_INPUTS = int(os.environ.get("EMBEDDING_BATCH_MAX_INPUTS", "64"))
+    EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", "4"))
+    EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "5"))
+    VECTOR_WRITE_CONCURRENCY = int(os.environ.get("VECTOR_WRITE_CONCURRENCY", "16"))
+    VECTOR_DELETE_CONCURRENCY = int(os.environ.get("VECTOR_DELETE_CONCURRENCY", "32"))
+
+    # "cosmos" searches Cosmos DB only. "local" keeps chunks in per-chat NumPy
+    # indexes persisted under LOCAL_VECTOR_INDEX_DIR, for development and tests
+    # without Cosmos DB. "cached" keeps Cosmos DB as the source of truth and
+    # serves hot chats from an in-memory copy held for VECTOR_CACHE_TTL_SECONDS.
+    # Both evict least recently used chats beyond the memory budget per worker
+    VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "cosmos")
+    LOCAL_VECTOR_INDEX_DIR = os.environ.get(
+        "LOCAL_VECTOR_INDEX_DIR",
+        os.path.join(tempfile.gettempdir(), "openai-chat-app-vectors"),
+    )
+    LOCAL_VECTOR_MEMORY_BUDGET_MB = int(
+        os.environ.get("LOCAL_VECTOR_MEMORY_BUDGET_MB", "256")
+    )
+    VECTOR_CACHE_TTL_SECONDS = int(os.environ.get("VECTOR_CACHE_TTL_SECONDS", "300"))
+
+    # Local SQLite cache of chunk embeddings and parsed files, so re-uploads and
+    # duplicate chunks skip parsing and embedding
+    INGESTION_CACHE_ENABLED = (
+        os.environ.get("INGESTION_CACHE_ENABLED", "true").lower() == "true"
+    )
+    INGESTION_CACHE_PATH = os.environ.get(
+        "INGESTION_CACHE_PATH",
+        os.path.join(tempfile.gettempdir(), "openai-chat-app-cache.sqlite3"),
+    )
+    INGESTION_CACHE_TTL_SECONDS = int(
+        os.environ.get("INGESTION_CACHE_TTL_SECONDS", str(30 * 24 * 3600))
+    )
+    EMBEDDING_CACHE_MAX_ENTRIES = int(
+        os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "200000")
+    )
+    FILE_CACHE_MAX_ENTRIES = int(os.environ.get("FILE_CACHE_MAX_ENTRIES", "500"))
+
+    # Document parsing runs in a process pool with per-job timeout and limits
+    PARSE_MAX_WORKERS = int(os.environ.get("PARSE_MAX_WORKERS", "2"))
+    PARSE_TIMEOUT_SECONDS = int(os.environ.get("PARSE_TIMEOUT_SECONDS", "300"))
+    UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+    UPLOAD_MAX_PAGES = int(os.environ.get("UPLOAD_MAX_PAGES", "500"))
+
+    # Background ingestion of uploads: worker tasks per instance and how long
+    # finished jobs stay in the memory of the instance that ran them
+    INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS", "2"))
+    INGESTION_JOB_RETENTION_SECONDS = int(
+        os.environ.get("INGESTION_JOB_RETENTION_SECONDS", "3600")
+    )
+    # Job records are kept in Cosmos DB, so any instance can report a job's
+    # status. A job not updated for INGESTION_JOB_STALE_SECONDS is taken to
+    # have died with its instance and is run again when the file is re-uploaded
+    INGESTION_JOB_STALE_SECONDS = int(
+        os.environ.get("INGESTION_JOB_STALE_SECONDS", "900")
+    )
+    # Cosmos DB removes job records this long after their last update; until
+    # then re-uploading a file that completed reuses its job
+    INGESTION_JOB_RECORD_TTL_SECONDS = int(
+        os.environ.get("INGESTION_JOB_RECORD_TTL_SECONDS", str(30 * 24 * 3600))
+    )
+    # "memory" runs jobs on worker tasks of the instance that took the upload,
+    # for local development and tests. "storage" stages uploads in a blob
+    # container and queues the jobs on an Azure Storage queue that triggers
+    # ingest_upload on any instance; the connection string is read from the
+    # app setting named by INGESTION_STORAGE_CONNECTION
+    INGESTION_QUEUE_BACKEND = os.environ.get("INGESTION_QUEUE_BACKEND", "memory")
+    INGESTION_STORAGE_CONNECTION = os.environ.get(
+        "INGESTION_STORAGE_CONNECTION", "AzureWebJobsStorage"
+    )
+    INGESTION_QUEUE_NAME = os.environ.get("INGESTION_QUEUE_NAME", "ingestion-jobs")
+    INGESTION_BLOB_CONTAINER = os.environ.get(
+        "INGESTION_BLOB_CONTAINER", "ingestion-uploads"
+    )
+    # Streaming ingestion parses PDFs a window of pages at a time and feeds the
+    # chunks to embedding through a bounded queue of windows
+    INGESTION_STREAMING = (
+        os.environ.get("INGESTION_STREAMING", "true").lower() == "true"
+    )
+    INGESTION_PAGE_WINDOW = int(os.environ.get("INGESTION_PAGE_WINDOW", "10"))
+    INGESTION_QUEUE_WINDOWS = int(os.environ.get("INGESTION_QUEUE_WINDOWS", "2"))
+
+    # Prompt budget for system prompt, context, history and the new question.
+    # History that does not fit is replaced by a rolling summary on the chat item
+    PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "12000"))
+    HISTORY_SUMMARY_ENABLED = (
+        os.environ.get("HISTORY_SUMMARY_ENABLED", "true").lower() == "true"
+    )
+    HISTORY_SUMMARY_MAX_TOKENS = int(
+        os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "500")
+    )
+
+    # Answers are reused for near-identical questions in the same chat against
+    # the same files (cosine similarity of the question embeddings)
+    ANSWER_CACHE_ENABLED = (
+        os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+    )
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(
+        os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.97")
+    )
+    ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+    # Admission control for answer generation per worker: streams in total and
+    # per user, estimated tokens in flight (prompt plus ADMISSION_OUTPUT_TOKENS
+    # of answer), and a wait queue served round-robin across users. Requests
+    # that cannot start within the timeout, or find the queue full, get a
+    # "busy" event instead
+    ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "16"))
+    ADMISSION_MAX_PER_USER = int(os.environ.get("ADMISSION_MAX_PER_USER", "4"))
+    ADMISSION_MAX_TOKENS = int(os.environ.get("ADMISSION_MAX_TOKENS", "120000"))
+    ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+    ADMISSION_QUEUE_TIMEOUT_SECONDS = float(
+        os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10")
+    )
+    ADMISSION_OUTPUT_TOKENS = int(os.environ.get("ADMISSION_OUTPUT_TOKENS", "800"))
+
+    # OpenAI clients and the vector store are created on first use; with
+    # warm-up on they are created on a background thread right after start-up
+    STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "true").lower() == "true"
 
 
 app_config = Config()
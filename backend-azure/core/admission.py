@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict
+
+from config import app_config
+from utils.metrics import increment_counter
+
+logger = logging.getLogger(__name__)
+
+REJECTED_QUEUE_FULL = "queue_full"
+REJECTED_TIMEOUT = "timeout"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    user: str
+    cost: int
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Admission:
+    """A granted generation slot. `release` is idempotent."""
+
+    def __init__(self, controller: "AdmissionController", user: str, cost: int):
+        self._controller = controller
+        self.user = user
+        self.cost = cost
+        self.wait_ms = 0.0
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+
+class AdmissionController:
+    """
+    Limits the answer generations a worker runs at once: `max_concurrent` in
+    total, `max_per_user` per user, and `max_tokens` of estimated prompt and
+    answer tokens in flight (a single request is always let through on an idle
+    worker, however large). Requests beyond that wait in a queue of at most
+    `max_queue` entries that is served round-robin across users, so one busy
+    user cannot starve the others. A request that is not admitted within
+    `queue_timeout_seconds`, or finds the queue full, is rejected with
+    AdmissionRejected instead of timing out upstream with everyone else.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_per_user: int,
+        max_tokens: int,
+        max_queue: int,
+        queue_timeout_seconds: float,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_tokens = max_tokens
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self._active = 0
+        self._active_tokens = 0
+        self._active_by_user: Counter = Counter()
+        # Per-user FIFO queues, in the order users are served
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._queued = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queued
+
+    def saturated(self) -> bool:
+        """Whether a new request would be rejected right away."""
+        return self._queued >= self.max_queue
+
+    def _fits(self, user: str, cost: int) -> bool:
+        return (
+            self._active < self.max_concurrent
+            and self._active_by_user[user] < self.max_per_user
+            and (self._active == 0 or self._active_tokens + cost <= self.max_tokens)
+        )
+
+    def _admit(self, user: str, cost: int) -> None:
+        self._active += 1
+        self._active_tokens += cost
+        self._active_by_user[user] += 1
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        queue = self._queues.get(waiter.user)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del self._queues[waiter.user]
+
+    def _dispatch(self) -> None:
+        """Admits queued requests, one per user in turn, while they fit."""
+        progress = True
+        while progress and self._queues:
+            progress = False
+            for user in list(self._queues):
+                queue = self._queues[user]
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                    self._queued -= 1
+                admitted = bool(queue) and self._fits(user, queue[0].cost)
+                if admitted:
+                    waiter = queue.popleft()
+                    self._queued -= 1
+                    self._admit(user, waiter.cost)
+                    waiter.future.set_result(None)
+                    progress = True
+                if not queue:
+                    del self._queues[user]
+                elif admitted:
+                    self._queues.move_to_end(user)
+
+    def _release(self, admission: Admission) -> None:
+        self._active -= 1
+        self._active_tokens -= admission.cost
+        self._active_by_user[admission.user] -= 1
+        if self._active_by_user[admission.user] <= 0:
+            del self._active_by_user[admission.user]
+        self._dispatch()
+
+    async def acquire(self, user: str, cost: int) -> Admission:
+        """Waits for a generation slot; raises AdmissionRejected if none comes."""
+        admission = Admission(self, user, cost)
+        if not self._queued and self._fits(user, cost):
+            self._admit(user, cost)
+            increment_counter("admission_admitted")
+            return admission
+        if self._queued >= self.max_queue:
+            increment_counter("admission_rejected_queue_full")
+            raise AdmissionRejected(REJECTED_QUEUE_FULL, self.queue_timeout_seconds)
+
+        waiter = _Waiter(user, cost, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(user, deque()).append(waiter)
+        self._queued += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter.future), timeout=self.queue_timeout_seconds
+            )
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._dequeue(waiter)
+                increment_counter("admission_rejected_timeout")
+                raise AdmissionRejected(REJECTED_TIMEOUT, self.queue_timeout_seconds)
+        except asyncio.CancelledError:
+            # The client went away while queued; give the slot back if it was
+            # granted meanwhile
+            if waiter.future.done() and not waiter.future.cancelled():
+                admission.release()
+            else:
+                waiter.future.cancel()
+                self._dequeue(waiter)
+            raise
+
+        admission.wait_ms = (time.monotonic() - waiter.enqueued_at) * 1000
+        increment_counter("admission_admitted")
+        increment_counter("admission_queued")
+        increment_counter("admission_wait_ms", admission.wait_ms)
+        return admission
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "admission_queue_depth": self._queued,
+            "admission_active": self._active,
+            "admission_active_tokens": self._active_tokens,
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrent=app_config.ADMISSION_MAX_CONCURRENT,
+    max_per_user=app_config.ADMISSION_MAX_PER_USER,
+    max_tokens=app_config.ADMISSION_MAX_TOKENS,
+    max_queue=app_config.ADMISSION_MAX_QUEUE,
+    queue_timeout_seconds=app_config.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+)
@@ -0,0 +1,128 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import app_config
+from utils.metrics import increment_counter
+
+logger = logging.getLogger(__name__)
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def files_key(files: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sorted(set(files)))
+
+
+@dataclass
+class AnswerCacheEntry:
+    chat_id: str
+    files: Tuple[str, ...]
+    embedding: List[float]
+    answer: str
+    created_at: float = field(default_factory=time.time)
+
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by a chat, the set of files uploaded to it and the embedding
+    of the question. A question is answered from the cache when an earlier
+    question in the same chat, asked against the same files, is at least
+    `similarity_threshold` similar. Entries expire after `ttl_seconds` and the
+    least recently used ones are evicted beyond `max_entries`.
+
+    Only turns grounded in documents are cached: in a chat without files the
+    answer depends on the conversation alone, so a repeated follow-up such as
+    "tell me more" must not get the reply it had earlier.
+
+    Lives in the worker's memory; entries of a chat are dropped when its files
+    change, and entries from before a change on another worker never match
+    because the file set is part of the key.
+    """
+
+    def __init__(self, similarity_threshold: float, ttl_seconds: int, max_entries: int):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, AnswerCacheEntry]" = OrderedDict()
+        self._by_chat: Dict[str, List[int]] = {}
+        self._next_id = 0
+
+    def _expired(self, entry: AnswerCacheEntry, now: float) -> bool:
+        return now - entry.created_at > self.ttl_seconds
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        ids = self._by_chat.get(entry.chat_id, [])
+        if entry_id in ids:
+            ids.remove(entry_id)
+        if not ids:
+            self._by_chat.pop(entry.chat_id, None)
+
+    def lookup(
+        self, chat_id: str, files: Iterable[str], embedding: List[float]
+    ) -> Optional[str]:
+        """Returns the cached answer for the closest matching question, if any."""
+        key = files_key(files)
+        if not key:
+            return None
+        now = time.time()
+        best_id, best_score = None, self.similarity_threshold
+        for entry_id in list(self._by_chat.get(chat_id, [])):
+            entry = self._entries[entry_id]
+            if self._expired(entry, now):
+                self._remove(entry_id)
+                continue
+            if entry.files != key:
+                continue
+            score = cosine_similarity(embedding, entry.embedding)
+            if score >= best_score:
+                best_id, best_score = entry_id, score
+
+        if best_id is None:
+            increment_counter("answer_cache_misses")
+            return None
+        increment_counter("answer_cache_hits")
+        self._entries.move_to_end(best_id)
+        logger.info(
+            f"Answer cache hit for chat {chat_id} (similarity {best_score:.3f})"
+        )
+        return self._entries[best_id].answer
+
+    def store(
+        self, chat_id: str, files: Iterable[str], embedding: List[float], answer: str
+    ) -> None:
+        key = files_key(files)
+        if not key:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = AnswerCacheEntry(
+            chat_id=chat_id, files=key, embedding=embedding, answer=answer
+        )
+        self._by_chat.setdefault(chat_id, []).append(entry_id)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_chat(self, chat_id: str) -> None:
+        for entry_id in list(self._by_chat.get(chat_id, [])):
+            self._remove(entry_id)
+
+
+if app_config.ANSWER_CACHE_ENABLED:
+    answer_cache = SemanticAnswerCache(
+        similarity_threshold=app_config.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds=app_config.ANSWER_CACHE_TTL_SECONDS,
+        max_entries=app_config.ANSWER_CACHE_MAX_ENTRIES,
+    )
+else:
+    answer_cache = None
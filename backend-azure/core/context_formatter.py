@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from utils.tokens import CHARS_PER_TOKEN, estimate_tokens
+
+# Blocks cut down below this many tokens are dropped instead of truncated
+MIN_BLOCK_TOKENS = 32
+
+
+@dataclass
+class FormattedContext:
+    text: str
+    tokens: int
+    # What the previous JSON dump of the same chunks would have cost
+    baseline_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.baseline_tokens - self.tokens)
+
+
+@dataclass
+class _Block:
+    filename: Optional[str]
+    first_page: Optional[int]
+    last_page: Optional[int]
+    texts: List[str]
+
+    def tag(self) -> str:
+        source = self.filename or "document"
+        if self.first_page is None:
+            return f"[{source}]"
+        if self.last_page in (None, self.first_page):
+            return f"[{source} p.{self.first_page}]"
+        return f"[{source} p.{self.first_page}-{self.last_page}]"
+
+    def render(self) -> str:
+        return self.tag() + "\n" + "\n".join(self.texts)
+
+
+def _page(document: Document) -> Optional[int]:
+    page = document.metadata.get("page_number")
+    return page if isinstance(page, int) else None
+
+
+def _blocks(documents: List[Document]) -> List[_Block]:
+    """Groups consecutive chunks of the same file on the same or next page."""
+    blocks: List[_Block] = []
+    for document in documents:
+        filename = document.metadata.get("filename")
+        page = _page(document)
+        last = blocks[-1] if blocks else None
+        if (
+            last is not None
+            and last.filename == filename
+            and (
+                page is None
+                or last.last_page is None
+                or last.last_page <= page <= last.last_page + 1
+            )
+        ):
+            last.texts.append(document.page_content.strip())
+            if page is not None:
+                last.last_page = page
+            continue
+        blocks.append(_Block(filename, page, page, [document.page_content.strip()]))
+    return blocks
+
+
+def format_context(
+    documents_with_scores: List[Tuple[Document, float]], max_tokens: int
+) -> FormattedContext:
+    """
+    Renders retrieved chunks for the system prompt as plain text under a short
+    source tag, most relevant first, within `max_tokens`. The last block that
+    does not fit is truncated, later ones are dropped.
+    """
+    documents = [document for document, _ in documents_with_scores]
+    baseline_tokens = sum(
+        estimate_tokens(f"content: {document.model_dump_json()}, score: {score}\n\n")
+        for document, score in documents_with_scores
+    )
+
+    rendered: List[str] = []
+    used = 0
+    for block in _blocks(documents):
+        text = block.render()
+        tokens = estimate_tokens(text)
+        remaining = max_tokens - used
+        if tokens > remaining:
+            if remaining >= MIN_BLOCK_TOKENS:
+                rendered.append(
+                    text[: (remaining - 2) * CHARS_PER_TOKEN].rstrip() + " ..."
+                )
+                used = max_tokens
+            break
+        rendered.append(text)
+        used += tokens
+
+    text = "\n\n".join(rendered)
+    return FormattedContext(
+        text=text,
+        tokens=estimate_tokens(text) if text else 0,
+        baseline_tokens=baseline_tokens,
+    )
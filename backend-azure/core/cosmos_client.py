@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+from azure.cosmos import PartitionKey
+from azure.cosmos.aio import ContainerProxy, CosmosClient
+
+from config import app_config
+
+logger = logging.getLogger(__name__)
+
+_client: Optional[CosmosClient] = None
+_containers: Dict[Tuple[str, str], ContainerProxy] = {}
+_lock = asyncio.Lock()
+
+
+def get_async_client() -> CosmosClient:
+    """Returns the process-wide async Cosmos client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = CosmosClient(
+            app_config.AZURE_COSMOS_DB_ENDPOINT,
+            credential=app_config.AZURE_COSMOS_DB_KEY,
+        )
+        logger.info("Created shared async CosmosDB client.")
+    return _client
+
+
+async def get_container(
+    database_name: str,
+    container_name: str,
+    partition_key_path: str,
+    **container_kwargs,
+) -> ContainerProxy:
+    """
+    Returns a cached container handle. The database and container are created
+    if missing the first time a given container is requested by this worker.
+    """
+    key = (database_name, container_name)
+    container = _containers.get(key)
+    if container is not None:
+        return container
+
+    async with _lock:
+        container = _containers.get(key)
+        if container is None:
+            database = await get_async_client().create_database_if_not_exists(
+                database_name
+            )
+            container = await database.create_container_if_not_exists(
+                id=container_name,
+                partition_key=PartitionKey(path=partition_key_path),
+                **container_kwargs,
+            )
+            _containers[key] = container
+            logger.info(f"CosmosDB container ready: {database_name}/{container_name}")
+    return container
+
+
+async def get_chat_container() -> ContainerProxy:
+    """
+    Container holding chat documents, partitioned by user_id. Time to live is
+    on without a default, so only items with a `ttl` (ingestion job records)
+    expire; a container created before needs it turned on the same way.
+    """
+    return await get_container(
+        app_config.COSMOS_DATABASE_NAME,
+        app_config.COSMOS_CONTAINER_NAME,
+        "/user_id",
+        default_ttl=-1,
+    )
+
+
+async def close_async_client() -> None:
+    """Closes the shared client, e.g. on worker shutdown."""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+        _containers.clear()
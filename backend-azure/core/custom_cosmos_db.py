@@ -1,87 +1,498 @@
 from __future__ import annotations
-from typing import Any, Optional, List
+from typing import Any, Callable, Coroutine, Optional, List, Sequence, Tuple, TypeVar
 
-from langchain_community.chat_message_histories.cosmos_db import (
-    CosmosDBChatMessageHistory,
-)
+from azure.cosmos.aio import ContainerProxy
+from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    message_to_dict,
+    messages_from_dict,
     messages_to_dict,
 )
+import asyncio
 import logging
-from azure.cosmos.exceptions import CosmosHttpResponseError
+import time
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosHttpResponseError,
+    CosmosResourceExistsError,
+)
+
+from utils.metrics import cosmos_response_hook
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
 
+STORAGE_MODE_DOCUMENT = "document"
+STORAGE_MODE_SEGMENTED = "segmented"
+T = TypeVar("T")
 
-class CustomCosmosDBChatMessageHistory(CosmosDBChatMessageHistory):
+# Attempts of a write that lost a race with another writer of the same chat
+CONFLICT_MAX_ATTEMPTS = 5
+
+
+class CustomCosmosDBChatMessageHistory(BaseChatMessageHistory):
     """
-    Customized CosmosDBChatMessageHistory class with support for chat titles.
+    Async Cosmos DB chat message history with support for chat titles and files.
+
+    Works on a shared `azure.cosmos.aio` container handle, so creating an
+    instance is free and every storage operation is awaitable.
+
+    In "document" mode the whole conversation lives in a single item, like
+    langchain's CosmosDBChatMessageHistory. In "segmented" mode the chat item
+    only holds metadata (title, files) and every message is stored as its own
+    item in the same partition, so a new turn writes one small item instead of
+    the full history.
+
+    Title, files, the rolling summary of older turns and the chat item's etag
+    are cached when the history is loaded, so metadata changes are written as
+    conditional patches without re-reading the chat item first.
+
+    The sync methods of BaseChatMessageHistory run their async counterparts on
+    the event loop the instance was created on, so they can be called from
+    worker threads, e.g. by sync langchain runnables.
     """
 
     def __init__(
         self,
-        cosmos_endpoint: str,
-        cosmos_database: str,
-        cosmos_container: str,
+        container: ContainerProxy,
         session_id: str,
         user_id: str,
         title: Optional[str | None] = None,
-        credential: Any = None,
-        connection_string: Optional[str] = None,
-        ttl: Optional[int] = None,
-        cosmos_client_kwargs: Optional[dict] = None,
         files: Optional[List[str]] = [],
+        storage_mode: str = STORAGE_MODE_DOCUMENT,
+        on_listing_change: Optional[Callable[[], None]] = None,
     ):
-        super().__init__(
-            cosmos_endpoint,
-            cosmos_database,
-            cosmos_container,
-            session_id,
-            user_id,
-            credential=credential,
-            connection_string=connection_string,
-            ttl=ttl,
-            cosmos_client_kwargs=cosmos_client_kwargs,
-        )
+        if storage_mode not in (STORAGE_MODE_DOCUMENT, STORAGE_MODE_SEGMENTED):
+            raise ValueError(f"Unknown chat history storage mode: {storage_mode}")
+        self._container = container
+        self.session_id = session_id
+        self.user_id = user_id
         self.title = title
         self.files = files
+        self.storage_mode = storage_mode
+        # Called when a write moves the chat in the chat listing
+        self.on_listing_change = on_listing_change
+        self.messages: List[BaseMessage] = []
+        # Summary of messages[:summary_message_count], see ContextWindowService
+        self.summary: Optional[str] = None
+        self.summary_message_count = 0
+        self._chat_item_exists = False
+        self._etag: Optional[str] = None
+        # Leading messages known to be in the stored chat item (document mode);
+        # the ones after them are this instance's unsaved turns
+        self._stored_message_count = 0
+        # The aio container is bound to this loop
+        try:
+            self._loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            self._loop = None
+
+    @property
+    def segmented(self) -> bool:
+        return self.storage_mode == STORAGE_MODE_SEGMENTED
+
+    def _message_item_id(self, index: int) -> str:
+        return f"{self.session_id}-msg-{index:08d}"
+
+    def _message_item(self, index: int, message: BaseMessage) -> dict:
+        return {
+            "id": self._message_item_id(index),
+            "user_id": self.user_id,
+            "session_id": self.session_id,
+            "index": index,
+            "message": message_to_dict(message),
+        }
+
+    async def _touch_chat_item(self) -> None:
+        """Bumps the chat's updated_at, which orders the chat listing."""
+        await self._patch_chat_item(
+            [{"op": "set", "path": "/updated_at", "value": time.time()}]
+        )
+        self._listing_changed()
+
+    def _listing_changed(self) -> None:
+        if self.on_listing_change is not None:
+            self.on_listing_change()
+
+    def _remember_chat_item(self, item: dict) -> None:
+        """Caches what later writes need from a chat item read or written."""
+        self._chat_item_exists = True
+        self._etag = item.get("_etag")
+
+    async def _read_chat_item(self) -> dict:
+        return await self._container.read_item(
+            item=self.session_id,
+            partition_key=self.user_id,
+            response_hook=cosmos_response_hook,
+        )
+
+    async def _patch_chat_item(
+        self, operations: List[dict], conditional: bool = False
+    ) -> None:
+        kwargs = {}
+        if conditional and self._etag:
+            kwargs = {
+                "etag": self._etag,
+                "match_condition": MatchConditions.IfNotModified,
+            }
+        item = await self._container.patch_item(
+            item=self.session_id,
+            partition_key=self.user_id,
+            patch_operations=operations,
+            response_hook=cosmos_response_hook,
+            **kwargs,
+        )
+        self._remember_chat_item(item)
 
-    def _load_existing_title(self) -> None:
-        """Loads the existing title from Cosmos DB."""
-        item = self._container.read_item(
-            item=self.session_id, partition_key=self.user_id
+    async def _load_message_items(self) -> List[BaseMessage]:
+        """Reads the per-message items of a segmented chat in order."""
+        items = self._container.query_items(
+            query=(
+                "SELECT c.message FROM c "
+                "WHERE c.session_id = @session_id ORDER BY c.index"
+            ),
+            parameters=[{"name": "@session_id", "value": self.session_id}],
+            partition_key=self.user_id,
+            response_hook=cosmos_response_hook,
         )
-        return item["title"]
+        return messages_from_dict([item["message"] async for item in items])
+
+    @property
+    def etag(self) -> Optional[str]:
+        """Etag of the chat item; it changes whenever messages or metadata do."""
+        return self._etag
 
-    def _load_existing_files(self) -> List[str]:
-        """Loads filenames from Cosmos DB."""
+    async def aload_chat_item(self) -> Optional[dict]:
+        """
+        Reads the chat item alone: title, files, summary and etag, plus the
+        messages of single-document chats. Returns None if the chat is missing.
+        """
         try:
-            item = self._container.read_item(
-                item=self.session_id, partition_key=self.user_id
-            )
-            if "files" in item:
-                return item["files"]
-            else:
-                return []
-        # case: New chat document
+            item = await self._read_chat_item()
         except CosmosHttpResponseError:
-            return []
+            logger.info("no session found")
+            return None
 
-    def upsert_messages(self) -> None:
-        if not self._container:
-            raise ValueError("Container not initialized")
+        self._remember_chat_item(item)
+        self.title = self.title or item.get("title")
+        self.files = item.get("files", [])
+        self.summary = item.get("summary")
+        self.summary_message_count = item.get("summary_message_count", 0)
+        if item.get("messages"):
+            self.messages = messages_from_dict(item["messages"])
+            self._stored_message_count = len(self.messages)
+        return item
+
+    async def aload_messages(self) -> None:
+        """Retrieve the messages from Cosmos, in whichever layout they are stored."""
+        item = await self.aload_chat_item()
+        if item is None or not self.segmented:
+            return
+        if item.get("messages"):
+            await self.amigrate_to_segmented(item)
+        else:
+            self.messages = await self._load_message_items()
+
+    async def aget_message_window(
+        self,
+        limit: Optional[int] = None,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+    ) -> Tuple[List[Tuple[int, BaseMessage]], bool]:
+        """
+        Returns (index, message) pairs in order and whether more messages lie
+        beyond the window: the `limit` newest messages, or the newest ones
+        before index `before`, or the oldest ones after index `after`. Call
+        after aload_chat_item; segmented chats only read the window's items.
+        """
+        if not self._chat_item_exists:
+            return [], False
+        if not self.segmented or self.messages:
+            indexed = list(enumerate(self.messages))
+            if after is not None:
+                indexed = [pair for pair in indexed if pair[0] > after]
+                window = indexed[:limit] if limit else indexed
+            else:
+                if before is not None:
+                    indexed = [pair for pair in indexed if pair[0] < before]
+                window = indexed[-limit:] if limit else indexed
+            return window, len(window) < len(indexed)
+
+        conditions = ["c.session_id = @session_id"]
+        parameters = [{"name": "@session_id", "value": self.session_id}]
+        if after is not None:
+            conditions.append("c.index > @after")
+            parameters.append({"name": "@after", "value": after})
+        elif before is not None:
+            conditions.append("c.index < @before")
+            parameters.append({"name": "@before", "value": before})
+        top = ""
+        if limit:
+            # One extra row tells whether there is more beyond the window
+            top = "TOP @top "
+            parameters.append({"name": "@top", "value": limit + 1})
+        order = "ASC" if after is not None else "DESC"
+        items = self._container.query_items(
+            query=(
+                f"SELECT {top}c.index, c.message FROM c "
+                f"WHERE {' AND '.join(conditions)} ORDER BY c.index {order}"
+            ),
+            parameters=parameters,
+            partition_key=self.user_id,
+            response_hook=cosmos_response_hook,
+        )
+        rows = [item async for item in items]
+        has_more = bool(limit) and len(rows) > limit
+        rows = rows[:limit] if limit else rows
+        if order == "DESC":
+            rows.reverse()
+        messages = messages_from_dict([row["message"] for row in rows])
+        return [(row["index"], m) for row, m in zip(rows, messages)], has_more
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return self.messages
+
+    async def amigrate_to_segmented(self, item: dict) -> None:
+        """
+        Moves the messages of a single-document chat into per-message items and
+        strips them from the chat item. Safe to re-run: message items are upserted
+        under deterministic ids before the chat item is rewritten.
+        """
+        messages = messages_from_dict(item.get("messages", []))
+        for index, message in enumerate(messages):
+            await self._container.upsert_item(
+                body=self._message_item(index, message),
+                response_hook=cosmos_response_hook,
+            )
 
         item_body = {
-            "id": self.session_id,
-            "user_id": self.user_id,
-            "messages": messages_to_dict(self.messages),
+            key: value
+            for key, value in item.items()
+            if key != "messages" and not key.startswith("_")
         }
-        item_body["title"] = self.title or self._load_existing_title()
-        item_body["files"] = self._load_existing_files() + self.files
-        self._container.upsert_item(body=item_body)
+        self._remember_chat_item(
+            await self._container.upsert_item(
+                body=item_body, response_hook=cosmos_response_hook
+            )
+        )
+        logger.info(
+            f"Migrated chat {self.session_id} to segmented storage "
+            f"({len(messages)} messages)."
+        )
+
+    async def _next_message_index(self) -> int:
+        items = self._container.query_items(
+            query=(
+                "SELECT TOP 1 c.index FROM c "
+                "WHERE c.session_id = @session_id ORDER BY c.index DESC"
+            ),
+            parameters=[{"name": "@session_id", "value": self.session_id}],
+            partition_key=self.user_id,
+            response_hook=cosmos_response_hook,
+        )
+        return max([item["index"] async for item in items], default=-1) + 1
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Add messages to the store."""
+        start = len(self.messages)
+        self.messages.extend(messages)
+        with tracer.span("cosmos_write", **{"db.operation": "add_messages"}):
+            if not self.segmented:
+                await self.aupsert_messages()
+                return
+
+            index, conflicted = start, False
+            for message in messages:
+                for attempt in range(CONFLICT_MAX_ATTEMPTS):
+                    try:
+                        await self._container.create_item(
+                            body=self._message_item(index, message),
+                            response_hook=cosmos_response_hook,
+                        )
+                        break
+                    except CosmosResourceExistsError:
+                        # Another writer took this index; append after its tail
+                        if attempt == CONFLICT_MAX_ATTEMPTS - 1:
+                            raise
+                        conflicted = True
+                        index = await self._next_message_index()
+                index += 1
+            if conflicted:
+                self.messages = await self._load_message_items()
+            if not self._chat_item_exists:
+                await self.aupsert_messages()
+            else:
+                await self._touch_chat_item()
+
+    async def aadd_user_message(self, message: HumanMessage | str) -> None:
+        if isinstance(message, str):
+            message = HumanMessage(content=message)
+        await self.aadd_messages([message])
+
+    async def aadd_ai_message(self, message: AIMessage | str) -> None:
+        if isinstance(message, str):
+            message = AIMessage(content=message)
+        await self.aadd_messages([message])
 
-    def set_title(self, title: str) -> None:
+    def _run_sync(self, operation: Coroutine[Any, Any, T]) -> T:
+        """Runs an async operation to completion from synchronous code."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            operation.close()
+            raise RuntimeError(
+                "Sync chat history methods would block the event loop; "
+                "await their async counterparts instead."
+            )
+        if self._loop is not None and self._loop.is_running():
+            return asyncio.run_coroutine_threadsafe(operation, self._loop).result()
+        return asyncio.run(operation)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self._run_sync(self.aadd_messages([message]))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._run_sync(self.aadd_messages(messages))
+
+    async def aupsert_messages(self) -> None:
+        """
+        Writes the whole chat item from the cached state. Guarded by the cached
+        etag, or created only if missing; if another writer got there first,
+        the stored item is merged in (its files, and in document mode the turns
+        it added before ours) and the write is retried against its etag.
+        """
+        for attempt in range(CONFLICT_MAX_ATTEMPTS):
+            item_body = {
+                "id": self.session_id,
+                "user_id": self.user_id,
+                "title": self.title,
+                "files": self.files,
+                "summary": self.summary,
+                "summary_message_count": self.summary_message_count,
+                "updated_at": time.time(),
+            }
+            if not self.segmented:
+                item_body["messages"] = messages_to_dict(self.messages)
+            try:
+                if not self._chat_item_exists:
+                    item = await self._container.create_item(
+                        body=item_body, response_hook=cosmos_response_hook
+                    )
+                elif self._etag:
+                    item = await self._container.upsert_item(
+                        body=item_body,
+                        etag=self._etag,
+                        match_condition=MatchConditions.IfNotModified,
+                        response_hook=cosmos_response_hook,
+                    )
+                else:
+                    item = await self._container.upsert_item(
+                        body=item_body, response_hook=cosmos_response_hook
+                    )
+                break
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                if attempt == CONFLICT_MAX_ATTEMPTS - 1:
+                    raise
+                logger.info(f"Chat {self.session_id} changed concurrently, merging.")
+                self._merge_chat_item(await self._read_chat_item())
+        self._remember_chat_item(item)
+        if not self.segmented:
+            self._stored_message_count = len(self.messages)
+        self._listing_changed()
+
+    def _merge_chat_item(self, current: dict) -> None:
+        """Takes in what another writer stored, keeping this instance's changes."""
+        self._remember_chat_item(current)
+        self.title = self.title or current.get("title")
+        self.files = self._merge_files(current.get("files", []), self.files)
+        if current.get("summary_message_count", 0) > self.summary_message_count:
+            self.summary = current.get("summary")
+            self.summary_message_count = current["summary_message_count"]
+        if not self.segmented:
+            stored = messages_from_dict(current.get("messages", []))
+            self.messages = stored + self.messages[self._stored_message_count :]
+            self._stored_message_count = len(stored)
+
+    @staticmethod
+    def _merge_files(existing: List[str], new: List[str]) -> List[str]:
+        return list(dict.fromkeys(existing + new))
+
+    async def aclear(self) -> None:
+        """Clear session memory from this memory and cosmos."""
+        self.messages = []
+        self._stored_message_count = 0
+        if self.segmented:
+            message_items = self._container.query_items(
+                query="SELECT c.id FROM c WHERE c.session_id = @session_id",
+                parameters=[{"name": "@session_id", "value": self.session_id}],
+                partition_key=self.user_id,
+                response_hook=cosmos_response_hook,
+            )
+            async for item in message_items:
+                await self._container.delete_item(
+                    item=item["id"],
+                    partition_key=self.user_id,
+                    response_hook=cosmos_response_hook,
+                )
+        await self._container.delete_item(
+            item=self.session_id,
+            partition_key=self.user_id,
+            response_hook=cosmos_response_hook,
+        )
+        self._chat_item_exists = False
+        self._etag = None
+
+    def clear(self) -> None:
+        self._run_sync(self.aclear())
+
+    async def aset_title(self, title: str) -> None:
         self.title = title
-        self.upsert_messages()
+        if not self._chat_item_exists:
+            await self.aupsert_messages()
+            return
+        await self._patch_chat_item([{"op": "set", "path": "/title", "value": title}])
 
-    def set_files(self, files: List[str]) -> None:
+    async def aset_summary(self, summary: str, message_count: int) -> None:
+        """Stores the rolling summary covering the first `message_count` messages."""
+        self.summary = summary
+        self.summary_message_count = message_count
+        if not self._chat_item_exists:
+            await self.aupsert_messages()
+            return
+        await self._patch_chat_item(
+            [
+                {"op": "set", "path": "/summary", "value": summary},
+                {"op": "set", "path": "/summary_message_count", "value": message_count},
+            ]
+        )
+
+    async def aset_files(self, files: List[str]) -> None:
         self.files = files
-        self.upsert_messages()
+        if not self._chat_item_exists:
+            await self.aupsert_messages()
+            return
+        for attempt in range(CONFLICT_MAX_ATTEMPTS):
+            if attempt:
+                # Another writer changed the chat; merge its files and retry
+                current = await self._read_chat_item()
+                self._remember_chat_item(current)
+                self.files = self._merge_files(current.get("files", []), self.files)
+            try:
+                await self._patch_chat_item(
+                    [{"op": "set", "path": "/files", "value": self.files}],
+                    conditional=True,
+                )
+                return
+            except CosmosAccessConditionFailedError:
+                if attempt == CONFLICT_MAX_ATTEMPTS - 1:
+                    raise
+
+    async def aadd_files(self, filenames: List[str]) -> None:
+        """Adds filenames to the chat's file list, ignoring ones already present."""
+        await self.aset_files(self._merge_files(self.files, filenames))
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+from langchain_core.documents import Document
+
+from config import app_config
+from utils.metrics import increment_counter
+
+logger = logging.getLogger(__name__)
+
+# Metadata that belongs to the upload, not to the file's content
+UPLOAD_METADATA_KEYS = ("chat_id", "filename")
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class _SqliteStore:
+    """
+    Small key/value table in a local SQLite file with TTL expiry and LRU
+    eviction by entry count. Shared by the caches below. The file is opened
+    on first use, not when the app is imported.
+    """
+
+    def __init__(self, path: str, table: str, max_entries: int, ttl_seconds: int):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Opens the table on first use; called with the lock held."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "created_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_last_used "
+                f"ON {self.table} (last_used)"
+            )
+            conn.commit()
+            self._conn = conn
+            logger.info(f"Ingestion cache table '{self.table}' opened in {self.path}")
+        return self._conn
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        if not keys:
+            return {}
+        now = time.time()
+        found: Dict[str, bytes] = {}
+        with self._lock:
+            conn = self._connection()
+            for start in range(0, len(keys), 500):
+                part = keys[start : start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT key, value, created_at FROM {self.table} "
+                    f"WHERE key IN ({placeholders})",
+                    part,
+                ).fetchall()
+                for key, value, created_at in rows:
+                    if now - created_at <= self.ttl_seconds:
+                        found[key] = value
+            if found:
+                conn.executemany(
+                    f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                conn.commit()
+        return found
+
+    def put_many(self, entries: Dict[str, bytes]) -> None:
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            self._connection().executemany(
+                f"INSERT OR REPLACE INTO {self.table} "
+                "(key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in entries.items()],
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE created_at < ?",
+            (now - self.ttl_seconds,),
+        )
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY last_used ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+
+class EmbeddingCache:
+    """
+    Chunk embeddings keyed by (embeddings model, normalized text hash). The
+    model is the one every embeddings deployment is called with, so vectors
+    are shared across the deployments of the pool and never across models.
+    """
+
+    def __init__(self, store: _SqliteStore, model: str):
+        self.store = store
+        self.model = model
+
+    def key(self, text: str) -> str:
+        return sha256_hex(f"{self.model}\0{normalize_text(text)}".encode("utf-8"))
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, List[float]]:
+        """Returns cached vectors for the given texts, keyed by cache key."""
+        keys = list(dict.fromkeys(self.key(text) for text in texts))
+        found = self.store.get_many(keys)
+        increment_counter("embedding_cache_hits", len(found))
+        increment_counter("embedding_cache_misses", len(keys) - len(found))
+        return {key: array("f", value).tolist() for key, value in found.items()}
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]) -> None:
+        self.store.put_many(
+            {
+                self.key(text): array("f", vector).tobytes()
+                for text, vector in zip(texts, vectors)
+            }
+        )
+
+
+class FileChunkCache:
+    """Parsed chunks of an uploaded file, keyed by the file's content hash."""
+
+    def __init__(self, store: _SqliteStore):
+        self.store = store
+
+    def get(self, fingerprint: str) -> Optional[List[Document]]:
+        found = self.store.get_many([fingerprint])
+        if fingerprint not in found:
+            increment_counter("file_cache_misses")
+            return None
+        increment_counter("file_cache_hits")
+        return [
+            Document(page_content=chunk["text"], metadata=chunk["metadata"])
+            for chunk in json.loads(found[fingerprint])
+        ]
+
+    @staticmethod
+    def to_chunks(documents: List[Document]) -> List[dict]:
+        """The cached form of documents, without the metadata of the upload."""
+        return [
+            {
+                "text": document.page_content,
+                "metadata": {
+                    key: value
+                    for key, value in document.metadata.items()
+                    if key not in UPLOAD_METADATA_KEYS
+                },
+            }
+            for document in documents
+        ]
+
+    def put(self, fingerprint: str, documents: List[Document]) -> None:
+        self.put_chunks(fingerprint, self.to_chunks(documents))
+
+    def put_chunks(self, fingerprint: str, chunks: List[dict]) -> None:
+        self.store.put_many({fingerprint: json.dumps(chunks).encode("utf-8")})
+
+
+def create_caches(
+    path: str,
+    model: str,
+    embedding_max_entries: int,
+    file_max_entries: int,
+    ttl_seconds: int,
+) -> tuple[EmbeddingCache, FileChunkCache]:
+    embedding_store = _SqliteStore(
+        path, "embeddings", embedding_max_entries, ttl_seconds
+    )
+    file_store = _SqliteStore(path, "file_chunks", file_max_entries, ttl_seconds)
+    return EmbeddingCache(embedding_store, model), FileChunkCache(file_store)
+
+
+if app_config.INGESTION_CACHE_ENABLED:
+    embedding_cache, file_chunk_cache = create_caches(
+        path=app_config.INGESTION_CACHE_PATH,
+        model=app_config.OPENAI_EMBEDDINGS_MODEL_NAME,
+        embedding_max_entries=app_config.EMBEDDING_CACHE_MAX_ENTRIES,
+        file_max_entries=app_config.FILE_CACHE_MAX_ENTRIES,
+        ttl_seconds=app_config.INGESTION_CACHE_TTL_SECONDS,
+    )
+else:
+    embedding_cache, file_chunk_cache = None, None
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import random
+import uuid
+from typing import Awaitable, Callable, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from core.embedding_cache import EmbeddingCache
+from utils.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingPipeline:
+    """
+    Embeds documents in token-bounded batches with a bounded number of requests
+    in flight, retrying throttled batches with exponential backoff. Each batch
+    is handed to `writer` as soon as its vectors arrive, so storage overlaps
+    with the remaining embedding calls. Chunks found in the optional
+    `cache` are written without calling the embeddings API.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        writer: Callable[[List[dict]], Awaitable[None]],
+        max_batch_tokens: int,
+        max_batch_inputs: int,
+        max_concurrency: int,
+        max_retries: int,
+        cache: Optional[EmbeddingCache] = None,
+    ):
+        self.embeddings = embeddings
+        self.writer = writer
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_inputs = max_batch_inputs
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.cache = cache
+
+    def make_batches(self, documents: List[Document]) -> List[List[Document]]:
+        """Groups documents so no batch exceeds the token or input limits."""
+        batches: List[List[Document]] = []
+        batch: List[Document] = []
+        batch_tokens = 0
+        for document in documents:
+            tokens = estimate_tokens(document.page_content)
+            if batch and (
+                batch_tokens + tokens > self.max_batch_tokens
+                or len(batch) >= self.max_batch_inputs
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(document)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        try:
+            return float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    async def _embed_with_retry(self, texts: List[str]) -> List[List[float]]:
+        # Imported here, like the clients, to keep the SDK out of cold start
+        from openai import APIStatusError, RateLimitError
+
+        attempt = 0
+        while True:
+            try:
+                return await self.embeddings.aembed_documents(
+                    texts, chunk_size=len(texts)
+                )
+            except (RateLimitError, APIStatusError) as e:
+                retryable = isinstance(e, RateLimitError) or e.status_code >= 500
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_after(e) or min(2**attempt, 30) + random.random()
+                attempt += 1
+                logger.warning(
+                    f"Embedding batch of {len(texts)} throttled ({e.status_code}), "
+                    f"retry {attempt}/{self.max_retries} in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def to_items(documents: List[Document], vectors: List[List[float]]) -> List[dict]:
+        """
+        Builds vector store items in AzureCosmosDBNoSqlVectorSearch's schema.
+        Documents with an `id` keep it, so writing them again replaces them.
+        """
+        return [
+            {
+                "id": document.id or str(uuid.uuid4()),
+                "text": document.page_content,
+                "embedding": vector,
+                "metadata": document.metadata,
+            }
+            for document, vector in zip(documents, vectors)
+        ]
+
+    async def run(
+        self,
+        documents: List[Document],
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> List[str]:
+        """
+        Embeds and writes all documents, returns the ids of the stored items.
+        `progress` is called with (newly embedded, newly indexed) chunk counts.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        report = progress or (lambda embedded, indexed: None)
+
+        async def write(batch: List[Document], vectors: List[List[float]]):
+            items = self.to_items(batch, vectors)
+            await self.writer(items)
+            report(0, len(items))
+            return [item["id"] for item in items]
+
+        async def process(batch: List[Document]) -> List[str]:
+            texts = [document.page_content for document in batch]
+            async with semaphore:
+                vectors = await self._embed_with_retry(texts)
+            report(len(batch), 0)
+            if self.cache:
+                await asyncio.to_thread(self.cache.put_many, texts, vectors)
+            return await write(batch, vectors)
+
+        to_embed = documents
+        jobs = []
+        if self.cache:
+            cached = await asyncio.to_thread(
+                self.cache.get_many, [document.page_content for document in documents]
+            )
+            hits = [d for d in documents if self.cache.key(d.page_content) in cached]
+            to_embed = [
+                d for d in documents if self.cache.key(d.page_content) not in cached
+            ]
+            if hits:
+                report(len(hits), 0)
+                jobs.append(
+                    write(hits, [cached[self.cache.key(d.page_content)] for d in hits])
+                )
+
+        batches = self.make_batches(to_embed)
+        jobs.extend(process(batch) for batch in batches)
+        results = await asyncio.gather(*jobs)
+        logger.info(
+            f"Embedded {len(to_embed)} chunks in {len(batches)} batches "
+            f"(max {self.max_concurrency} in flight), "
+            f"{len(documents) - len(to_embed)} served from cache."
+        )
+        return [doc_id for ids in results for doc_id in ids]
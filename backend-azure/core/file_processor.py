@@ -1,6 +1,6 @@
-from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
-    AzureCosmosDBNoSqlVectorSearch,
-)
+import io
+import os
+
 from langchain_unstructured import UnstructuredLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
@@ -20,3 +20,34 @@ def file_processor(path: str) -> list[Document]:
     docs = text_splitter.split_documents(data)
 
     return docs
+
+
+def file_processor_pages(path: str, first_page: int, last_page: int) -> list[Document]:
+    """
+    Parses and splits only pages [first_page, last_page) of a PDF, so a large
+    file can be processed one window of pages at a time.
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(path)
+    writer = PdfWriter()
+    for page in reader.pages[first_page:last_page]:
+        writer.add_page(page)
+    window = io.BytesIO()
+    writer.write(window)
+    window.seek(0)
+
+    loader = UnstructuredLoader(
+        file=window,
+        metadata_filename=os.path.basename(path),
+        chunking_strategy="basic",
+        max_characters=1000000,
+        include_orig_elements=False,
+    )
+    data = loader.load()
+    for doc in data:
+        if "page_number" in doc.metadata:
+            doc.metadata["page_number"] += first_page
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
+    return text_splitter.split_documents(data)
@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import tempfile
+from typing import TYPE_CHECKING, Optional
+
+from config import app_config
+
+if TYPE_CHECKING:
+    from azure.storage.blob.aio import ContainerClient
+    from azure.storage.queue.aio import QueueClient
+
+logger = logging.getLogger(__name__)
+
+
+class StorageJobQueue:
+    """
+    Hands ingestion jobs to whichever instance the Functions host triggers:
+    the staged upload is copied to a blob named after the job, and a message
+    with the job id goes to an Azure Storage queue that ingest_upload listens
+    on. A message that is not completed is delivered again, so a job whose
+    instance went away is picked up by another one.
+
+    Clients are created on first use; the storage SDKs are only needed with
+    the "storage" backend.
+    """
+
+    def __init__(self, connection_setting: str, queue_name: str, container_name: str):
+        self.connection_setting = connection_setting
+        self.queue_name = queue_name
+        self.container_name = container_name
+        self._container: Optional["ContainerClient"] = None
+        self._queue: Optional["QueueClient"] = None
+
+    def _connection_string(self) -> str:
+        return os.environ[self.connection_setting]
+
+    async def _get_container(self) -> "ContainerClient":
+        if self._container is None:
+            from azure.core.exceptions import ResourceExistsError
+            from azure.storage.blob.aio import ContainerClient
+
+            container = ContainerClient.from_connection_string(
+                self._connection_string(), self.container_name
+            )
+            try:
+                await container.create_container()
+            except ResourceExistsError:
+                pass
+            self._container = container
+        return self._container
+
+    async def _get_queue(self) -> "QueueClient":
+        if self._queue is None:
+            from azure.core.exceptions import ResourceExistsError
+            from azure.storage.queue import TextBase64EncodePolicy
+            from azure.storage.queue.aio import QueueClient
+
+            # The queue trigger expects base64 encoded messages
+            queue = QueueClient.from_connection_string(
+                self._connection_string(),
+                self.queue_name,
+                message_encode_policy=TextBase64EncodePolicy(),
+            )
+            try:
+                await queue.create_queue()
+            except ResourceExistsError:
+                pass
+            self._queue = queue
+        return self._queue
+
+    async def stage(self, job_id: str, file_path: str) -> None:
+        """Copies the staged upload to the job's blob."""
+        container = await self._get_container()
+        with open(file_path, "rb") as file:
+            await container.upload_blob(job_id, file, overwrite=True)
+        logger.info(f"Staged upload of job {job_id} in '{self.container_name}'.")
+
+    async def send(self, job_id: str) -> None:
+        queue = await self._get_queue()
+        await queue.send_message(json.dumps({"job_id": job_id}))
+
+    async def fetch(self, job_id: str, suffix: str) -> str:
+        """Downloads the job's blob to a temporary file and returns its path."""
+        container = await self._get_container()
+        downloader = await container.download_blob(job_id)
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as file:
+            async for chunk in downloader.chunks():
+                file.write(chunk)
+        return file.name
+
+    async def discard(self, job_id: str) -> None:
+        from azure.core.exceptions import ResourceNotFoundError
+
+        container = await self._get_container()
+        try:
+            await container.delete_blob(job_id)
+        except ResourceNotFoundError:
+            pass
+
+    @staticmethod
+    def job_id_of(message_body: bytes) -> str:
+        return json.loads(message_body.decode("utf-8"))["job_id"]
+
+
+storage_job_queue = StorageJobQueue(
+    connection_setting=app_config.INGESTION_STORAGE_CONNECTION,
+    queue_name=app_config.INGESTION_QUEUE_NAME,
+    container_name=app_config.INGESTION_BLOB_CONTAINER,
+)
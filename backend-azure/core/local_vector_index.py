@@ -0,0 +1,261 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from config import app_config
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class ChatVectorIndex:
+    """
+    The chunks of one chat: a contiguous float32 matrix of unit-length
+    embeddings, one row per chunk, plus the chunks' ids, texts and metadata.
+    Rows are appended into spare capacity, so adding a few chunks does not
+    copy the whole matrix each time. Adding a chunk whose id is already held
+    replaces it.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self._rows: Dict[str, int] = {}
+        self._matrix = np.empty((0, dimensions), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[: len(self.ids)]
+
+    @property
+    def nbytes(self) -> int:
+        text_bytes = sum(len(text) for text in self.texts)
+        return self._matrix.nbytes + text_bytes
+
+    def add(
+        self,
+        ids: Sequence[str],
+        texts: Sequence[str],
+        metadata: Sequence[Dict[str, Any]],
+        vectors: Sequence[Sequence[float]],
+    ) -> None:
+        rows = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        new = [i for i, doc_id in enumerate(ids) if doc_id not in self._rows]
+        size, needed = len(self.ids), len(self.ids) + len(new)
+        if needed > self._matrix.shape[0] or not self._matrix.flags.writeable:
+            grown = np.empty(
+                (max(needed, 2 * self._matrix.shape[0]), self.dimensions),
+                dtype=np.float32,
+            )
+            grown[:size] = self._matrix[:size]
+            self._matrix = grown
+        for i, doc_id in enumerate(ids):
+            row = self._rows.get(doc_id)
+            if row is not None:
+                self._matrix[row] = rows[i]
+                self.texts[row], self.metadata[row] = texts[i], metadata[i]
+        self._matrix[size:needed] = rows[new]
+        for row, i in enumerate(new, start=size):
+            self._rows[ids[i]] = row
+            self.ids.append(ids[i])
+            self.texts.append(texts[i])
+            self.metadata.append(metadata[i])
+
+    def search(
+        self, embedding: Sequence[float], k: int
+    ) -> List[Tuple[Document, float]]:
+        """Top `k` chunks by cosine similarity, best first."""
+        size = len(self.ids)
+        if size == 0 or k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self.matrix @ query
+        k = min(k, size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                Document(
+                    page_content=self.texts[i],
+                    metadata={**self.metadata[i], "id": self.ids[i]},
+                ),
+                float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def save(self, path: str) -> None:
+        """Writes `<path>.npy` (the matrix) and `<path>.json` (everything else)."""
+        np.save(f"{path}.npy", self.matrix)
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {"ids": self.ids, "texts": self.texts, "metadata": self.metadata}, f
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "ChatVectorIndex":
+        """Opens a saved index with the matrix memory-mapped read-only."""
+        matrix = np.load(f"{path}.npy", mmap_mode="r")
+        with open(f"{path}.json", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(matrix.shape[1])
+        index._matrix = matrix
+        index.ids, index.texts, index.metadata = (
+            data["ids"],
+            data["texts"],
+            data["metadata"],
+        )
+        index._rows = {doc_id: row for row, doc_id in enumerate(index.ids)}
+        return index
+
+
+class LocalVectorIndex:
+    """
+    Per-chat in-memory vector indexes with LRU eviction by memory budget.
+
+    With `persist_dir`, changes are written to disk on `flush` (or when an
+    unsaved chat is evicted) and evicted chats are reopened memory-mapped on
+    their next use, so the local index can serve as the vector store on its
+    own. Without it, chats are only held for `ttl_seconds`, which suits a
+    read-through cache in front of Cosmos DB. A chat can be stored with a
+    `version`; a lookup with a different version is a miss.
+    """
+
+    def __init__(
+        self,
+        memory_budget_bytes: int,
+        persist_dir: Optional[str] = None,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.persist_dir = persist_dir
+        self.ttl_seconds = ttl_seconds
+        self._chats: "OrderedDict[str, Tuple[float, Any, ChatVectorIndex]]" = (
+            OrderedDict()
+        )
+        self._unsaved: Set[str] = set()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    def _path(self, chat_id: str) -> Optional[str]:
+        if not self.persist_dir:
+            return None
+        name = hashlib.sha256(str(chat_id).encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.persist_dir, name)
+
+    def _evict(self) -> None:
+        total = sum(index.nbytes for _, _, index in self._chats.values())
+        while total > self.memory_budget_bytes and len(self._chats) > 1:
+            chat_id, (_, _, index) = self._chats.popitem(last=False)
+            total -= index.nbytes
+            if chat_id in self._unsaved:
+                self._unsaved.discard(chat_id)
+                self._save(chat_id, index)
+            logger.debug(f"Evicted local vector index of chat {chat_id}")
+
+    def get(self, chat_id: str, version: Any = None) -> Optional[ChatVectorIndex]:
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            loaded_at, stored_version, index = entry
+            age = time.monotonic() - loaded_at
+            fresh = self.ttl_seconds is None or age <= self.ttl_seconds
+            if fresh and (version is None or version == stored_version):
+                self._chats.move_to_end(chat_id)
+                return index
+            del self._chats[chat_id]
+            return None
+
+        path = self._path(chat_id)
+        if path and os.path.exists(f"{path}.npy"):
+            index = ChatVectorIndex.load(path)
+            self.put(chat_id, index)
+            return index
+        return None
+
+    def put(self, chat_id: str, index: ChatVectorIndex, version: Any = None) -> None:
+        self._chats[chat_id] = (time.monotonic(), version, index)
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def add(
+        self,
+        chat_id: str,
+        ids: Sequence[str],
+        texts: Sequence[str],
+        metadata: Sequence[Dict[str, Any]],
+        vectors: Sequence[Sequence[float]],
+    ) -> None:
+        """Appends chunks to a chat; they reach disk on the next `flush`."""
+        if not ids:
+            return
+        index = self.get(chat_id) or ChatVectorIndex(len(vectors[0]))
+        index.add(ids, texts, metadata, vectors)
+        self._unsaved.add(chat_id)
+        self.put(chat_id, index)
+
+    def flush(self, chat_id: str) -> None:
+        """Writes a chat's unsaved chunks to disk, e.g. once an upload is done."""
+        if chat_id not in self._unsaved:
+            return
+        self._unsaved.discard(chat_id)
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            self._save(chat_id, entry[2])
+
+    def remove_chat(self, chat_id: str) -> int:
+        """Forgets a chat, on disk too. Returns how many chunks it had."""
+        index = self.get(chat_id)
+        self._chats.pop(chat_id, None)
+        self._unsaved.discard(chat_id)
+        path = self._path(chat_id)
+        if path:
+            for suffix in (".npy", ".json"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        return len(index) if index else 0
+
+    def _save(self, chat_id: str, index: ChatVectorIndex) -> None:
+        path = self._path(chat_id)
+        if path:
+            index.save(path)
+
+    def search(
+        self, chat_id: str, embedding: Sequence[float], k: int, version: Any = None
+    ) -> Optional[List[Tuple[Document, float]]]:
+        """Searches a chat's index; None if the chat is not held locally."""
+        index = self.get(chat_id, version)
+        if index is None:
+            return None
+        return index.search(embedding, k)
+
+
+if app_config.VECTOR_BACKEND == "local":
+    local_vector_index = LocalVectorIndex(
+        memory_budget_bytes=app_config.LOCAL_VECTOR_MEMORY_BUDGET_MB * 1024 * 1024,
+        persist_dir=app_config.LOCAL_VECTOR_INDEX_DIR,
+    )
+elif app_config.VECTOR_BACKEND == "cached":
+    local_vector_index = LocalVectorIndex(
+        memory_budget_bytes=app_config.LOCAL_VECTOR_MEMORY_BUDGET_MB * 1024 * 1024,
+        ttl_seconds=app_config.VECTOR_CACHE_TTL_SECONDS,
+    )
+else:
+    local_vector_index = None
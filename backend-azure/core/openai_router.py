@@ -0,0 +1,498 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Mapping,
+    Optional,
+    TypeVar,
+)
+
+import httpx
+from langchain_core.embeddings import Embeddings
+
+from config import app_config
+from utils.metrics import increment_counter
+from utils.tokens import estimate_tokens
+from utils.tracing import CORRELATION_ID_HEADER, correlation_id, current_span
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+DEPLOYMENT_KIND_CHAT = "chat"
+DEPLOYMENT_KIND_EMBEDDINGS = "embeddings"
+# Azure OpenAI quotas are per minute, spent quota comes back over this window
+QUOTA_WINDOW_SECONDS = 60.0
+# The SDK's own retry count, kept when a kind has a single deployment to fail
+# over to
+SDK_MAX_RETRIES = 2
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+@dataclass
+class Deployment:
+    name: str
+    kind: str
+    endpoint: str
+    deployment: str
+    api_version: str
+    api_key: Optional[str] = None
+    # Configured quota, assumed until response headers report what is left
+    tokens_per_minute: Optional[int] = None
+    requests_per_minute: Optional[int] = None
+
+
+@dataclass
+class DeploymentState:
+    remaining_tokens: Optional[float] = None
+    remaining_requests: Optional[float] = None
+    observed_at: float = 0.0
+    in_flight: int = 0
+    reserved_tokens: float = 0.0
+    consecutive_failures: int = 0
+    open_until: float = 0.0
+    trial_in_flight: bool = False
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether another deployment may succeed where this one failed."""
+    # The SDK takes a second to import; it is loaded with the first client
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIConnectionError):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500
+    return False
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    retry_after_ms = _header_float(response.headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    return _header_float(response.headers, "retry-after")
+
+
+class OpenAIRouter:
+    """
+    Spreads Azure OpenAI calls over a pool of deployments.
+
+    Each call goes to the healthy deployment of the requested kind with the
+    most quota left: the remaining tokens and requests reported in the
+    x-ratelimit-* headers of its last response, refilled over the quota
+    window, minus what calls in flight are expected to use. Throttled (429),
+    failing (5xx) and unreachable deployments are skipped for the rest of the
+    call, and a circuit breaker keeps them out of rotation: for Retry-After
+    after a 429, for `cooldown_seconds` after `failure_threshold` consecutive
+    failures. A single trial call then closes or reopens the circuit.
+
+    Calls are functions of a `Deployment`, so the router works with any client;
+    `client_kwargs` configures LangChain's Azure clients for a deployment.
+    """
+
+    def __init__(
+        self,
+        deployments: List[Deployment],
+        failure_threshold: int,
+        cooldown_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.deployments = deployments
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.clock = clock
+        self._state: Dict[str, DeploymentState] = {
+            deployment.name: DeploymentState() for deployment in deployments
+        }
+        # Sync embeddings run on worker threads
+        self._lock = threading.Lock()
+
+    def deployments_of(self, kind: str) -> List[Deployment]:
+        return [
+            deployment for deployment in self.deployments if deployment.kind == kind
+        ]
+
+    def state(self, name: str) -> DeploymentState:
+        return self._state[name]
+
+    def record_headers(self, name: str, headers: Mapping[str, str]) -> None:
+        """Updates a deployment's remaining quota from response headers."""
+        tokens = _header_float(headers, "x-ratelimit-remaining-tokens")
+        requests = _header_float(headers, "x-ratelimit-remaining-requests")
+        if tokens is None and requests is None:
+            return
+        with self._lock:
+            state = self._state[name]
+            state.remaining_tokens = tokens
+            state.remaining_requests = requests
+            state.observed_at = self.clock()
+
+    @staticmethod
+    def _refilled(
+        remaining: Optional[float], capacity: Optional[int], elapsed: float
+    ) -> float:
+        if remaining is None:
+            return math.inf if capacity is None else float(capacity)
+        if capacity is None:
+            return remaining if elapsed < QUOTA_WINDOW_SECONDS else math.inf
+        return min(capacity, remaining + capacity * elapsed / QUOTA_WINDOW_SECONDS)
+
+    def headroom(self, deployment: Deployment) -> float:
+        """Tokens the deployment is expected to accept right now."""
+        state = self._state[deployment.name]
+        elapsed = self.clock() - state.observed_at
+        requests = self._refilled(
+            state.remaining_requests, deployment.requests_per_minute, elapsed
+        )
+        if requests - state.in_flight <= 0:
+            return 0.0
+        tokens = self._refilled(
+            state.remaining_tokens, deployment.tokens_per_minute, elapsed
+        )
+        return tokens - state.reserved_tokens
+
+    def candidates(self, kind: str) -> List[Deployment]:
+        """Deployments of `kind` to try, in order of preference."""
+        now = self.clock()
+        pool = self.deployments_of(kind)
+        if not pool:
+            raise ValueError(f"No Azure OpenAI deployments of kind {kind}")
+        with self._lock:
+            available = [
+                deployment
+                for deployment in pool
+                if self._state[deployment.name].open_until <= now
+                and not self._state[deployment.name].trial_in_flight
+            ]
+            available.sort(
+                key=lambda d: (-self.headroom(d), self._state[d.name].in_flight)
+            )
+            if available:
+                return available
+            # Every circuit is open: rather than refusing, try the deployment
+            # that is due back first
+            return sorted(pool, key=lambda d: self._state[d.name].open_until)[:1]
+
+    def _acquire(self, deployment: Deployment, estimated_tokens: int) -> None:
+        with self._lock:
+            state = self._state[deployment.name]
+            state.in_flight += 1
+            state.reserved_tokens += estimated_tokens
+            if state.consecutive_failures >= self.failure_threshold:
+                state.trial_in_flight = True
+
+    def _release(
+        self,
+        deployment: Deployment,
+        estimated_tokens: int,
+        error: Optional[BaseException],
+    ) -> None:
+        with self._lock:
+            state = self._state[deployment.name]
+            state.in_flight -= 1
+            state.reserved_tokens -= estimated_tokens
+            state.trial_in_flight = False
+            if error is None or not is_retryable(error):
+                state.consecutive_failures = 0
+                state.open_until = 0.0
+                return
+
+            state.consecutive_failures += 1
+            retry_after = retry_after_seconds(error)
+            if getattr(error, "status_code", None) == 429:
+                state.remaining_tokens = 0.0
+                state.observed_at = self.clock()
+                cooldown = retry_after or self.cooldown_seconds
+            elif state.consecutive_failures >= self.failure_threshold:
+                cooldown = self.cooldown_seconds
+            else:
+                cooldown = 0.0
+            if cooldown:
+                state.open_until = self.clock() + cooldown
+                increment_counter("openai_circuit_opened")
+        logger.warning(
+            f"Azure OpenAI deployment {deployment.name} failed ({error}), "
+            + (f"out of rotation for {cooldown:.0f}s" if cooldown else "failing over")
+        )
+
+    async def call(
+        self,
+        kind: str,
+        request: Callable[[Deployment], Awaitable[T]],
+        estimated_tokens: int = 0,
+    ) -> T:
+        """Runs `request` on the best deployment, failing over on retryable errors."""
+        last_error: Optional[BaseException] = None
+        for deployment in self.candidates(kind):
+            if last_error is not None:
+                increment_counter("openai_failovers")
+            self._acquire(deployment, estimated_tokens)
+            try:
+                result = await request(deployment)
+            except Exception as e:
+                self._release(deployment, estimated_tokens, e)
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                continue
+            self._release(deployment, estimated_tokens, None)
+            return result
+        raise last_error
+
+    def call_sync(
+        self,
+        kind: str,
+        request: Callable[[Deployment], T],
+        estimated_tokens: int = 0,
+    ) -> T:
+        """`call` for blocking clients."""
+        last_error: Optional[BaseException] = None
+        for deployment in self.candidates(kind):
+            if last_error is not None:
+                increment_counter("openai_failovers")
+            self._acquire(deployment, estimated_tokens)
+            try:
+                result = request(deployment)
+            except Exception as e:
+                self._release(deployment, estimated_tokens, e)
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                continue
+            self._release(deployment, estimated_tokens, None)
+            return result
+        raise last_error
+
+    async def stream(
+        self,
+        kind: str,
+        request: Callable[[Deployment], AsyncIterator[T]],
+        estimated_tokens: int = 0,
+    ) -> AsyncIterator[T]:
+        """
+        Streams from the best deployment. Fails over only until the first chunk
+        arrives; errors after that are raised to the caller.
+        """
+        last_error: Optional[BaseException] = None
+        for deployment in self.candidates(kind):
+            if last_error is not None:
+                increment_counter("openai_failovers")
+            self._acquire(deployment, estimated_tokens)
+            started = False
+            error: Optional[BaseException] = None
+            try:
+                async for item in request(deployment):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                error = e
+                if started or not is_retryable(e):
+                    raise
+                last_error = e
+            finally:
+                self._release(deployment, estimated_tokens, error)
+        raise last_error
+
+    def _hook(self, deployment: Deployment) -> Callable[[httpx.Response], None]:
+        def hook(response: httpx.Response) -> None:
+            self.record_headers(deployment.name, response.headers)
+
+        return hook
+
+    @staticmethod
+    def _propagate(request: httpx.Request) -> None:
+        """Sends the request's correlation id and W3C trace context upstream."""
+        if correlation_id():
+            request.headers[CORRELATION_ID_HEADER] = correlation_id()
+        span = current_span()
+        if span is not None:
+            request.headers["traceparent"] = f"00-{span.trace_id}-{span.span_id}-01"
+
+    def client_kwargs(self, deployment: Deployment) -> Dict[str, Any]:
+        """
+        Arguments for AzureChatOpenAI / AzureOpenAIEmbeddings that target
+        `deployment` and report its rate limit headers to the router.
+        """
+        hook = self._hook(deployment)
+
+        async def async_hook(response: httpx.Response) -> None:
+            hook(response)
+
+        async def async_propagate(request: httpx.Request) -> None:
+            self._propagate(request)
+
+        kwargs: Dict[str, Any] = {
+            "azure_endpoint": deployment.endpoint,
+            "azure_deployment": deployment.deployment,
+            "openai_api_version": deployment.api_version,
+            "max_retries": (
+                SDK_MAX_RETRIES if len(self.deployments_of(deployment.kind)) == 1 else 0
+            ),
+            "http_client": httpx.Client(
+                event_hooks={"request": [self._propagate], "response": [hook]}
+            ),
+            "http_async_client": httpx.AsyncClient(
+                event_hooks={"request": [async_propagate], "response": [async_hook]}
+            ),
+        }
+        if deployment.api_key:
+            kwargs["api_key"] = deployment.api_key
+        return kwargs
+
+
+class DeploymentClients(Generic[T]):
+    """
+    One client per deployment of a kind, made by `factory` on first use, so
+    importing the app neither imports the OpenAI SDK nor builds clients.
+    """
+
+    def __init__(
+        self, router: OpenAIRouter, kind: str, factory: Callable[[Deployment], T]
+    ):
+        self.router = router
+        self.kind = kind
+        self.factory = factory
+        self._clients: Dict[str, T] = {}
+        # Requests and the startup warm-up may ask for a client at the same time
+        self._lock = threading.Lock()
+
+    def get(self, deployment: Deployment) -> T:
+        client = self._clients.get(deployment.name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(deployment.name)
+                if client is None:
+                    client = self.factory(deployment)
+                    self._clients[deployment.name] = client
+        return client
+
+    def warm(self) -> None:
+        """Creates the clients of all deployments of the kind."""
+        for deployment in self.router.deployments_of(self.kind):
+            self.get(deployment)
+
+
+class RoutedEmbeddings(Embeddings):
+    """Embeddings that go through the router, one client per deployment."""
+
+    def __init__(self, router: OpenAIRouter, clients: DeploymentClients[Embeddings]):
+        self.router = router
+        self.clients = clients
+
+    def embed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        return self.router.call_sync(
+            DEPLOYMENT_KIND_EMBEDDINGS,
+            lambda d: self.clients.get(d).embed_documents(texts, chunk_size=chunk_size),
+            estimated_tokens=sum(estimate_tokens(text) for text in texts),
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.router.call_sync(
+            DEPLOYMENT_KIND_EMBEDDINGS,
+            lambda d: self.clients.get(d).embed_query(text),
+            estimated_tokens=estimate_tokens(text),
+        )
+
+    async def aembed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = None
+    ) -> List[List[float]]:
+        return await self.router.call(
+            DEPLOYMENT_KIND_EMBEDDINGS,
+            lambda d: self.clients.get(d).aembed_documents(
+                texts, chunk_size=chunk_size
+            ),
+            estimated_tokens=sum(estimate_tokens(text) for text in texts),
+        )
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.router.call(
+            DEPLOYMENT_KIND_EMBEDDINGS,
+            lambda d: self.clients.get(d).aembed_query(text),
+            estimated_tokens=estimate_tokens(text),
+        )
+
+
+def load_deployments() -> List[Deployment]:
+    """
+    Deployments from AZURE_OPENAI_DEPLOYMENTS, or the single chat and
+    embeddings deployment of the other AZURE_OPENAI_* / OPENAI_EMBEDDINGS_*
+    settings when it is not set.
+    """
+    if not app_config.AZURE_OPENAI_DEPLOYMENTS:
+        return [
+            Deployment(
+                name="default",
+                kind=DEPLOYMENT_KIND_CHAT,
+                endpoint=app_config.AZURE_OPENAI_ENDPOINT,
+                deployment=app_config.AZURE_OPENAI_DEPLOYMENT_NAME,
+                api_version=app_config.AZURE_OPENAI_API_VERSION,
+            ),
+            Deployment(
+                name="default-embeddings",
+                kind=DEPLOYMENT_KIND_EMBEDDINGS,
+                endpoint=app_config.AZURE_OPENAI_ENDPOINT,
+                deployment=app_config.OPENAI_EMBEDDINGS_MODEL_DEPLOYMENT,
+                api_version=app_config.OPENAI_EMBEDDINGS_API_VERSION,
+            ),
+        ]
+
+    deployments = []
+    for entry in json.loads(app_config.AZURE_OPENAI_DEPLOYMENTS):
+        kind = entry.get("kind", DEPLOYMENT_KIND_CHAT)
+        if kind not in (DEPLOYMENT_KIND_CHAT, DEPLOYMENT_KIND_EMBEDDINGS):
+            raise ValueError(f"Unknown Azure OpenAI deployment kind: {kind}")
+        deployments.append(
+            Deployment(
+                name=entry["name"],
+                kind=kind,
+                endpoint=entry["endpoint"],
+                deployment=entry["deployment"],
+                api_version=entry.get(
+                    "api_version",
+                    (
+                        app_config.OPENAI_EMBEDDINGS_API_VERSION
+                        if kind == DEPLOYMENT_KIND_EMBEDDINGS
+                        else app_config.AZURE_OPENAI_API_VERSION
+                    ),
+                ),
+                api_key=(
+                    os.environ.get(entry["api_key_env"])
+                    if entry.get("api_key_env")
+                    else None
+                ),
+                tokens_per_minute=entry.get("tpm"),
+                requests_per_minute=entry.get("rpm"),
+            )
+        )
+    return deployments
+
+
+openai_router = OpenAIRouter(
+    load_deployments(),
+    failure_threshold=app_config.OPENAI_CIRCUIT_FAILURE_THRESHOLD,
+    cooldown_seconds=app_config.OPENAI_CIRCUIT_COOLDOWN_SECONDS,
+)
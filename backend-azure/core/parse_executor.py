@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from langchain_core.documents import Document
+
+from config import app_config
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentLimitError(ValueError):
+    """Raised when a document is over the configured size or page limits."""
+
+
+def _count_pdf_pages(file_path: str) -> Optional[int]:
+    if not file_path.lower().endswith(".pdf"):
+        return None
+    from pypdf import PdfReader
+
+    return len(PdfReader(file_path).pages)
+
+
+def _parse_in_worker(file_path: str, max_pages: int) -> List[Document]:
+    """Runs in a pool process: enforces the page limit, then parses and splits."""
+    pages = _count_pdf_pages(file_path)
+    if pages is not None and pages > max_pages:
+        raise DocumentLimitError(
+            f"Document has {pages} pages, the limit is {max_pages}."
+        )
+
+    from core.file_processor import file_processor
+
+    return file_processor(file_path)
+
+
+def _parse_pages_in_worker(
+    file_path: str, first_page: int, last_page: int
+) -> List[Document]:
+    from core.file_processor import file_processor_pages
+
+    return file_processor_pages(file_path, first_page, last_page)
+
+
+class ParseExecutor:
+    """
+    Parses uploaded documents in a pool of worker processes so the CPU-heavy
+    unstructured partitioning never runs on the event loop.
+
+    A job that exceeds `timeout_seconds` is abandoned and its pool retired:
+    new jobs go to a fresh pool, the other jobs on the retired pool run to
+    completion, and its processes are stopped once only abandoned jobs are
+    left on it.
+    """
+
+    def __init__(
+        self, max_workers: int, timeout_seconds: int, max_bytes: int, max_pages: int
+    ):
+        self.max_workers = max_workers
+        self.timeout_seconds = timeout_seconds
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Jobs submitted to each pool that have not finished, and those of them
+        # that timed out
+        self._jobs: Dict[ProcessPoolExecutor, Set[Future]] = {}
+        self._abandoned: Set[Future] = set()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that holds event loop and client threads
+            # is not safe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def _retire_pool(self, pool: ProcessPoolExecutor) -> None:
+        if self._pool is pool:
+            self._pool = None
+        self._stop_if_idle(pool)
+
+    def _stop_if_idle(self, pool: ProcessPoolExecutor) -> None:
+        """Stops a retired pool's processes once no job it runs is still wanted."""
+        if pool is self._pool or pool not in self._jobs:
+            return
+        if not self._jobs[pool] <= self._abandoned:
+            return
+        for job in self._jobs.pop(pool):
+            self._abandoned.discard(job)
+        processes = list((getattr(pool, "_processes", None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _job_done(self, pool: ProcessPoolExecutor, job: Future) -> None:
+        self._jobs.get(pool, set()).discard(job)
+        self._abandoned.discard(job)
+        self._stop_if_idle(pool)
+
+    def _check_size(self, file_path: str) -> None:
+        size = os.path.getsize(file_path)
+        if size > self.max_bytes:
+            raise DocumentLimitError(
+                f"Document is {size} bytes, the limit is {self.max_bytes}."
+            )
+
+    async def parse(self, file_path: str) -> List[Document]:
+        self._check_size(file_path)
+        return await self._run_job(_parse_in_worker, file_path, self.max_pages)
+
+    async def parse_stream(
+        self, file_path: str, page_window: int
+    ) -> AsyncIterator[List[Document]]:
+        """
+        Yields the chunks of a PDF `page_window` pages at a time, each window
+        parsed by its own pool job. Other formats are yielded in one piece.
+        """
+        self._check_size(file_path)
+        pages = await asyncio.to_thread(_count_pdf_pages, file_path)
+        if pages is None:
+            yield await self._run_job(_parse_in_worker, file_path, self.max_pages)
+            return
+        if pages > self.max_pages:
+            raise DocumentLimitError(
+                f"Document has {pages} pages, the limit is {self.max_pages}."
+            )
+        for first_page in range(0, pages, page_window):
+            yield await self._run_job(
+                _parse_pages_in_worker,
+                file_path,
+                first_page,
+                min(first_page + page_window, pages),
+            )
+
+    async def _run_job(self, func, *args) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        job = pool.submit(func, *args)
+        self._jobs.setdefault(pool, set()).add(job)
+
+        def on_done(_: Future) -> None:
+            try:
+                loop.call_soon_threadsafe(self._job_done, pool, job)
+            except RuntimeError:  # the loop is closed
+                pass
+
+        job.add_done_callback(on_done)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(job), timeout=self.timeout_seconds
+            )
+        except asyncio.TimeoutError:
+            logger.error(
+                f"Parsing '{args[0]}' exceeded {self.timeout_seconds}s, "
+                "retiring its parser pool."
+            )
+            self._abandoned.add(job)
+            self._retire_pool(pool)
+            raise
+        except BrokenProcessPool:
+            # Every job on a broken pool fails; its processes are gone
+            self._abandoned.update(self._jobs.get(pool, ()))
+            self._retire_pool(pool)
+            raise
+
+    def shutdown(self) -> None:
+        for pool in list(self._jobs):
+            self._abandoned.update(self._jobs[pool])
+            self._retire_pool(pool)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+parse_executor = ParseExecutor(
+    max_workers=app_config.PARSE_MAX_WORKERS,
+    timeout_seconds=app_config.PARSE_TIMEOUT_SECONDS,
+    max_bytes=app_config.UPLOAD_MAX_BYTES,
+    max_pages=app_config.UPLOAD_MAX_PAGES,
+)
@@ -0,0 +1,108 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+# Words that only add noise to a full-text ranking
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it me of on or "
+    "please tell that the this to was what when where which who why with you".split()
+)
+
+
+def search_terms(query: str, max_terms: int) -> List[str]:
+    """Plain lowercase words of a query, safe to inline into a FullTextScore call."""
+    terms = [t for t in re.findall(r"[\w]+", query.lower()) if t not in STOPWORDS]
+    return list(dict.fromkeys(terms))[:max_terms]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[Hashable]], k: int = 60
+) -> Dict[Hashable, float]:
+    """Scores every key by the sum of 1 / (k + rank) over the rankings it is in."""
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+@dataclass
+class Candidate:
+    document: Document
+    fused_score: float
+    similarity: Optional[float] = None
+
+
+def select_adaptive(
+    candidates: List[Candidate],
+    min_k: int,
+    max_k: int,
+    relative_score: float,
+    min_similarity: float,
+) -> List[Candidate]:
+    """
+    Keeps the best `min_k` candidates, then further ones while their fused score
+    is within `relative_score` of the best and their vector similarity (when
+    known) is at least `min_similarity`, up to `max_k`.
+    """
+    ranked = sorted(candidates, key=lambda c: c.fused_score, reverse=True)
+    if not ranked:
+        return []
+    floor = ranked[0].fused_score * relative_score
+    selected = ranked[:min_k]
+    for candidate in ranked[min_k:max_k]:
+        if candidate.fused_score < floor:
+            break
+        if candidate.similarity is not None and candidate.similarity < min_similarity:
+            continue
+        selected.append(candidate)
+    return selected
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _overlap(first: str, second: str, max_overlap: int) -> int:
+    """Length of the longest suffix of `first` that is a prefix of `second`."""
+    for size in range(min(len(first), len(second), max_overlap), 0, -1):
+        if first.endswith(second[:size]):
+            return size
+    return 0
+
+
+def dedupe_overlapping(
+    candidates: List[Candidate], min_overlap: int, max_overlap: int
+) -> List[Candidate]:
+    """
+    Drops chunks whose text is contained in a better-ranked chunk of the same
+    file and merges neighbouring chunks that share a splitter overlap of at
+    least `min_overlap` characters. Order and best scores are kept.
+    """
+    kept: List[Candidate] = []
+    for candidate in candidates:
+        text = _normalize(candidate.document.page_content)
+        source = candidate.document.metadata.get("filename")
+        for existing in kept:
+            if existing.document.metadata.get("filename") != source:
+                continue
+            existing_text = _normalize(existing.document.page_content)
+            if text in existing_text:
+                break
+            if existing_text in text:
+                existing.document.page_content = text
+                break
+            after = _overlap(existing_text, text, max_overlap)
+            before = _overlap(text, existing_text, max_overlap)
+            if max(after, before) >= min_overlap:
+                existing.document.page_content = (
+                    existing_text + text[after:]
+                    if after >= before
+                    else text + existing_text[before:]
+                )
+                break
+        else:
+            kept.append(candidate)
+    return kept
@@ -1,11 +1,24 @@
+import threading
+from typing import TYPE_CHECKING, Optional
+
 from azure.cosmos import CosmosClient, PartitionKey
-from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
-    AzureCosmosDBNoSqlVectorSearch,
-)
-from langchain_openai import AzureOpenAIEmbeddings
+from azure.cosmos.aio import ContainerProxy
+from langchain_core.embeddings import Embeddings
 
 from config import app_config
+from core.cosmos_client import get_container
+from core.openai_router import (
+    DEPLOYMENT_KIND_EMBEDDINGS,
+    Deployment,
+    DeploymentClients,
+    RoutedEmbeddings,
+    openai_router,
+)
 
+if TYPE_CHECKING:
+    from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+        AzureCosmosDBNoSqlVectorSearch,
+    )
 
 HOST = app_config.AZURE_COSMOS_DB_ENDPOINT
 KEY = app_config.AZURE_COSMOS_DB_KEY
@@ -36,26 +49,72 @@ full_text_policy = {
 }
 
 
-cosmos_client = CosmosClient(HOST, KEY)
+VECTOR_LAYOUT_ID = "id"
+VECTOR_LAYOUT_CHAT = "chat"
+PARTITION_KEY_PATHS = {
+    VECTOR_LAYOUT_ID: "/id",
+    VECTOR_LAYOUT_CHAT: "/metadata/chat_id",
+}
+
+
+def partition_key_path(layout: str) -> str:
+    if layout not in PARTITION_KEY_PATHS:
+        raise ValueError(f"Unknown vector partition layout: {layout}")
+    return PARTITION_KEY_PATHS[layout]
+
+
 database_name = app_config.COSMOS_VECTOR_DB_NAME
 container_name = app_config.COSMOS_VECTOR_CONTAINER_NAME
-partition_key = PartitionKey(path="/id")
+partition_layout = app_config.VECTOR_PARTITION_LAYOUT
+partition_key = PartitionKey(path=partition_key_path(partition_layout))
 cosmos_container_properties = {"partition_key": partition_key}
 
 
-openai_embeddings = AzureOpenAIEmbeddings(
-    model=app_config.OPENAI_EMBEDDINGS_MODEL_NAME,
-    chunk_size=1,
-    azure_deployment=app_config.OPENAI_EMBEDDINGS_MODEL_DEPLOYMENT,
-    openai_api_version=app_config.OPENAI_EMBEDDINGS_API_VERSION,
-    azure_endpoint=app_config.AZURE_OPENAI_ENDPOINT,
+_cosmos_client: Optional[CosmosClient] = None
+_cosmos_client_lock = threading.Lock()
+
+
+def get_cosmos_client() -> CosmosClient:
+    """
+    Sync Cosmos client of the LangChain vector store, created on first use:
+    the constructor reads the account over the network.
+    """
+    global _cosmos_client
+    with _cosmos_client_lock:
+        if _cosmos_client is None:
+            _cosmos_client = CosmosClient(HOST, KEY)
+    return _cosmos_client
+
+
+def _embeddings_client(deployment: Deployment) -> Embeddings:
+    from langchain_openai import AzureOpenAIEmbeddings
+
+    return AzureOpenAIEmbeddings(
+        model=app_config.OPENAI_EMBEDDINGS_MODEL_NAME,
+        chunk_size=app_config.EMBEDDING_BATCH_MAX_INPUTS,
+        # Inputs are chunks of at most 1000 characters in token-bounded
+        # batches, and queries are capped at QUERY_EMBEDDING_MAX_CHARS, so
+        # the client-side tiktoken pass (and the download of its encoding
+        # on first use) is not needed
+        check_embedding_ctx_length=False,
+        **openai_router.client_kwargs(deployment),
+    )
+
+
+openai_embeddings = RoutedEmbeddings(
+    openai_router,
+    DeploymentClients(openai_router, DEPLOYMENT_KIND_EMBEDDINGS, _embeddings_client),
 )
 
 
-def create_vector_search() -> AzureCosmosDBNoSqlVectorSearch:
+def create_vector_search() -> "AzureCosmosDBNoSqlVectorSearch":
+    from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+        AzureCosmosDBNoSqlVectorSearch,
+    )
+
     vector_search = AzureCosmosDBNoSqlVectorSearch(
         embedding=openai_embeddings,
-        cosmos_client=cosmos_client,
+        cosmos_client=get_cosmos_client(),
         database_name=database_name,
         container_name=container_name,
         vector_embedding_policy=vector_embedding_policy,
@@ -67,3 +126,21 @@ def create_vector_search() -> AzureCosmosDBNoSqlVectorSearch:
     )
 
     return vector_search
+
+
+async def get_async_vector_container(
+    name: str = container_name, layout: str = partition_layout
+) -> ContainerProxy:
+    """
+    Async handle to the vector container, on the shared Cosmos client. Other
+    containers can be opened with the same policies by passing their name and
+    partition layout, e.g. for migrations.
+    """
+    return await get_container(
+        database_name,
+        name,
+        partition_key_path(layout),
+        indexing_policy=indexing_policy,
+        vector_embedding_policy=vector_embedding_policy,
+        full_text_policy=full_text_policy,
+    )
@@ -0,0 +1,53 @@
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """
+    Runs start-up steps on a background thread, so importing the app stays
+    fast and the clients are ready by the time most first requests need them.
+    A step that fails is logged and left to be retried on first use; requests
+    that arrive first create what they need themselves.
+    """
+
+    def __init__(self):
+        self.timings_ms: Dict[str, float] = {}
+        self.failed: List[str] = []
+        self._thread: Optional[threading.Thread] = None
+        self._done = threading.Event()
+
+    def start(self, steps: List[Tuple[str, Callable[[], Any]]]) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(steps,), name="warmup", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, steps: List[Tuple[str, Callable[[], Any]]]) -> None:
+        started = time.perf_counter()
+        for name, step in steps:
+            step_started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                self.failed.append(name)
+                logger.warning(f"Warm-up step '{name}' failed: {e}")
+            self.timings_ms[name] = (time.perf_counter() - step_started) * 1000
+        self.timings_ms["total"] = (time.perf_counter() - started) * 1000
+        logger.info(f"Warm-up finished in {self.timings_ms['total']:.0f} ms")
+        self._done.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the warm-up finished; False on timeout or if not started."""
+        return self._thread is not None and self._done.wait(timeout)
+
+    def snapshot(self) -> Dict[str, float]:
+        return {f"warmup_{name}_ms": ms for name, ms in self.timings_ms.items()}
+
+
+warmup = Warmup()
@@ -6,25 +6,81 @@ from azurefunctions.extensions.http.fastapi import (
     JSONResponse,
 )
 from fastapi import HTTPException, UploadFile
+import asyncio
+import importlib
 import json
 import logging
 import os
+from typing import Optional
 
 
 from config import app_config
+from core.admission import AdmissionRejected, admission_controller
+from core.answer_cache import answer_cache
+from core.context_formatter import format_context
+from core.job_queue import storage_job_queue
+from core.vector_stores import openai_embeddings
+from core.warmup import warmup
 from services.chat_history import chat_history_service
+from services.context_window import context_window_service
+from services.ingestion_jobs import ingestion_job_service
 from services.openai_service import openai_service
 from services.vector_store import vector_store_service
 from utils.file_handling import file_handler
+from utils.background import spawn_background
 from utils.exceptions import ChatServiceError, FileProcessingError, OpenAIError
+from utils.metrics import (
+    counters_snapshot,
+    increment_counter,
+    start_request_metrics,
+)
+from utils.sse import coalesce_sse, replay_text, sse_event
+from utils.tokens import estimate_messages_tokens, estimate_tokens
+from utils.tracing import CORRELATION_ID_HEADER
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 
+async def _generate_and_store_title(history, prompt: str, chat_id: str) -> None:
+    """Titles a chat from its first prompt; runs in the background."""
+    try:
+        title = await openai_service.generate_chat_title(prompt)
+        await chat_history_service.set_chat_title(history, title)
+        logging.info(f"Generated and set title for chat {chat_id}: '{title}'")
+    except OpenAIError as e:
+        logging.warning(f"Could not generate chat title for {chat_id}: {e.detail}")
+
+
+def _client_key(req: Request) -> str:
+    """Who a request counts against for per-user admission limits."""
+    principal = req.headers.get("x-ms-client-principal-id")
+    if principal:
+        return principal
+    return req.client.host if req.client else "anonymous"
+
+
+def _busy_event(reason: str, retry_after: float) -> bytes:
+    return sse_event(
+        json.dumps({"reason": reason, "retry_after": round(retry_after)}),
+        event="busy",
+    )
+
+
 @app.route(route="request_gpt", methods=[func.HttpMethod.POST])
 async def stream_openai_text(req: Request) -> StreamingResponse:
     logging.info("Received request for /request_gpt")
+    if admission_controller.saturated():
+        # Shed load before touching Cosmos DB or Azure OpenAI
+        retry_after = admission_controller.queue_timeout_seconds
+        increment_counter("admission_rejected_queue_full")
+        return StreamingResponse(
+            iter([_busy_event("queue_full", retry_after)]),
+            media_type="text/event-stream",
+            status_code=503,
+            headers={"Retry-After": str(round(retry_after))},
+        )
+    request_metrics = start_request_metrics("request_gpt", req.headers)
     try:
         body = await req.json()
         prompt = body.get("q")
@@ -46,59 +102,141 @@ async def stream_openai_text(req: Request) -> StreamingResponse:
             f"Processing request for chat ID: {chat_id}, prompt: '{prompt[:75]}{'...' if len(prompt) > 75 else ''}'"
         )
 
-        history = await chat_history_service.get_history_instance(chat_id)
-
-        documents_with_scores = vector_store_service.similarity_search_with_filter(
-            query=prompt, chat_id=chat_id, k=3
+        # History load runs alongside embedding the question; retrieval waits
+        # for it to check the cached vectors against the chat's files. The
+        # search is dropped if the answer cache already has a reply.
+        history_task = asyncio.create_task(
+            chat_history_service.get_history_instance(chat_id)
         )
-        context = ""
-        for document, score in documents_with_scores:
-            context += f"content: {document.model_dump_json()}, score: {score}\n\n"
+        retrieval_task = None
 
-        history.add_user_message(prompt)
+        async def retrieve(embedding):
+            # Shielded: cancelling the search must not cancel the history load
+            chat_files = (await asyncio.shield(history_task)).files
+            return await vector_store_service.aretrieve(
+                query=prompt, chat_id=chat_id, embedding=embedding, files=chat_files
+            )
 
-        if len(history.messages) == 2:
-            try:
-                title = await openai_service.generate_chat_title(prompt)
-                history.set_title(title=title)
-                logging.info(f"Generated and set title for chat {chat_id}: '{title}'")
-            except OpenAIError as e:
-                logging.warning(
-                    f"Could not generate chat title for {chat_id}: {e.detail}"
-                )
+        try:
+            query_embedding = await vector_store_service.aembed_query(prompt)
+            retrieval_task = asyncio.create_task(retrieve(query_embedding))
+            history = await history_task
+        except BaseException:
+            for task in (history_task, retrieval_task):
+                if task is not None:
+                    task.cancel()
+            raise
+
+        # Only the prior turns go into the prompt, the new one is sent separately
+        prior_messages = list(history.messages)
+        is_first_turn = len(prior_messages) == 1
+
+        cached_answer = None
+        admission_cost = None
+        if answer_cache:
+            cached_answer = answer_cache.lookup(chat_id, history.files, query_embedding)
+        if cached_answer is not None:
+            retrieval_task.cancel()
+            answer_source = replay_text(cached_answer)
+        else:
+            documents_with_scores = await retrieval_task
+            formatted = format_context(
+                documents_with_scores, max_tokens=app_config.CONTEXT_MAX_TOKENS
+            )
+            context = formatted.text
+            request_metrics.context_tokens = formatted.tokens
+            request_metrics.context_tokens_saved = formatted.tokens_saved
+            increment_counter("context_tokens", formatted.tokens)
+            increment_counter("context_tokens_saved", formatted.tokens_saved)
+
+            prompt_history = context_window_service.build_history(
+                history,
+                prior_messages,
+                reserved=[openai_service.system_prompt(context), prompt],
+            )
+            answer_source = openai_service.generate_response_stream(
+                prompt, prompt_history, context
+            )
+            admission_cost = (
+                estimate_messages_tokens(prompt_history)
+                + estimate_tokens(openai_service.system_prompt(context))
+                + estimate_tokens(prompt)
+                + app_config.ADMISSION_OUTPUT_TOKENS
+            )
 
         full_gpt_response = ""
+        response_chunks = []
 
         async def stream_generator():
+            async for chunk in answer_source:
+                response_chunks.append(chunk)
+                yield chunk
+
+        async def final_stream_processor():
             nonlocal full_gpt_response
+            admission = None
+            save_user_message = None
             try:
-                async for chunk in openai_service.generate_response_stream(
-                    prompt, history, context
+                # Generation waits for a slot; cached answers need none
+                if admission_cost is not None:
+                    try:
+                        admission = await admission_controller.acquire(
+                            _client_key(req), admission_cost
+                        )
+                    except AdmissionRejected as e:
+                        logging.warning(
+                            f"Rejected request for chat {chat_id}: {e.reason}"
+                        )
+                        yield _busy_event(e.reason, e.retry_after)
+                        return
+                    request_metrics.admission_wait_ms = admission.wait_ms
+
+                # The user message is persisted while the answer streams; the AI
+                # message waits for it so both keep their order in the history.
+                save_user_message = asyncio.create_task(
+                    history.aadd_user_message(prompt)
+                )
+                if is_first_turn:
+                    spawn_background(
+                        _generate_and_store_title(history, prompt, chat_id),
+                        name=f"title-{chat_id}",
+                    )
+
+                async for frame in coalesce_sse(
+                    stream_generator(),
+                    max_bytes=app_config.SSE_FLUSH_BYTES,
+                    max_interval_ms=app_config.SSE_FLUSH_INTERVAL_MS,
                 ):
-                    yield chunk
+                    request_metrics.mark_first_byte()
+                    yield frame
+                full_gpt_response = "".join(response_chunks)
+                if answer_cache and cached_answer is None and full_gpt_response:
+                    answer_cache.store(
+                        chat_id, history.files, query_embedding, full_gpt_response
+                    )
             except OpenAIError as e:
                 logging.error(
                     f"Error during AI streaming for chat {chat_id}: {e.detail}",
                     exc_info=True,
                 )
-                yield f"data: ERROR: An error occurred during response generation: {e.detail}\n\n".encode(
-                    "utf-8"
+                yield sse_event(
+                    f"ERROR: An error occurred during response generation: {e.detail}"
                 )
-                raise
-
-        async def final_stream_processor():
-            nonlocal full_gpt_response
-            response_chunks = []
-            try:
-                async for chunk in stream_generator():
-                    response_chunks.append(chunk.decode("utf-8"))
-                    yield chunk
-                full_gpt_response = "".join(response_chunks)
             except Exception as e:
                 pass
             finally:
+                if admission is not None:
+                    admission.release()
+                try:
+                    if save_user_message is not None:
+                        await save_user_message
+                except Exception as e:
+                    logging.error(
+                        f"Failed to save user message for chat {chat_id}: {e}",
+                        exc_info=True,
+                    )
                 if full_gpt_response:
-                    history.add_ai_message(full_gpt_response)
+                    await history.aadd_ai_message(full_gpt_response)
                     logging.info(
                         f"Full AI response saved to history for chat {chat_id}."
                     )
@@ -106,13 +244,17 @@ async def stream_openai_text(req: Request) -> StreamingResponse:
                     logging.warning(
                         f"No AI response generated for chat {chat_id} to save to history."
                     )
+                request_metrics.log()
 
         return StreamingResponse(
-            final_stream_processor(), media_type="text/event-stream"
+            final_stream_processor(),
+            media_type="text/event-stream",
+            headers={CORRELATION_ID_HEADER: request_metrics.correlation_id},
         )
 
     except HTTPException as http_exc:
         logging.error(f"HTTP Error: {http_exc.detail}", exc_info=True)
+        request_metrics.log()
         return StreamingResponse(
             iter([f"data: ERROR: {http_exc.detail}\n\n".encode("utf-8")]),
             media_type="text/event-stream",
@@ -122,6 +264,7 @@ async def stream_openai_text(req: Request) -> StreamingResponse:
         status_code = getattr(e, "status_code", 500)
         detail = getattr(e, "detail", str(e))
         logging.error(f"Error processing request: {detail}", exc_info=True)
+        request_metrics.log()
         return StreamingResponse(
             iter(
                 [
@@ -135,44 +278,39 @@ async def stream_openai_text(req: Request) -> StreamingResponse:
         )
 
 
-@app.cosmos_db_input(
-    arg_name="documents",
-    database_name=app_config.COSMOS_DATABASE_NAME,
-    container_name=app_config.COSMOS_CONTAINER_NAME,
-    connection="CosmosDBConnection",
-    sql_query="SELECT c.id, c.title FROM c",
-)
 @app.route(route="fetch_chats", auth_level=func.AuthLevel.FUNCTION)
-async def get_all_metadata_ids(req: Request, documents: func.DocumentList) -> Response:
+async def get_all_metadata_ids(req: Request) -> Response:
+    """
+    Lists the user's chats, most recently updated first, one page at a time.
+    Pass the returned `continuation` back to get the next page.
+    """
     logging.info("Python HTTP trigger function processed a request for fetch_chats.")
     try:
-        if not documents:
-            logging.warning("No documents found in the specified Cosmos DB container.")
-            logging.info("Creating new chat!")
-            cosmos_history = await chat_history_service.create_new_chat_history()
-            documents.append(
-                {"id": cosmos_history.session_id, "title": cosmos_history.title}
-            )
-
-        metadata_ids = [
-            {"id": doc.get("id"), "title": doc.get("title")}
-            for doc in documents
-            if doc.get("id")
-        ]
+        limit = int(req.query_params.get("limit", app_config.CHAT_LIST_PAGE_SIZE))
+    except ValueError:
+        return JSONResponse({"error": "'limit' must be an integer."}, status_code=400)
+    limit = max(1, min(limit, app_config.CHAT_LIST_MAX_PAGE_SIZE))
+    continuation = req.query_params.get("continuation") or None
 
-        logging.info(f"Successfully fetched {len(metadata_ids)} metadata IDs.")
-        return Response(
-            content=json.dumps(metadata_ids),
-            media_type="application/json",
+    request_metrics = start_request_metrics("fetch_chats", req.headers)
+    try:
+        chats, next_continuation = await chat_history_service.list_chats(
+            limit=limit, continuation=continuation
+        )
+        logging.info(f"Successfully fetched {len(chats)} chats.")
+        return JSONResponse(
+            content={"chats": chats, "continuation": next_continuation},
             status_code=200,
         )
+    except ChatServiceError as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
     except Exception as e:
         logging.error(f"An error occurred in fetch_chats: {e}", exc_info=True)
-        return Response(
-            content=json.dumps({"error": f"An error occurred: {str(e)}"}),
-            status_code=500,
-            media_type="application/json",
+        return JSONResponse(
+            status_code=500, content={"error": f"An error occurred: {str(e)}"}
         )
+    finally:
+        request_metrics.log()
 
 
 @app.route(route="create_chat", methods=[func.HttpMethod.POST])
@@ -195,10 +333,25 @@ async def create_new_chat(req: Request) -> Response:
         )
 
 
+def _optional_int(req: Request, name: str) -> Optional[int]:
+    value = req.query_params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"'{name}' must be an integer.")
+
+
 @app.route(route="fetch_chat", methods=[func.HttpMethod.GET])
 async def fetch_chat(req: Request) -> Response:
     """
     Accepts a chatId and returns list of messages associated with it, if exists.
+
+    Optional query parameters select a window of messages: `limit` (the newest
+    N), `before` (older than a message index) or `after` (newer than a message
+    index, for delta sync). The response carries the chat's ETag; a request
+    with a matching If-None-Match gets 304 without reading any messages.
     """
     logging.info("Received request for /fetch_chat")
     chat_id = req.query_params.get("chat_id")
@@ -209,25 +362,48 @@ async def fetch_chat(req: Request) -> Response:
             status_code=400,
         )
 
+    request_metrics = start_request_metrics("fetch_chat", req.headers)
     try:
-        history = await chat_history_service.get_history_instance(chat_id)
-        messages = await history.aget_messages()
-        files = history._load_existing_files()
+        limit = _optional_int(req, "limit")
+        before = _optional_int(req, "before")
+        after = _optional_int(req, "after")
+        if limit is not None and limit < 1:
+            raise HTTPException(status_code=400, detail="'limit' must be positive.")
+
+        history = await chat_history_service.get_history_instance(
+            chat_id, load_messages=False
+        )
+        headers = {"ETag": history.etag} if history.etag else {}
+        if history.etag and req.headers.get("if-none-match") == history.etag:
+            return Response(status_code=304, headers=headers)
 
+        window, has_more = await history.aget_message_window(
+            limit=limit, before=before, after=after
+        )
         message_list = []
-        for message in messages:
+        for index, message in window:
             role = None
             if message.type == "ai":
                 role = "agent"
             elif message.type == "human":
                 role = "user"
             if role:
-                message_list.append({"role": role, "value": message.content})
+                message_list.append(
+                    {"role": role, "value": message.content, "index": index}
+                )
 
         return JSONResponse(
-            content={"messages": message_list, "files": files},
+            content={
+                "messages": message_list,
+                "files": history.files,
+                "title": history.title,
+                "has_more": has_more,
+            },
             status_code=200,
+            headers=headers,
         )
+    except HTTPException as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.detail})
     except ChatServiceError as e:
         logging.error(f"Error fetching chat {chat_id}: {e.detail}", exc_info=True)
         return JSONResponse(status_code=e.status_code, content={"error": e.detail})
@@ -237,17 +413,12 @@ async def fetch_chat(req: Request) -> Response:
             status_code=500,
             content={"error": f"An unexpected server error occurred: {e}"},
         )
+    finally:
+        request_metrics.log()
 
 
 @app.route("delete_chat/{chat_id}", methods=[func.HttpMethod.DELETE])
-@app.cosmos_db_input(
-    arg_name="documents",
-    database_name=app_config.COSMOS_VECTOR_DB_NAME,
-    container_name=app_config.COSMOS_VECTOR_CONTAINER_NAME,
-    connection="CosmosDBConnection",
-    sql_query="SELECT c.id FROM c WHERE c.metadata.chat_id = {chat_id}",
-)
-async def delete_chat(req: Request, documents: func.DocumentList) -> Response:
+async def delete_chat(req: Request) -> Response:
     logging.info(f"Received request for /delete_chat/{req.path_params.get('chat_id')}")
     chat_id = req.path_params.get("chat_id")
     if not chat_id:
@@ -256,13 +427,15 @@ async def delete_chat(req: Request, documents: func.DocumentList) -> Response:
             status_code=400,
         )
 
+    request_metrics = start_request_metrics("delete_chat", req.headers)
     try:
         await chat_history_service.clear_chat_history(chat_id)
+        if answer_cache:
+            answer_cache.invalidate_chat(chat_id)
+        await ingestion_job_service.adelete_chat_jobs(chat_id)
 
-        if documents:
-            doc_ids_to_delete = [doc.get("id") for doc in documents if doc.get("id")]
-            vector_store_service.delete_documents_by_id(doc_ids_to_delete)
-        else:
+        deleted = await vector_store_service.adelete_chat_documents(chat_id)
+        if not deleted:
             logging.info(f"No vector documents found to delete for chat ID: {chat_id}")
 
         return JSONResponse(
@@ -278,11 +451,18 @@ async def delete_chat(req: Request, documents: func.DocumentList) -> Response:
             status_code=500,
             content={"error": f"An unexpected server error occurred: {e}"},
         )
+    finally:
+        request_metrics.log()
 
 
 @app.route(route="upload", methods=[func.HttpMethod.POST])
 async def upload(req: Request) -> JSONResponse:
+    """
+    Stages the uploaded file and queues it for ingestion. Responds right away
+    with the job; progress is reported by /upload_status/{job_id}.
+    """
     logging.info("Received request for /upload")
+    request_metrics = start_request_metrics("upload", req.headers)
     temp_file_path = None
     try:
         form_data = await req.form()
@@ -299,27 +479,29 @@ async def upload(req: Request) -> JSONResponse:
             uploaded_file
         )
 
-        documents = file_handler.process_pdf_documents(
-            temp_file_path, chat_id, uploaded_file.filename
-        )
-        await vector_store_service.add_documents_to_vector_store(documents)
-
-        history = await chat_history_service.get_history_instance(session_id=chat_id)
-        current_files = history._load_existing_files()
-        updated_files = list(set(current_files + [uploaded_file.filename]))
-        history.set_files(updated_files)
-
-        logging.info(
-            f"Updated chat {chat_id} history with new file: {uploaded_file.filename}"
+        job = await ingestion_job_service.submit(
+            chat_id=chat_id,
+            file_path=temp_file_path,
+            filename=uploaded_file.filename,
+            content_type=uploaded_file.content_type,
+            file_size_bytes=os.path.getsize(temp_file_path),
         )
+        # The job owns the staged file from here on
+        temp_file_path = None
 
         response_data = {
-            "message": "File processed and indexed successfully!",
-            "original_file_name": uploaded_file.filename,
-            "content_type": uploaded_file.content_type,
-            "file_size_bytes": os.path.getsize(temp_file_path),
+            "message": "File accepted for processing.",
+            "job_id": job.job_id,
+            "status": job.status,
+            "original_file_name": job.filename,
+            "content_type": job.content_type,
+            "file_size_bytes": job.file_size_bytes,
         }
-        return JSONResponse(content=response_data, status_code=200)
+        return JSONResponse(
+            content=response_data,
+            status_code=202,
+            headers={CORRELATION_ID_HEADER: request_metrics.correlation_id},
+        )
 
     except (HTTPException, FileProcessingError, ChatServiceError) as http_exc:
         logging.error(f"HTTP Error during upload: {http_exc.detail}", exc_info=True)
@@ -336,3 +518,66 @@ async def upload(req: Request) -> JSONResponse:
         )
     finally:
         file_handler.cleanup_temporary_file(temp_file_path)
+        request_metrics.log()
+
+
+@app.route(route="upload_status/{job_id}", methods=[func.HttpMethod.GET])
+async def upload_status(req: Request) -> JSONResponse:
+    """Reports progress of an ingestion job started by /upload."""
+    job_id = req.path_params.get("job_id")
+    try:
+        job = await ingestion_job_service.get(job_id) if job_id else None
+    except Exception as e:
+        logging.error(f"Error reading ingestion job {job_id}: {e}", exc_info=True)
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"An unexpected server error occurred: {e}"},
+        )
+    if job is None:
+        return JSONResponse({"error": f"Unknown job '{job_id}'."}, status_code=404)
+    return JSONResponse(content=job.to_dict(), status_code=200)
+
+
+if app_config.INGESTION_QUEUE_BACKEND == "storage":
+
+    @app.queue_trigger(
+        arg_name="message",
+        queue_name=app_config.INGESTION_QUEUE_NAME,
+        connection=app_config.INGESTION_STORAGE_CONNECTION,
+    )
+    async def ingest_upload(message: func.QueueMessage) -> None:
+        """Runs an ingestion job queued by /upload on any instance."""
+        job_id = storage_job_queue.job_id_of(message.get_body())
+        logging.info(
+            f"Ingestion job {job_id} dequeued (delivery {message.dequeue_count})"
+        )
+        await ingestion_job_service.run_queued(job_id)
+
+
+@app.route(
+    route="metrics", methods=[func.HttpMethod.GET], auth_level=func.AuthLevel.FUNCTION
+)
+async def metrics(req: Request) -> JSONResponse:
+    """Returns this worker's counters (cache hits/misses, ...) and admission state."""
+    return JSONResponse(
+        content={
+            **counters_snapshot(),
+            **admission_controller.snapshot(),
+            **warmup.snapshot(),
+        },
+        status_code=200,
+    )
+
+
+if app_config.STARTUP_WARMUP:
+    # Clients are created on first use; create them off the import path, so
+    # the host can index the functions sooner and first requests find them ready
+    warmup.start(
+        [
+            ("openai_sdk", lambda: importlib.import_module("langchain_openai")),
+            ("chat_clients", openai_service.models.warm),
+            ("title_clients", openai_service.title_models.warm),
+            ("embeddings_clients", openai_embeddings.clients.warm),
+            ("vector_search", lambda: vector_store_service.vector_search),
+        ]
+    )
@@ -1,38 +1,63 @@
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from langchain_core.messages import SystemMessage
+from core.cosmos_client import get_chat_container
 from core.custom_cosmos_db import CustomCosmosDBChatMessageHistory
 from config import app_config
 from utils.exceptions import ChatServiceError
+from utils.metrics import cosmos_response_hook, increment_counter
+from utils.tracing import tracer
+from utils.ttl_cache import TTLCache
 
 logger = logging.getLogger(__name__)
 
+USER_ID = 1  # TODO: Change when auth is added, single user for now
+
+# Chat items only; per-message items of segmented chats carry a session_id,
+# ingestion job records a job_id. Chats written before updated_at existed sort
+# after all others.
+LIST_CHATS_QUERY = (
+    "SELECT c.id, c.title, c.updated_at FROM c "
+    "WHERE NOT IS_DEFINED(c.session_id) AND NOT IS_DEFINED(c.job_id) "
+    "ORDER BY c.updated_at DESC"
+)
+
 
 class ChatHistoryService:
     def __init__(self):
-        self.cosmos_endpoint = app_config.AZURE_COSMOS_DB_ENDPOINT
-        self.cosmos_key = app_config.AZURE_COSMOS_DB_KEY
-        self.database_name = app_config.COSMOS_DATABASE_NAME
-        self.container_name = app_config.COSMOS_CONTAINER_NAME
+        self.storage_mode = app_config.CHAT_HISTORY_STORAGE_MODE
+        self._listing_cache = TTLCache(
+            ttl_seconds=app_config.CHAT_LIST_CACHE_TTL_SECONDS, max_entries=256
+        )
 
     async def get_history_instance(
-        self, session_id: str, title: Optional[str] = None, files: List[str] = []
+        self,
+        session_id: str,
+        title: Optional[str] = None,
+        files: List[str] = [],
+        load_messages: bool = True,
     ) -> CustomCosmosDBChatMessageHistory:
         """
         Fetches CustomCosmosDBChatMessageHistory instance for sessionId (Thread).
+        All instances share the worker's pooled async Cosmos container. With
+        `load_messages=False` only the chat item is read.
         """
         try:
             history = CustomCosmosDBChatMessageHistory(
-                cosmos_endpoint=self.cosmos_endpoint,
-                credential=self.cosmos_key,
-                cosmos_database=self.database_name,
-                cosmos_container=self.container_name,
+                container=await get_chat_container(),
                 session_id=session_id,
-                user_id=1,  # TODO: Change when auth is added, single user for now
+                user_id=USER_ID,
                 title=title,
                 files=files,
+                storage_mode=self.storage_mode,
+                on_listing_change=self.invalidate_listing,
             )
-            history.prepare_cosmos()
+            with tracer.span("history_load", **{"chat.id": session_id}) as span:
+                if load_messages:
+                    await history.aload_messages()
+                else:
+                    await history.aload_chat_item()
+                span.set_attribute("chat.messages", len(history.messages))
             logger.info(f"CosmosDB history loaded for session: {session_id}")
             return history
         except Exception as e:
@@ -52,16 +77,65 @@ class ChatHistoryService:
         cosmos_history = await self.get_history_instance(
             session_id=new_uuid, title="New Chat"
         )
-        cosmos_history.add_message(
-            SystemMessage(content="You are a helpful assistant!")
+        await cosmos_history.aadd_messages(
+            [SystemMessage(content="You are a helpful assistant!")]
         )
+        self.invalidate_listing()
         return cosmos_history
 
     async def clear_chat_history(self, session_id: str):
         """Clears the chat history for a given session ID."""
         history = await self.get_history_instance(session_id)
-        history.clear()
+        await history.aclear()
+        self.invalidate_listing()
         logger.info(f"Chat history cleared for session: {session_id}")
 
+    async def set_chat_title(
+        self, history: CustomCosmosDBChatMessageHistory, title: str
+    ) -> None:
+        await history.aset_title(title=title)
+        self.invalidate_listing()
+
+    def invalidate_listing(self) -> None:
+        self._listing_cache.invalidate(lambda key: key[0] == USER_ID)
+
+    async def list_chats(
+        self, limit: int, continuation: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Returns one page of the user's chats, most recently updated first, and
+        the continuation token of the next page (None on the last page). Reads
+        only the user's partition; pages are cached briefly.
+        """
+        key = (USER_ID, limit, continuation)
+        cached = self._listing_cache.get(key)
+        if cached is not None:
+            increment_counter("chat_list_cache_hits")
+            return cached
+        increment_counter("chat_list_cache_misses")
+
+        try:
+            container = await get_chat_container()
+            pages = container.query_items(
+                query=LIST_CHATS_QUERY,
+                partition_key=USER_ID,
+                max_item_count=limit,
+                response_hook=cosmos_response_hook,
+            ).by_page(continuation)
+            chats: List[Dict] = []
+            async for page in pages:
+                chats = [
+                    {"id": item["id"], "title": item.get("title")}
+                    async for item in page
+                ]
+                break
+            result = (chats, pages.continuation_token)
+        except Exception as e:
+            logger.error(f"Failed to list chats: {e}", exc_info=True)
+            raise ChatServiceError(status_code=500, detail=f"Failed to list chats: {e}")
+
+        self._listing_cache.set(key, result)
+        return result
+
 
 chat_history_service = ChatHistoryService()
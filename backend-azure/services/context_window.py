@@ -0,0 +1,139 @@
+import logging
+from typing import List, Set
+
+from langchain_core.messages import BaseMessage, SystemMessage
+
+from config import app_config
+from core.custom_cosmos_db import CustomCosmosDBChatMessageHistory
+from services.openai_service import openai_service
+from utils.background import spawn_background
+from utils.exceptions import OpenAIError
+from utils.tokens import estimate_message_tokens, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class ContextWindowService:
+    """
+    Fits a chat's history into the prompt token budget.
+
+    Leading system messages are always kept. When the remaining history does
+    not fit next to the system prompt, context and question, the most recent
+    messages are kept verbatim and everything before them is represented by
+    the chat's rolling summary. The summary is stored on the chat item and
+    refreshed in the background, folding in only the messages it does not
+    cover yet, so building a prompt never waits for a summarization call.
+    """
+
+    def __init__(self, token_budget: int, summary_max_tokens: int, summaries: bool):
+        self.token_budget = token_budget
+        self.summary_max_tokens = summary_max_tokens
+        self.summaries = summaries
+        self._refreshing: Set[str] = set()
+
+    @staticmethod
+    def _leading_system_count(messages: List[BaseMessage]) -> int:
+        count = 0
+        while count < len(messages) and isinstance(messages[count], SystemMessage):
+            count += 1
+        return count
+
+    @staticmethod
+    def _recent_start(messages: List[BaseMessage], start: int, budget: int) -> int:
+        """Index of the oldest message from which the tail still fits `budget`."""
+        used = 0
+        index = len(messages)
+        while index > start:
+            tokens = estimate_message_tokens(messages[index - 1])
+            if used + tokens > budget:
+                break
+            used += tokens
+            index -= 1
+        return index
+
+    def build_history(
+        self,
+        history: CustomCosmosDBChatMessageHistory,
+        messages: List[BaseMessage],
+        reserved: List[str],
+    ) -> List[BaseMessage]:
+        """
+        Returns the messages to send for `history`, given the texts in
+        `reserved` (system prompt, question) that share the budget.
+        """
+        lead = self._leading_system_count(messages)
+        budget = (
+            self.token_budget
+            - sum(estimate_tokens(text) for text in reserved)
+            - sum(estimate_message_tokens(message) for message in messages[:lead])
+        )
+        body_tokens = sum(estimate_message_tokens(m) for m in messages[lead:])
+        if body_tokens <= budget:
+            return list(messages)
+
+        recent_start = self._recent_start(
+            messages, lead, max(0, budget - self.summary_max_tokens)
+        )
+        window = list(messages[:lead])
+        if history.summary:
+            window.append(
+                SystemMessage(
+                    content=f"Summary of the earlier conversation:\n{history.summary}"
+                )
+            )
+            recent_start = max(recent_start, history.summary_message_count)
+        window.extend(messages[recent_start:])
+
+        if self.summaries and history.summary_message_count < recent_start:
+            self._schedule_refresh(history, messages, lead, recent_start)
+        logger.info(
+            f"History of chat {history.session_id} trimmed to "
+            f"{len(messages) - recent_start} recent messages "
+            f"({'with' if history.summary else 'without'} summary)."
+        )
+        return window
+
+    def _schedule_refresh(
+        self,
+        history: CustomCosmosDBChatMessageHistory,
+        messages: List[BaseMessage],
+        lead: int,
+        upto: int,
+    ) -> None:
+        if history.session_id in self._refreshing:
+            return
+        self._refreshing.add(history.session_id)
+        spawn_background(
+            self._refresh_summary(history, list(messages), lead, upto),
+            name=f"summary-{history.session_id}",
+        )
+
+    async def _refresh_summary(
+        self,
+        history: CustomCosmosDBChatMessageHistory,
+        messages: List[BaseMessage],
+        lead: int,
+        upto: int,
+    ) -> None:
+        try:
+            start = max(lead, history.summary_message_count)
+            summary = await openai_service.summarize_conversation(
+                history.summary, messages[start:upto], self.summary_max_tokens
+            )
+            await history.aset_summary(summary, upto)
+            logger.info(
+                f"Summary of chat {history.session_id} now covers {upto} messages."
+            )
+        except OpenAIError as e:
+            logger.warning(
+                f"Could not refresh summary for chat {history.session_id}: {e.detail}"
+            )
+        finally:
+            self._refreshing.discard(history.session_id)
+
+
+context_window_service = ContextWindowService(
+    token_budget=app_config.PROMPT_TOKEN_BUDGET,
+    summary_max_tokens=app_config.HISTORY_SUMMARY_MAX_TOKENS,
+    summaries=app_config.HISTORY_SUMMARY_ENABLED,
+)
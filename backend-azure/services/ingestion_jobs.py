@@ -0,0 +1,481 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from langchain_core.documents import Document
+
+from config import app_config
+from core.answer_cache import answer_cache
+from core.cosmos_client import get_chat_container
+from core.job_queue import storage_job_queue
+from services.chat_history import USER_ID, chat_history_service
+from services.vector_store import vector_store_service
+from utils.exceptions import FileProcessingError
+from utils.file_handling import file_handler
+from utils.metrics import (
+    cosmos_response_hook,
+    increment_counter,
+    start_request_metrics,
+)
+from utils.tracing import CORRELATION_ID_HEADER, correlation_id, tracer
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_PARSING = "parsing"
+STATUS_EMBEDDING = "embedding"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+BACKEND_MEMORY = "memory"
+BACKEND_STORAGE = "storage"
+
+# Job records share the chat container; their ids cannot clash with chat ids
+JOB_ITEM_PREFIX = "ingestion-job-"
+# Progress is saved at most this often; status changes are saved right away
+PROGRESS_SAVE_INTERVAL_SECONDS = 2.0
+
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    chat_id: str
+    filename: str
+    content_type: Optional[str]
+    file_size_bytes: int
+    file_path: Optional[str] = None
+    status: str = STATUS_QUEUED
+    chunks_parsed: int = 0
+    chunks_embedded: int = 0
+    chunks_indexed: int = 0
+    error: Optional[str] = None
+    # Of the upload request, so the job's trace can be tied back to it
+    correlation_id: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (STATUS_COMPLETED, STATUS_FAILED)
+
+    def update(self, **changes) -> None:
+        for key, value in changes.items():
+            setattr(self, key, value)
+        self.updated_at = time.time()
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("file_path")
+        return data
+
+    def to_item(self, user_id, ttl_seconds: int) -> dict:
+        return {
+            "id": f"{JOB_ITEM_PREFIX}{self.job_id}",
+            "user_id": user_id,
+            "ttl": ttl_seconds,
+            **self.to_dict(),
+        }
+
+    def assign_chunk_ids(self, documents: List[Document], first: int) -> None:
+        """
+        Numbers chunks from `first` within the job, so a re-run writes the
+        same ids and replaces the chunks of the earlier run.
+        """
+        for index, document in enumerate(documents, start=first):
+            document.id = f"{self.job_id}-{index}"
+
+    @classmethod
+    def from_item(cls, item: dict) -> "IngestionJob":
+        return cls(
+            **{name: item[name] for name in cls.__dataclass_fields__ if name in item}
+        )
+
+
+class IngestionJobService:
+    """
+    Runs uploads through parse -> chunk -> embed -> index in the background.
+
+    Job records are items in the user's partition of the chat container, so
+    every instance can report any job's status; the jobs an instance runs are
+    also held in memory. With the "memory" backend jobs are queued on an
+    in-process asyncio queue and drained by worker tasks on the instance that
+    took the upload. With "storage" the upload is staged in Blob storage and
+    the job queued on an Azure Storage queue, whose trigger runs it on any
+    instance (see StorageJobQueue).
+
+    A job's id is derived from the chat and the file's content hash, so
+    re-submitting the same file to the same chat returns the existing job
+    instead of indexing it twice; creating its record is conditional, so this
+    holds across instances too. A job that failed, went stale or whose record
+    expired is run again; its chunk ids are derived from the job id, so the
+    re-run replaces the chunks it had written.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        retention_seconds: int,
+        stale_seconds: int,
+        record_ttl_seconds: int,
+        backend: str,
+    ):
+        if backend not in (BACKEND_MEMORY, BACKEND_STORAGE):
+            raise ValueError(f"Unknown ingestion queue backend: {backend}")
+        self.workers = workers
+        self.retention_seconds = retention_seconds
+        self.stale_seconds = stale_seconds
+        self.record_ttl_seconds = record_ttl_seconds
+        self.backend = backend
+        self._jobs: Dict[str, IngestionJob] = {}
+        self._saved_at: Dict[str, float] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    @staticmethod
+    def job_id_for(chat_id: str, fingerprint: str) -> str:
+        return hashlib.sha256(f"{chat_id}\0{fingerprint}".encode("utf-8")).hexdigest()[
+            :32
+        ]
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        self._worker_tasks = [task for task in self._worker_tasks if not task.done()]
+        while len(self._worker_tasks) < self.workers:
+            self._worker_tasks.append(
+                asyncio.create_task(
+                    self._worker(), name=f"ingestion-{len(self._worker_tasks)}"
+                )
+            )
+        return self._queue
+
+    def _expired(self, job: IngestionJob) -> bool:
+        return job.finished and job.updated_at < time.time() - self.retention_seconds
+
+    def _stale(self, job: IngestionJob) -> bool:
+        """Unfinished, but not updated for so long its instance must be gone."""
+        return not job.finished and job.updated_at < time.time() - self.stale_seconds
+
+    def _purge_finished(self) -> None:
+        for job_id, job in list(self._jobs.items()):
+            if self._expired(job):
+                del self._jobs[job_id]
+                self._saved_at.pop(job_id, None)
+
+    async def _read(self, job_id: str) -> Tuple[Optional[IngestionJob], Optional[str]]:
+        """The stored job and the etag of its record."""
+        container = await get_chat_container()
+        try:
+            item = await container.read_item(
+                item=f"{JOB_ITEM_PREFIX}{job_id}",
+                partition_key=USER_ID,
+                response_hook=cosmos_response_hook,
+            )
+        except CosmosResourceNotFoundError:
+            return None, None
+        return IngestionJob.from_item(item), item.get("_etag")
+
+    async def _save(self, job: IngestionJob) -> None:
+        container = await get_chat_container()
+        await container.upsert_item(
+            body=job.to_item(USER_ID, self.record_ttl_seconds),
+            response_hook=cosmos_response_hook,
+        )
+        self._saved_at[job.job_id] = time.monotonic()
+
+    async def _checkpoint(self, job: IngestionJob, force: bool = True) -> None:
+        """
+        Saves the job's record; progress only every few seconds unless forced.
+        A failed save is logged, the job itself carries on.
+        """
+        last = self._saved_at.get(job.job_id)
+        if (
+            not force
+            and last is not None
+            and time.monotonic() - last < PROGRESS_SAVE_INTERVAL_SECONDS
+        ):
+            return
+        try:
+            await self._save(job)
+        except Exception as e:
+            logger.warning(f"Could not save ingestion job {job.job_id}: {e}")
+
+    async def _claim(self, job: IngestionJob, etag: Optional[str]) -> bool:
+        """
+        Stores a new job's record, or replaces the failed or stale record it
+        re-runs. False when another upload of the same file got there first.
+        """
+        container = await get_chat_container()
+        body = job.to_item(USER_ID, self.record_ttl_seconds)
+        try:
+            if etag is None:
+                await container.create_item(
+                    body=body, response_hook=cosmos_response_hook
+                )
+            else:
+                await container.replace_item(
+                    item=body["id"],
+                    body=body,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                    response_hook=cosmos_response_hook,
+                )
+        except (CosmosResourceExistsError, CosmosAccessConditionFailedError):
+            return False
+        self._saved_at[job.job_id] = time.monotonic()
+        return True
+
+    async def get(self, job_id: str) -> Optional[IngestionJob]:
+        """The job as this instance runs it, else as last saved by the one that does."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            job, _ = await self._read(job_id)
+        return job
+
+    def _reusable(self, job: Optional[IngestionJob]) -> bool:
+        """Completed, or still running somewhere; decided on the stored record."""
+        if job is None:
+            return False
+        if job.finished:
+            return job.status == STATUS_COMPLETED
+        return not self._stale(job)
+
+    async def submit(
+        self,
+        chat_id: str,
+        file_path: str,
+        filename: str,
+        content_type: Optional[str],
+        file_size_bytes: int,
+    ) -> IngestionJob:
+        """
+        Queues a staged upload and takes ownership of `file_path`. Returns the
+        already known job if this file was submitted to the chat before and has
+        not failed.
+        """
+        self._purge_finished()
+        fingerprint = await asyncio.to_thread(file_handler.fingerprint_file, file_path)
+        job_id = self.job_id_for(chat_id, fingerprint)
+
+        existing, etag = self._jobs.get(job_id), None
+        if not self._reusable(existing):
+            existing, etag = await self._read(job_id)
+        if self._reusable(existing):
+            logger.info(f"Upload of '{filename}' matches job {job_id}, not re-queued.")
+            file_handler.cleanup_temporary_file(file_path)
+            return existing
+
+        job = IngestionJob(
+            job_id=job_id,
+            chat_id=chat_id,
+            filename=filename,
+            content_type=content_type,
+            file_size_bytes=file_size_bytes,
+            file_path=file_path,
+            correlation_id=correlation_id(),
+        )
+        if not await self._claim(job, etag):
+            logger.info(f"Upload of '{filename}' was just queued as job {job_id}.")
+            file_handler.cleanup_temporary_file(file_path)
+            existing, _ = await self._read(job_id)
+            return existing or job
+
+        if self.backend == BACKEND_STORAGE:
+            await storage_job_queue.stage(job_id, file_path)
+            file_handler.cleanup_temporary_file(file_path)
+            job.file_path = None
+            await storage_job_queue.send(job_id)
+        else:
+            self._jobs[job_id] = job
+            self._ensure_workers().put_nowait(job)
+        increment_counter("ingestion_jobs_submitted")
+        logger.info(f"Queued ingestion job {job_id} for '{filename}' in chat {chat_id}")
+        return job
+
+    async def adelete_chat_jobs(self, chat_id: str) -> int:
+        """Forgets a deleted chat's jobs, their records too. Returns how many."""
+        for job_id, job in list(self._jobs.items()):
+            if job.chat_id == chat_id:
+                del self._jobs[job_id]
+                self._saved_at.pop(job_id, None)
+        container = await get_chat_container()
+        items = container.query_items(
+            query=(
+                "SELECT c.id FROM c "
+                "WHERE IS_DEFINED(c.job_id) AND c.chat_id = @chat_id"
+            ),
+            parameters=[{"name": "@chat_id", "value": chat_id}],
+            partition_key=USER_ID,
+            response_hook=cosmos_response_hook,
+        )
+        deleted = 0
+        for item_id in [item["id"] async for item in items]:
+            try:
+                await container.delete_item(
+                    item=item_id,
+                    partition_key=USER_ID,
+                    response_hook=cosmos_response_hook,
+                )
+                deleted += 1
+            except CosmosResourceNotFoundError:
+                pass
+        return deleted
+
+    async def run_queued(self, job_id: str) -> None:
+        """Runs a job taken off the storage queue, on whichever instance got it."""
+        job, _ = await self._read(job_id)
+        if job is None:
+            logger.warning(f"Queued ingestion job {job_id} has no record, dropped.")
+            return
+        if job.finished:
+            # A message delivered again after the job completed
+            logger.info(f"Ingestion job {job_id} already {job.status}.")
+            await storage_job_queue.discard(job_id)
+            return
+
+        job.file_path = await storage_job_queue.fetch(
+            job_id, suffix=os.path.splitext(job.filename)[1]
+        )
+        self._jobs[job_id] = job
+        await self._run(job)
+        # Only once the job ran; a message whose run was cut short keeps its
+        # blob for the next delivery
+        await storage_job_queue.discard(job_id)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _progress_reporter(job: IngestionJob):
+        def on_progress(embedded: int, indexed: int) -> None:
+            job.update(
+                chunks_embedded=job.chunks_embedded + embedded,
+                chunks_indexed=job.chunks_indexed + indexed,
+            )
+
+        return on_progress
+
+    async def _index_whole_file(self, job: IngestionJob) -> None:
+        with tracer.span("parse"):
+            documents = await file_handler.process_pdf_documents(
+                job.file_path, job.chat_id, job.filename
+            )
+        job.assign_chunk_ids(documents, first=0)
+        job.update(status=STATUS_EMBEDDING, chunks_parsed=len(documents))
+        await self._checkpoint(job)
+        with tracer.span("embed_index", **{"ingestion.chunks": len(documents)}):
+            await vector_store_service.add_documents_to_vector_store(
+                documents, progress=self._progress_reporter(job)
+            )
+
+    async def _index_streaming(self, job: IngestionJob) -> None:
+        """
+        Parses page windows in a producer task and embeds them as they arrive.
+        The bounded queue makes parsing wait when embedding falls behind, so
+        peak memory depends on the window size, not the file size.
+        """
+        windows: asyncio.Queue = asyncio.Queue(
+            maxsize=app_config.INGESTION_QUEUE_WINDOWS
+        )
+
+        async def produce() -> None:
+            stream = file_handler.stream_pdf_documents(
+                job.file_path,
+                job.chat_id,
+                job.filename,
+                page_window=app_config.INGESTION_PAGE_WINDOW,
+            )
+            try:
+                # aclosing: a cancelled producer stops the parse stream at once
+                async with contextlib.aclosing(stream):
+                    with tracer.span("parse"):
+                        async for documents in stream:
+                            job.assign_chunk_ids(documents, first=job.chunks_parsed)
+                            job.update(chunks_parsed=job.chunks_parsed + len(documents))
+                            await windows.put(documents)
+            except asyncio.CancelledError:
+                # The consumer failed and stopped reading; the queue may be
+                # full, so do not wait to put the end marker
+                raise
+            except Exception:
+                await windows.put(None)
+                raise
+            await windows.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (documents := await windows.get()) is not None:
+                if job.status != STATUS_EMBEDDING:
+                    job.update(status=STATUS_EMBEDDING)
+                    await self._checkpoint(job)
+                with tracer.span("embed_index", **{"ingestion.chunks": len(documents)}):
+                    await vector_store_service.add_documents_to_vector_store(
+                        documents, progress=self._progress_reporter(job)
+                    )
+                await self._checkpoint(job, force=False)
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+                await asyncio.gather(producer, return_exceptions=True)
+
+    async def _run(self, job: IngestionJob) -> None:
+        job_metrics = start_request_metrics(
+            "ingestion_job",
+            {CORRELATION_ID_HEADER: job.correlation_id} if job.correlation_id else None,
+        )
+        job_metrics.span.set_attribute("ingestion.job_id", job.job_id)
+        try:
+            job.update(status=STATUS_PARSING)
+            await self._checkpoint(job)
+            if app_config.INGESTION_STREAMING:
+                await self._index_streaming(job)
+            else:
+                await self._index_whole_file(job)
+            vector_store_service.flush_chat(job.chat_id)
+
+            # The chat only lists the file once its chunks are searchable
+            history = await chat_history_service.get_history_instance(
+                session_id=job.chat_id
+            )
+            await history.aadd_files([job.filename])
+            if answer_cache:
+                answer_cache.invalidate_chat(job.chat_id)
+            job.update(status=STATUS_COMPLETED)
+            increment_counter("ingestion_jobs_completed")
+            logger.info(f"Ingestion job {job.job_id} completed.")
+        except Exception as e:
+            detail = e.detail if isinstance(e, FileProcessingError) else str(e)
+            job.update(status=STATUS_FAILED, error=detail)
+            increment_counter("ingestion_jobs_failed")
+            logger.error(f"Ingestion job {job.job_id} failed: {detail}", exc_info=True)
+        finally:
+            file_handler.cleanup_temporary_file(job.file_path)
+            job.file_path = None
+            job_metrics.log()
+        await self._checkpoint(job)
+
+
+ingestion_job_service = IngestionJobService(
+    workers=app_config.INGESTION_WORKERS,
+    retention_seconds=app_config.INGESTION_JOB_RETENTION_SECONDS,
+    stale_seconds=app_config.INGESTION_JOB_STALE_SECONDS,
+    record_ttl_seconds=app_config.INGESTION_JOB_RECORD_TTL_SECONDS,
+    backend=app_config.INGESTION_QUEUE_BACKEND,
+)
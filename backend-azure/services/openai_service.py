@@ -1,70 +1,149 @@
 import logging
-import asyncio
-from typing import AsyncGenerator, List
-from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage, BaseMessage
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+    BaseMessage,
+)
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from core.custom_cosmos_db import CustomCosmosDBChatMessageHistory
-from config import app_config
+from core.openai_router import (
+    DEPLOYMENT_KIND_CHAT,
+    Deployment,
+    DeploymentClients,
+    openai_router,
+)
 from utils.exceptions import OpenAIError
+from utils.metrics import record_token_usage
+from utils.tokens import CHARS_PER_TOKEN, estimate_messages_tokens, estimate_tokens
+from utils.tracing import Span, tracer
 
 logger = logging.getLogger(__name__)
 
 
+def _chat_client(
+    deployment: Deployment, temperature: float, streaming: bool
+) -> BaseChatModel:
+    from langchain_openai import AzureChatOpenAI
+
+    return AzureChatOpenAI(
+        temperature=temperature,
+        streaming=streaming,
+        **openai_router.client_kwargs(deployment),
+    )
+
+
 class OpenAIService:
     def __init__(self):
-        self.model = AzureChatOpenAI(
-            azure_endpoint=app_config.AZURE_OPENAI_ENDPOINT,
-            azure_deployment=app_config.AZURE_OPENAI_DEPLOYMENT_NAME,
-            openai_api_version=app_config.AZURE_OPENAI_API_VERSION,
-            temperature=0.8,
-            streaming=True,
+        # One client pair per chat deployment, created on first use; calls are
+        # routed between them
+        self.models = DeploymentClients(
+            openai_router,
+            DEPLOYMENT_KIND_CHAT,
+            lambda deployment: _chat_client(deployment, 0.8, streaming=True),
         )
-        self.title_model = AzureChatOpenAI(
-            azure_endpoint=app_config.AZURE_OPENAI_ENDPOINT,
-            azure_deployment=app_config.AZURE_OPENAI_DEPLOYMENT_NAME,
-            openai_api_version=app_config.AZURE_OPENAI_API_VERSION,
-            temperature=0.5,
-            streaming=False,
+        self.title_models = DeploymentClients(
+            openai_router,
+            DEPLOYMENT_KIND_CHAT,
+            lambda deployment: _chat_client(deployment, 0.5, streaming=False),
+        )
+
+    @staticmethod
+    def system_prompt(context: str) -> str:
+        return (
+            "You are a helpful AI assistant. Answer the user's questions based on the provided context if available, otherwise feel free to use your knowledge."
+            f"\n\nContext: {context}"
         )
 
+    @staticmethod
+    def _record_usage(
+        span: Span,
+        usage: Optional[Dict[str, Any]],
+        estimated_input: int,
+        estimated_output: int,
+    ) -> int:
+        """
+        Puts a call's token usage on its span and the request, estimated when
+        the response did not report it. Returns the output tokens.
+        """
+        if usage:
+            input_tokens, output_tokens = usage["input_tokens"], usage["output_tokens"]
+        else:
+            input_tokens, output_tokens = estimated_input, estimated_output
+            span.set_attribute("gen_ai.usage.estimated", True)
+        span.set_attribute("gen_ai.usage.input_tokens", input_tokens)
+        span.set_attribute("gen_ai.usage.output_tokens", output_tokens)
+        record_token_usage(input_tokens, output_tokens)
+        return output_tokens
+
     async def generate_response_stream(
-        self, prompt: str, chat_history: CustomCosmosDBChatMessageHistory, context: str
+        self, prompt: str, chat_history: List[BaseMessage], context: str
     ) -> AsyncGenerator[str, None]:
         """
-        Generates a streaming response from OpenAI based on prompt, chat history, and context.
+        Generates a streaming response from OpenAI based on prompt, the chat's
+        previous messages, and context.
         """
-        system_prompt_template = (
-            "You are a helpful AI assistant. Answer the user's questions based on the provided context if available, otherwise feel free to use your knowledge."
-            f"\n\nContext: {context}"
-        )
         prompt_template = ChatPromptTemplate.from_messages(
             [
-                SystemMessage(content=system_prompt_template),
+                SystemMessage(content=self.system_prompt(context)),
                 MessagesPlaceholder(variable_name="chat_history"),
                 HumanMessage(content=prompt),
             ]
         )
 
-        chain = (
-            RunnablePassthrough.assign(
-                chat_history=RunnableLambda(lambda x: chat_history.messages),
+        span = tracer.start_span("llm_stream")
+
+        def stream(deployment: Deployment):
+            span.set_attribute("gen_ai.deployment", deployment.name)
+            chain = (
+                RunnablePassthrough.assign(
+                    chat_history=RunnableLambda(lambda x: chat_history),
+                )
+                | prompt_template
+                | self.models.get(deployment)
             )
-            | prompt_template
-            | self.model
-        )
+            return chain.astream({"input": prompt})
 
+        estimated_tokens = estimate_messages_tokens(
+            [SystemMessage(content=self.system_prompt(context)), *chat_history]
+        ) + estimate_tokens(prompt)
+        started = time.perf_counter()
+        first_token_at = None
+        answer_chars = 0
+        usage = None
         try:
-            async for chunk in chain.astream({"input": prompt}):
+            async for chunk in openai_router.stream(
+                DEPLOYMENT_KIND_CHAT, stream, estimated_tokens
+            ):
+                usage = chunk.usage_metadata or usage
                 if chunk.content:
-                    yield chunk.content.encode("utf-8")
-                    await asyncio.sleep(0.05)
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        span.set_attribute(
+                            "time_to_first_token_ms", (first_token_at - started) * 1000
+                        )
+                    answer_chars += len(chunk.content)
+                    yield chunk.content
         except Exception as e:
+            span.record_error(e)
             logger.error(f"Error during AI streaming: {e}", exc_info=True)
             raise OpenAIError(
                 status_code=500, detail=f"Error generating AI response: {e}"
             )
+        finally:
+            finished = time.perf_counter()
+            output_tokens = self._record_usage(
+                span, usage, estimated_tokens, answer_chars // CHARS_PER_TOKEN
+            )
+            span.set_attribute("stream_duration_ms", (finished - started) * 1000)
+            if first_token_at is not None and finished > first_token_at:
+                span.set_attribute(
+                    "tokens_per_second", output_tokens / (finished - first_token_at)
+                )
+            span.end()
 
     async def generate_chat_title(self, prompt: str) -> str:
         title_prompt: List[BaseMessage] = [
@@ -87,7 +166,19 @@ class OpenAIService:
             ),
         ]
         try:
-            title_response = await self.title_model.ainvoke(title_prompt)
+            with tracer.span("title_generation") as span:
+                estimated_tokens = estimate_messages_tokens(title_prompt)
+                title_response = await openai_router.call(
+                    DEPLOYMENT_KIND_CHAT,
+                    lambda d: self.title_models.get(d).ainvoke(title_prompt),
+                    estimated_tokens,
+                )
+                self._record_usage(
+                    span,
+                    title_response.usage_metadata,
+                    estimated_tokens,
+                    estimate_tokens(title_response.content),
+                )
             return title_response.content
         except Exception as e:
             logger.error(f"Error generating chat title: {e}", exc_info=True)
@@ -95,5 +186,56 @@ class OpenAIService:
                 status_code=500, detail=f"Error generating chat title: {e}"
             )
 
+    async def summarize_conversation(
+        self,
+        previous_summary: Optional[str],
+        messages: List[BaseMessage],
+        max_tokens: int,
+    ) -> str:
+        """Folds `messages` into the running summary of a conversation."""
+        transcript = "\n".join(
+            f"{'Assistant' if isinstance(m, AIMessage) else 'User'}: {m.content}"
+            for m in messages
+        )
+        summary_prompt: List[BaseMessage] = [
+            SystemMessage(
+                content=(
+                    "You maintain a running summary of a conversation between a user "
+                    "and an AI assistant. Update the summary with the new messages. "
+                    "Keep facts, names, numbers, decisions and open questions the "
+                    "assistant may need later; drop greetings and repetition. "
+                    f"Answer with the summary only, in under {max_tokens} tokens."
+                )
+            ),
+            HumanMessage(
+                content=(
+                    f"Current summary:\n{previous_summary or '(none)'}"
+                    f"\n\nNew messages:\n{transcript}"
+                )
+            ),
+        ]
+        try:
+            with tracer.span("history_summary") as span:
+                estimated_tokens = estimate_messages_tokens(summary_prompt)
+                response = await openai_router.call(
+                    DEPLOYMENT_KIND_CHAT,
+                    lambda d: self.title_models.get(d).ainvoke(
+                        summary_prompt, max_tokens=max_tokens
+                    ),
+                    estimated_tokens + max_tokens,
+                )
+                self._record_usage(
+                    span,
+                    response.usage_metadata,
+                    estimated_tokens,
+                    estimate_tokens(response.content),
+                )
+            return response.content
+        except Exception as e:
+            logger.error(f"Error summarizing conversation: {e}", exc_info=True)
+            raise OpenAIError(
+                status_code=500, detail=f"Error summarizing conversation: {e}"
+            )
+
 
 openai_service = OpenAIService()
@@ -1,27 +1,131 @@
+import asyncio
 import logging
-from typing import List, Tuple
-from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
-    PreFilter,
-    Condition,
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from azure.cosmos.exceptions import (
+    CosmosBatchOperationError,
+    CosmosResourceNotFoundError,
 )
 from langchain_core.documents import Document
 
-from core.vector_stores import create_vector_search
+from config import app_config
+from core.answer_cache import files_key
+from core.embedding_cache import embedding_cache
+from core.embedding_pipeline import EmbeddingPipeline
+from core.local_vector_index import ChatVectorIndex, local_vector_index
+from core.retrieval import (
+    Candidate,
+    dedupe_overlapping,
+    reciprocal_rank_fusion,
+    search_terms,
+    select_adaptive,
+)
+from core.vector_stores import (
+    VECTOR_LAYOUT_CHAT,
+    create_vector_search,
+    get_async_vector_container,
+    openai_embeddings,
+    partition_layout,
+)
+from utils.background import spawn_background
+from utils.metrics import cosmos_response_hook, increment_counter
+from utils.tracing import tracer
+
+if TYPE_CHECKING:
+    # LangChain community takes a third of a second to import; it is loaded
+    # with the vector store, on first use
+    from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+        AzureCosmosDBNoSqlVectorSearch,
+        PreFilter,
+    )
 
 logger = logging.getLogger(__name__)
 
+VECTOR_BACKEND_LOCAL = "local"
+VECTOR_BACKEND_CACHED = "cached"
+RETRIEVAL_MODE_VECTOR = "vector"
+RETRIEVAL_MODE_HYBRID = "hybrid"
+# Neighbouring chunks share up to the splitter's 150 character overlap
+CHUNK_MIN_OVERLAP = 50
+CHUNK_MAX_OVERLAP = 200
+FULL_TEXT_MAX_TERMS = 16
+# Deletes are scheduled in slices so huge chats do not create one task per item
+DELETE_SLICE_SIZE = 500
+# Cosmos DB limit of operations in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+# Well below the 8191 token input limit of the embedding models, even for text
+# that tokenizes densely; the start of a long prompt is enough to retrieve by
+QUERY_EMBEDDING_MAX_CHARS = 16000
+
 
 class VectorStoreService:
     def __init__(self):
-        self.vector_search = create_vector_search()
+        self.backend = app_config.VECTOR_BACKEND
+        self.local_index = local_vector_index
+        # Created on first use (or by the startup warm-up): it connects to
+        # Cosmos DB and creates or verifies the container
+        self._vector_search: Optional["AzureCosmosDBNoSqlVectorSearch"] = None
+        self._vector_search_lock = threading.Lock()
+        # Chats whose cached index is being loaded; False once a write made the
+        # load stale
+        self._warming: Dict[str, bool] = {}
+        self.native_async = app_config.VECTOR_SEARCH_NATIVE_ASYNC
+        self.retrieval_mode = app_config.RETRIEVAL_MODE
+        self.partition_layout = partition_layout
+        self._executor = ThreadPoolExecutor(
+            max_workers=app_config.VECTOR_SEARCH_MAX_WORKERS,
+            thread_name_prefix="vector-search",
+        )
+        self.embedding_pipeline = EmbeddingPipeline(
+            embeddings=openai_embeddings,
+            writer=self._write_items,
+            max_batch_tokens=app_config.EMBEDDING_BATCH_MAX_TOKENS,
+            max_batch_inputs=app_config.EMBEDDING_BATCH_MAX_INPUTS,
+            max_concurrency=app_config.EMBEDDING_MAX_CONCURRENCY,
+            max_retries=app_config.EMBEDDING_MAX_RETRIES,
+            cache=embedding_cache,
+        )
+        self._write_semaphore = asyncio.Semaphore(app_config.VECTOR_WRITE_CONCURRENCY)
+        self._delete_semaphore = asyncio.Semaphore(app_config.VECTOR_DELETE_CONCURRENCY)
 
-    def similarity_search_with_filter(
-        self, query: str, chat_id: str, k: int = 3
-    ) -> List[Tuple[Document, float]]:
+    @property
+    def vector_search(self) -> Optional["AzureCosmosDBNoSqlVectorSearch"]:
         """
-        Performs a similarity search with a pre-filter for a specific chat_id.
+        The LangChain vector store, or None on the local backend, which never
+        touches the Cosmos DB vector container.
         """
-        id_filter = PreFilter(
+        if self._vector_search is None and self.backend != VECTOR_BACKEND_LOCAL:
+            with self._vector_search_lock:
+                if self._vector_search is None:
+                    self._vector_search = create_vector_search()
+        return self._vector_search
+
+    async def aget_vector_search(self) -> Optional["AzureCosmosDBNoSqlVectorSearch"]:
+        """`vector_search`, created on the thread pool if this is its first use."""
+        if self._vector_search is not None or self.backend == VECTOR_BACKEND_LOCAL:
+            return self._vector_search
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, lambda: self.vector_search
+        )
+
+    @staticmethod
+    def _chat_filter(chat_id: str) -> "PreFilter":
+        from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+            Condition,
+            PreFilter,
+        )
+
+        return PreFilter(
             conditions=[
                 Condition(
                     property="metadata.chat_id",
@@ -30,26 +134,476 @@ class VectorStoreService:
                 )
             ]
         )
+
+    def _chat_scope(self, chat_id: str) -> Dict[str, Any]:
+        """Query options that keep a chat's query inside its partition, if it has one."""
+        if self.partition_layout == VECTOR_LAYOUT_CHAT:
+            return {"partition_key": str(chat_id)}
+        return {}
+
+    @staticmethod
+    def _to_document_with_score(item: Dict[str, Any]) -> Tuple[Document, float]:
+        """Maps a vector query row the same way AzureCosmosDBNoSqlVectorSearch does."""
+        metadata = item.get("metadata") or {}
+        metadata["id"] = item["id"]
+        return (
+            Document(page_content=item["text"], metadata=metadata),
+            item.get("SimilarityScore", 0.0),
+        )
+
+    def similarity_search_with_filter(
+        self, query: str, chat_id: str, k: int = 3
+    ) -> List[Tuple[Document, float]]:
+        """
+        Performs a similarity search with a pre-filter for a specific chat_id.
+        """
         documents_with_scores = self.vector_search.similarity_search_with_score(
-            query=query, k=k, pre_filter=id_filter
+            query=query, k=k, pre_filter=self._chat_filter(chat_id)
         )
         logger.debug(
             f"Found {len(documents_with_scores)} documents for chat ID {chat_id}"
         )
         return documents_with_scores
 
-    async def add_documents_to_vector_store(self, documents: List[Document]):
-        """Adds documents to the vector store."""
-        await self.vector_search.aadd_documents(documents=documents)
+    async def aembed_query(self, query: str) -> List[float]:
+        with tracer.span("query_embedding"):
+            return await openai_embeddings.aembed_query(
+                query[:QUERY_EMBEDDING_MAX_CHARS]
+            )
+
+    def _local_search(
+        self,
+        chat_id: str,
+        embedding: List[float],
+        k: int,
+        files: Optional[Iterable[str]] = None,
+    ) -> Optional[List[Tuple[Document, float]]]:
+        """
+        Searches the in-process index. Returns None when the cached backend
+        does not hold the chat yet, after scheduling it to be loaded. With
+        `files`, the chat's current file list, a cached index loaded for other
+        files is a miss too, so uploads indexed by another instance show up
+        before the cache expires.
+        """
+        if self.backend == VECTOR_BACKEND_LOCAL:
+            return self.local_index.search(chat_id, embedding, k) or []
+        version = files_key(files) if files is not None else None
+        hits = self.local_index.search(chat_id, embedding, k, version)
+        if hits is None:
+            increment_counter("vector_cache_misses")
+            self._schedule_warm(chat_id, version)
+            return None
+        increment_counter("vector_cache_hits")
+        return hits
+
+    def _schedule_warm(self, chat_id: str, version: Any = None) -> None:
+        if chat_id in self._warming:
+            return
+        self._warming[chat_id] = True
+        spawn_background(
+            self._warm_cache(chat_id, version), name=f"warm-vectors-{chat_id}"
+        )
+
+    async def _warm_cache(self, chat_id: str, version: Any = None) -> None:
+        """Loads a chat's chunks and embeddings from Cosmos DB into the cache."""
+        try:
+            container = await get_async_vector_container()
+            items = container.query_items(
+                query=(
+                    "SELECT c.id, c.text, c.metadata, c.embedding FROM c "
+                    "WHERE c.metadata.chat_id = @chat_id"
+                ),
+                parameters=[{"name": "@chat_id", "value": chat_id}],
+                response_hook=cosmos_response_hook,
+                **self._chat_scope(chat_id),
+            )
+            rows = [item async for item in items]
+            if not self._warming.get(chat_id):
+                return
+            index = ChatVectorIndex(len(rows[0]["embedding"]) if rows else 0)
+            if rows:
+                index.add(
+                    [row["id"] for row in rows],
+                    [row["text"] for row in rows],
+                    [row.get("metadata") or {} for row in rows],
+                    [row["embedding"] for row in rows],
+                )
+            self.local_index.put(chat_id, index, version)
+            logger.debug(f"Cached {len(rows)} vectors of chat {chat_id}")
+        finally:
+            self._warming.pop(chat_id, None)
+
+    def _invalidate_cached(self, chat_id: str) -> None:
+        if chat_id in self._warming:
+            self._warming[chat_id] = False
+        self.local_index.remove_chat(chat_id)
+
+    def _similarity_search_by_vector(
+        self, embedding: List[float], chat_id: str, k: int
+    ) -> List[Tuple[Document, float]]:
+        from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+            CosmosDBQueryType,
+        )
+
+        return self.vector_search._similarity_search_with_score(
+            query_type=CosmosDBQueryType.VECTOR,
+            embeddings=embedding,
+            k=k,
+            pre_filter=self._chat_filter(chat_id),
+        )
+
+    async def asimilarity_search_with_filter(
+        self,
+        query: str,
+        chat_id: str,
+        k: int = 3,
+        embedding: Optional[List[float]] = None,
+        files: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Non-blocking similarity_search_with_filter. Embeds the query with the async
+        Azure OpenAI client and runs the vector query on the async Cosmos client,
+        or falls back to the sync search on a bounded thread pool. Pass
+        `embedding` when the query was already embedded. The local and cached
+        backends answer from the in-process index when they hold the chat;
+        `files` lets the cached backend check it holds the chat's current files.
+        """
+        if self.local_index is not None:
+            if embedding is None:
+                embedding = await self.aembed_query(query)
+            hits = self._local_search(str(chat_id), embedding, k, files)
+            if hits is not None:
+                return hits
+
+        if not self.native_async:
+            loop = asyncio.get_running_loop()
+            if embedding is not None:
+                return await loop.run_in_executor(
+                    self._executor,
+                    self._similarity_search_by_vector,
+                    embedding,
+                    chat_id,
+                    k,
+                )
+            return await loop.run_in_executor(
+                self._executor,
+                self.similarity_search_with_filter,
+                query,
+                chat_id,
+                k,
+            )
+
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+        vector_search = await self.aget_vector_search()
+        from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+            CosmosDBQueryType,
+        )
+
+        sql_query, parameters = vector_search._construct_query(
+            k=k,
+            query_type=CosmosDBQueryType.VECTOR,
+            embeddings=embedding,
+            pre_filter=self._chat_filter(chat_id),
+        )
+        container = await get_async_vector_container()
+        items = container.query_items(
+            query=sql_query,
+            parameters=parameters,
+            response_hook=cosmos_response_hook,
+            **self._chat_scope(chat_id),
+        )
+        documents_with_scores = [
+            self._to_document_with_score(item) async for item in items
+        ]
+        logger.debug(
+            f"Found {len(documents_with_scores)} documents for chat ID {chat_id}"
+        )
+        return documents_with_scores
+
+    async def afull_text_search_with_filter(
+        self, query: str, chat_id: str, k: int
+    ) -> List[Tuple[Document, float]]:
+        """
+        Full-text ranked search (BM25 on /text) within a chat, best match first.
+        The local backend has no full-text index, so hybrid retrieval degrades
+        to vector ranking there.
+        """
+        if self.backend == VECTOR_BACKEND_LOCAL:
+            return []
+        terms = search_terms(query, FULL_TEXT_MAX_TERMS)
+        if not terms:
+            return []
+        vector_search = await self.aget_vector_search()
+        from langchain_community.vectorstores.azure_cosmos_db_no_sql import (
+            CosmosDBQueryType,
+        )
+
+        sql_query, parameters = vector_search._construct_query(
+            k=k,
+            query_type=CosmosDBQueryType.FULL_TEXT_RANK,
+            search_text=" ".join(terms),
+            pre_filter=self._chat_filter(chat_id),
+        )
+        if not self.native_async:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                lambda: vector_search._execute_query(
+                    query=sql_query,
+                    query_type=CosmosDBQueryType.FULL_TEXT_RANK,
+                    parameters=parameters,
+                    with_embedding=False,
+                    projection_mapping=None,
+                ),
+            )
+        container = await get_async_vector_container()
+        items = container.query_items(
+            query=sql_query,
+            parameters=parameters,
+            response_hook=cosmos_response_hook,
+            **self._chat_scope(chat_id),
+        )
+        return [self._to_document_with_score(item) async for item in items]
+
+    async def ahybrid_search_with_filter(
+        self,
+        query: str,
+        chat_id: str,
+        embedding: List[float],
+        files: Optional[Iterable[str]] = None,
+    ) -> Tuple[List[Tuple[Document, float]], Dict[str, float]]:
+        """
+        Runs vector and full-text search side by side and fuses the two rankings
+        with reciprocal rank fusion. Returns (document, fused score) pairs, best
+        first, and the vector similarity of every chunk the vector search found.
+        """
+        candidates = app_config.RETRIEVAL_CANDIDATES
+        vector_hits, text_hits = await asyncio.gather(
+            self.asimilarity_search_with_filter(
+                query=query,
+                chat_id=chat_id,
+                k=candidates,
+                embedding=embedding,
+                files=files,
+            ),
+            self.afull_text_search_with_filter(query, chat_id, k=candidates),
+        )
+        documents: Dict[str, Document] = {}
+        similarities: Dict[str, float] = {}
+        for document, score in vector_hits:
+            documents[document.metadata["id"]] = document
+            similarities[document.metadata["id"]] = score
+        for document, _ in text_hits:
+            documents.setdefault(document.metadata["id"], document)
+
+        fused = reciprocal_rank_fusion(
+            [
+                [document.metadata["id"] for document, _ in vector_hits],
+                [document.metadata["id"] for document, _ in text_hits],
+            ],
+            k=app_config.RETRIEVAL_RRF_K,
+        )
+        return [
+            (documents[doc_id], score)
+            for doc_id, score in sorted(fused.items(), key=lambda kv: -kv[1])
+        ], similarities
+
+    async def aretrieve(
+        self,
+        query: str,
+        chat_id: str,
+        embedding: Optional[List[float]] = None,
+        files: Optional[Iterable[str]] = None,
+    ) -> List[Tuple[Document, float]]:
+        """
+        Context retrieval for a prompt: vector or hybrid search depending on
+        RETRIEVAL_MODE, then an adaptive number of chunks with overlapping
+        neighbours merged. `files` is the chat's file list, see `_local_search`.
+        """
+        if embedding is None:
+            embedding = await self.aembed_query(query)
+
+        with tracer.span(
+            "vector_search",
+            **{"retrieval.mode": self.retrieval_mode, "vector.backend": self.backend},
+        ) as span:
+            if self.retrieval_mode == RETRIEVAL_MODE_HYBRID:
+                ranked, similarities = await self.ahybrid_search_with_filter(
+                    query, chat_id, embedding, files
+                )
+                candidates = [
+                    Candidate(
+                        document=document,
+                        fused_score=score,
+                        similarity=similarities.get(document.metadata["id"]),
+                    )
+                    for document, score in ranked
+                ]
+            else:
+                hits = await self.asimilarity_search_with_filter(
+                    query=query,
+                    chat_id=chat_id,
+                    k=app_config.RETRIEVAL_CANDIDATES,
+                    embedding=embedding,
+                    files=files,
+                )
+                candidates = [
+                    Candidate(document=document, fused_score=score, similarity=score)
+                    for document, score in hits
+                ]
+            span.set_attribute("retrieval.candidates", len(candidates))
+
+        selected = select_adaptive(
+            candidates,
+            min_k=app_config.RETRIEVAL_MIN_K,
+            max_k=app_config.RETRIEVAL_MAX_K,
+            relative_score=app_config.RETRIEVAL_RELATIVE_SCORE,
+            min_similarity=app_config.RETRIEVAL_MIN_SIMILARITY,
+        )
+        selected = dedupe_overlapping(selected, CHUNK_MIN_OVERLAP, CHUNK_MAX_OVERLAP)
+        logger.debug(
+            f"Retrieved {len(selected)} of {len(candidates)} candidate chunks "
+            f"for chat {chat_id} ({self.retrieval_mode})"
+        )
+        return [(c.document, c.fused_score) for c in selected]
+
+    async def _write_items(self, items: List[Dict[str, Any]]) -> None:
+        """Writes a batch of embedded items concurrently on the async client."""
+        chat_ids = {str(item["metadata"]["chat_id"]) for item in items}
+        if self.backend == VECTOR_BACKEND_LOCAL:
+            for chat_id in chat_ids:
+                chat_items = [
+                    item
+                    for item in items
+                    if str(item["metadata"]["chat_id"]) == chat_id
+                ]
+                self.local_index.add(
+                    chat_id,
+                    [item["id"] for item in chat_items],
+                    [item["text"] for item in chat_items],
+                    [item["metadata"] for item in chat_items],
+                    [item["embedding"] for item in chat_items],
+                )
+            return
+
+        container = await get_async_vector_container()
+
+        async def write(item: Dict[str, Any]) -> None:
+            async with self._write_semaphore:
+                await container.upsert_item(
+                    body=item, response_hook=cosmos_response_hook
+                )
+
+        with tracer.span(
+            "cosmos_write", **{"db.operation": "upsert_vectors", "items": len(items)}
+        ):
+            await asyncio.gather(*(write(item) for item in items))
+        if self.local_index is not None:
+            for chat_id in chat_ids:
+                self._invalidate_cached(chat_id)
+
+    async def add_documents_to_vector_store(
+        self,
+        documents: List[Document],
+        progress: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Adds documents to the vector store. On the local backend they reach
+        disk on `flush_chat`, which uploads call once after their last batch.
+        """
+        await self.embedding_pipeline.run(documents, progress=progress)
         logger.info(f"Added {len(documents)} documents to vector store.")
 
-    def delete_documents_by_id(self, doc_ids: List[str]):
-        """Deletes documents from the vector store by their IDs."""
-        if doc_ids:
-            self.vector_search.delete(doc_ids)
-            logger.info(f"Deleted {len(doc_ids)} documents from vector store.")
+    def flush_chat(self, chat_id: str) -> None:
+        """Persists the chunks the local backend holds unsaved for a chat."""
+        if self.backend == VECTOR_BACKEND_LOCAL:
+            self.local_index.flush(str(chat_id))
+
+    async def adelete_documents_by_id(
+        self, doc_ids: List[str], partition_key: Optional[str] = None
+    ) -> int:
+        """
+        Deletes documents on the async client with bounded concurrency. Ids
+        that are already gone are skipped. Returns the number deleted.
+        `partition_key` is required when the documents are not partitioned by id.
+        """
+        container = await get_async_vector_container()
+
+        async def delete(doc_id: str) -> bool:
+            async with self._delete_semaphore:
+                try:
+                    await container.delete_item(
+                        item=doc_id,
+                        partition_key=partition_key or doc_id,
+                        response_hook=cosmos_response_hook,
+                    )
+                except CosmosResourceNotFoundError:
+                    return False
+                return True
+
+        deleted = 0
+        for start in range(0, len(doc_ids), DELETE_SLICE_SIZE):
+            results = await asyncio.gather(
+                *(
+                    delete(doc_id)
+                    for doc_id in doc_ids[start : start + DELETE_SLICE_SIZE]
+                )
+            )
+            deleted += sum(results)
+        return deleted
+
+    async def _adelete_in_batches(self, chat_id: str, doc_ids: List[str]) -> int:
+        """
+        Deletes documents of one chat partition in transactional batches. A
+        batch that fails, e.g. because one of its items is already gone, is
+        retried item by item.
+        """
+        container = await get_async_vector_container()
+
+        async def delete_batch(batch: List[str]) -> int:
+            async with self._delete_semaphore:
+                try:
+                    await container.execute_item_batch(
+                        batch_operations=[("delete", (doc_id,)) for doc_id in batch],
+                        partition_key=chat_id,
+                        response_hook=cosmos_response_hook,
+                    )
+                    return len(batch)
+                except CosmosBatchOperationError:
+                    pass
+            return await self.adelete_documents_by_id(batch, partition_key=chat_id)
+
+        results = await asyncio.gather(
+            *(
+                delete_batch(doc_ids[start : start + MAX_BATCH_OPERATIONS])
+                for start in range(0, len(doc_ids), MAX_BATCH_OPERATIONS)
+            )
+        )
+        return sum(results)
+
+    async def adelete_chat_documents(self, chat_id: str) -> int:
+        """Deletes every vector document of a chat, returns how many were deleted."""
+        if self.backend == VECTOR_BACKEND_LOCAL:
+            deleted = self.local_index.remove_chat(str(chat_id))
+            logger.info(f"Deleted {deleted} local vectors of chat {chat_id}.")
+            return deleted
+
+        container = await get_async_vector_container()
+        items = container.query_items(
+            query="SELECT c.id FROM c WHERE c.metadata.chat_id = @chat_id",
+            parameters=[{"name": "@chat_id", "value": str(chat_id)}],
+            response_hook=cosmos_response_hook,
+            **self._chat_scope(chat_id),
+        )
+        doc_ids = [item["id"] async for item in items]
+        if self.partition_layout == VECTOR_LAYOUT_CHAT:
+            deleted = await self._adelete_in_batches(str(chat_id), doc_ids)
         else:
-            logger.info("No document IDs provided for deletion.")
+            deleted = await self.adelete_documents_by_id(doc_ids)
+        if self.local_index is not None:
+            self._invalidate_cached(str(chat_id))
+        logger.info(f"Deleted {deleted} vector documents of chat {chat_id}.")
+        return deleted
 
 
 vector_store_service = VectorStoreService()
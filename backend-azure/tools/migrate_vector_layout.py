@@ -0,0 +1,108 @@
+"""
+Copies vector documents into a container with another partition layout, e.g.
+from the id-partitioned container to a chat-partitioned one:
+
+    cd backend-azure
+    python -m tools.migrate_vector_layout \\
+        --source langchain_python_container --source-layout id \\
+        --target langchain_python_container_by_chat --target-layout chat
+
+Items keep their ids and are upserted, so an interrupted run can simply be
+repeated. Once it is done, set VECTOR_PARTITION_LAYOUT (and
+COSMOS_VECTOR_CONTAINER_NAME if not using the default name) to the target,
+and delete the source container when nothing reads it anymore.
+"""
+
+import argparse
+import asyncio
+import logging
+
+from core.cosmos_client import close_async_client
+from core.vector_stores import (
+    PARTITION_KEY_PATHS,
+    VECTOR_LAYOUT_CHAT,
+    get_async_vector_container,
+)
+
+logger = logging.getLogger("migrate_vector_layout")
+
+
+def _copyable(item: dict) -> dict:
+    """Drops Cosmos system properties so the item can be written elsewhere."""
+    return {key: value for key, value in item.items() if not key.startswith("_")}
+
+
+async def migrate(
+    source_name: str,
+    source_layout: str,
+    target_name: str,
+    target_layout: str,
+    concurrency: int,
+    dry_run: bool,
+) -> None:
+    source = await get_async_vector_container(source_name, source_layout)
+    target = await get_async_vector_container(target_name, target_layout)
+    semaphore = asyncio.Semaphore(concurrency)
+    copied = skipped = 0
+    pending = set()
+
+    async def copy(item: dict) -> None:
+        nonlocal copied
+        async with semaphore:
+            if not dry_run:
+                await target.upsert_item(body=_copyable(item))
+            copied += 1
+            if copied % 1000 == 0:
+                logger.info(f"Copied {copied} documents...")
+
+    async for item in source.read_all_items(max_item_count=1000):
+        if target_layout == VECTOR_LAYOUT_CHAT and not (item.get("metadata") or {}).get(
+            "chat_id"
+        ):
+            skipped += 1
+            logger.warning(f"Skipping {item['id']}: no metadata.chat_id")
+            continue
+        task = asyncio.create_task(copy(item))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        if len(pending) >= concurrency * 4:
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    if pending:
+        await asyncio.gather(*pending)
+
+    logger.info(
+        f"{'Would copy' if dry_run else 'Copied'} {copied} documents from "
+        f"{source_name} to {target_name}, skipped {skipped}."
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--source", required=True, help="source container name")
+    parser.add_argument("--source-layout", choices=PARTITION_KEY_PATHS, default="id")
+    parser.add_argument("--target", required=True, help="target container name")
+    parser.add_argument(
+        "--target-layout", choices=PARTITION_KEY_PATHS, default=VECTOR_LAYOUT_CHAT
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    async def run() -> None:
+        try:
+            await migrate(
+                args.source,
+                args.source_layout,
+                args.target,
+                args.target_layout,
+                args.concurrency,
+                args.dry_run,
+            )
+        finally:
+            await close_async_client()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
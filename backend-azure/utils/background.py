@@ -0,0 +1,26 @@
+# utils/background.py
+import asyncio
+import logging
+from typing import Coroutine, Set
+
+logger = logging.getLogger(__name__)
+
+# Strong references so fire-and-forget tasks are not garbage collected mid-run
+_background_tasks: Set[asyncio.Task] = set()
+
+
+def _on_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(
+            f"Background task {task.get_name()} failed: {task.exception()}",
+            exc_info=task.exception(),
+        )
+
+
+def spawn_background(coro: Coroutine, name: str) -> asyncio.Task:
+    """Runs a coroutine off the request's critical path."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_done)
+    return task
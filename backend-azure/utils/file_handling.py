@@ -1,15 +1,22 @@
 # utils/file_handling.py
+import asyncio
+import contextlib
+import hashlib
 import os
 import tempfile
 import logging
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
 from fastapi import UploadFile
-from core.file_processor import file_processor
+from config import app_config
+from core.embedding_cache import file_chunk_cache
+from core.parse_executor import DocumentLimitError, parse_executor
 from langchain_core.documents import Document
 from utils.exceptions import FileProcessingError
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_READ_SIZE = 1024 * 1024
+
 
 class FileHandler:
     @staticmethod
@@ -23,6 +30,11 @@ class FileHandler:
             )
         if uploaded_file.size == 0:
             raise FileProcessingError(status_code=400, detail="Uploaded file is empty.")
+        if uploaded_file.size and uploaded_file.size > app_config.UPLOAD_MAX_BYTES:
+            raise FileProcessingError(
+                status_code=413,
+                detail=f"Uploaded file exceeds {app_config.UPLOAD_MAX_BYTES} bytes.",
+            )
 
         temp_file_path = None
         try:
@@ -31,7 +43,7 @@ class FileHandler:
             ) as temp_file:
                 temp_file_path = temp_file.name
                 while True:
-                    chunk = await uploaded_file.read(8192)
+                    chunk = await uploaded_file.read(UPLOAD_READ_SIZE)
                     if not chunk:
                         break
                     temp_file.write(chunk)
@@ -50,19 +62,111 @@ class FileHandler:
             )
 
     @staticmethod
-    def process_pdf_documents(
+    def fingerprint_file(file_path: str) -> str:
+        """Returns the SHA-256 of a file's contents."""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    async def process_pdf_documents(
         file_path: str, chat_id: str, filename: str
     ) -> List[Document]:
         """
         Processes a PDF file into Langchain documents and adds metadata.
+        Parsing runs in the parser process pool; files uploaded before reuse
+        their cached chunks instead of being parsed.
         """
         try:
-            documents = file_processor(file_path)
+            fingerprint = None
+            documents = None
+            if file_chunk_cache:
+                fingerprint = await asyncio.to_thread(
+                    FileHandler.fingerprint_file, file_path
+                )
+                documents = await asyncio.to_thread(file_chunk_cache.get, fingerprint)
+            if documents is None:
+                documents = await parse_executor.parse(file_path)
+                if file_chunk_cache:
+                    await asyncio.to_thread(
+                        file_chunk_cache.put, fingerprint, documents
+                    )
+            else:
+                logger.info(f"Reusing cached chunks for '{filename}'.")
             for doc in documents:
                 doc.metadata["chat_id"] = chat_id
                 doc.metadata["filename"] = filename
             logger.info(f"Processed {len(documents)} documents from '{filename}'.")
             return documents
+        except DocumentLimitError as e:
+            raise FileProcessingError(status_code=413, detail=str(e))
+        except asyncio.TimeoutError:
+            raise FileProcessingError(
+                status_code=504,
+                detail=f"Processing '{filename}' took too long and was stopped.",
+            )
+        except Exception as e:
+            logger.error(f"Error processing PDF '{filename}': {e}", exc_info=True)
+            raise FileProcessingError(
+                status_code=500, detail=f"Failed to process PDF: {e}"
+            )
+
+    @staticmethod
+    def _add_upload_metadata(
+        documents: List[Document], chat_id: str, filename: str
+    ) -> List[Document]:
+        for doc in documents:
+            doc.metadata["chat_id"] = chat_id
+            doc.metadata["filename"] = filename
+        return documents
+
+    @staticmethod
+    async def stream_pdf_documents(
+        file_path: str, chat_id: str, filename: str, page_window: int
+    ) -> AsyncIterator[List[Document]]:
+        """
+        Like process_pdf_documents, but yields chunks one window of pages at a
+        time so only a window of the document is held in memory. Only the
+        chunks' text and metadata are kept for the file cache, which is filled
+        once the whole file was parsed.
+        """
+        try:
+            fingerprint = None
+            if file_chunk_cache:
+                fingerprint = await asyncio.to_thread(
+                    FileHandler.fingerprint_file, file_path
+                )
+                documents = await asyncio.to_thread(file_chunk_cache.get, fingerprint)
+                if documents is not None:
+                    logger.info(f"Reusing cached chunks for '{filename}'.")
+                    yield FileHandler._add_upload_metadata(documents, chat_id, filename)
+                    return
+
+            total = 0
+            cached_chunks = []
+            windows = parse_executor.parse_stream(file_path, page_window)
+            async with contextlib.aclosing(windows):
+                async for documents in windows:
+                    total += len(documents)
+                    if fingerprint:
+                        cached_chunks.extend(file_chunk_cache.to_chunks(documents))
+                    yield FileHandler._add_upload_metadata(documents, chat_id, filename)
+            if fingerprint:
+                await asyncio.to_thread(
+                    file_chunk_cache.put_chunks, fingerprint, cached_chunks
+                )
+            logger.info(f"Processed {total} documents from '{filename}'.")
+        except DocumentLimitError as e:
+            raise FileProcessingError(status_code=413, detail=str(e))
+        except asyncio.TimeoutError:
+            raise FileProcessingError(
+                status_code=504,
+                detail=f"Processing '{filename}' took too long and was stopped.",
+            )
+        except FileProcessingError:
+            raise
         except Exception as e:
             logger.error(f"Error processing PDF '{filename}': {e}", exc_info=True)
             raise FileProcessingError(
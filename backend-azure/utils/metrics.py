@@ -0,0 +1,169 @@
+# utils/metrics.py
+import logging
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional
+
+from utils.tracing import Span, current_span, tracer
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestMetrics:
+    """Per-request counters, collected through a context variable."""
+
+    route: str
+    cosmos_request_charge: float = 0.0
+    cosmos_round_trips: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+    first_byte_at: Optional[float] = None
+    context_tokens: Optional[int] = None
+    context_tokens_saved: Optional[int] = None
+    admission_wait_ms: Optional[float] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Root span of the request's trace
+    span: Optional[Span] = None
+
+    @property
+    def correlation_id(self) -> Optional[str]:
+        return self.span.attributes.get("correlation.id") if self.span else None
+
+    def mark_first_byte(self) -> None:
+        if self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+
+    @property
+    def time_to_first_byte_ms(self) -> Optional[float]:
+        if self.first_byte_at is None:
+            return None
+        return (self.first_byte_at - self.started_at) * 1000
+
+    def record_cosmos_response(self, headers: Mapping[str, str]) -> None:
+        self.cosmos_round_trips += 1
+        try:
+            charge = float(headers.get("x-ms-request-charge", 0) or 0)
+        except (TypeError, ValueError):
+            return
+        self.cosmos_request_charge += charge
+        span = current_span()
+        if span is not None and span is not self.span:
+            span.add("db.cosmosdb.request_charge", charge)
+
+    def log(self) -> None:
+        """Logs the request's usage and ends its trace."""
+        ttfb = self.time_to_first_byte_ms
+        stages = self.span.stage_durations() if self.span else {}
+        logger.info(
+            f"Cosmos usage for /{self.route}: {self.cosmos_request_charge:.2f} RU "
+            f"over {self.cosmos_round_trips} round trips"
+            + (f", time to first byte {ttfb:.0f} ms" if ttfb is not None else "")
+            + (
+                f", context {self.context_tokens} tokens "
+                f"({self.context_tokens_saved} saved)"
+                if self.context_tokens is not None
+                else ""
+            )
+            + (
+                f", queued {self.admission_wait_ms:.0f} ms"
+                if self.admission_wait_ms
+                else ""
+            )
+            + (
+                f", {self.prompt_tokens} prompt / {self.completion_tokens} "
+                "completion tokens"
+                if self.prompt_tokens or self.completion_tokens
+                else ""
+            )
+            + (
+                ", stages: "
+                + ", ".join(f"{name} {ms:.0f} ms" for name, ms in stages.items())
+                if stages
+                else ""
+            ),
+            extra={
+                "route": self.route,
+                "cosmos_request_charge": self.cosmos_request_charge,
+                "cosmos_round_trips": self.cosmos_round_trips,
+                "time_to_first_byte_ms": ttfb,
+                "context_tokens": self.context_tokens,
+                "context_tokens_saved": self.context_tokens_saved,
+                "admission_wait_ms": self.admission_wait_ms,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "stage_durations_ms": stages,
+                "correlation_id": self.correlation_id,
+            },
+        )
+        if self.span is not None:
+            self.span.set_attribute(
+                "db.cosmosdb.request_charge", self.cosmos_request_charge
+            )
+            self.span.set_attribute("db.cosmosdb.round_trips", self.cosmos_round_trips)
+            self.span.set_attribute("gen_ai.usage.input_tokens", self.prompt_tokens)
+            self.span.set_attribute(
+                "gen_ai.usage.output_tokens", self.completion_tokens
+            )
+            if ttfb is not None:
+                self.span.set_attribute("time_to_first_byte_ms", ttfb)
+            self.span.end()
+
+
+_current_metrics: ContextVar[Optional[RequestMetrics]] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+def start_request_metrics(
+    route: str, headers: Optional[Mapping[str, str]] = None
+) -> RequestMetrics:
+    """
+    Starts collecting metrics for the request running in the current context,
+    and its trace, continuing the caller's trace context from `headers`.
+    """
+    metrics = RequestMetrics(
+        route=route,
+        span=tracer.start_trace(f"/{route}", headers, **{"http.route": f"/{route}"}),
+    )
+    _current_metrics.set(metrics)
+    return metrics
+
+
+def current_request_metrics() -> Optional[RequestMetrics]:
+    return _current_metrics.get()
+
+
+def cosmos_response_hook(headers: Mapping[str, str], _result: Any) -> None:
+    """`response_hook` for Cosmos SDK calls, charges the current request."""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.record_cosmos_response(headers)
+
+
+# Process-wide counters (cache hits, queue events, ...) exposed on /metrics
+_counters: Counter = Counter()
+_counters_lock = threading.Lock()
+
+
+def increment_counter(name: str, value: float = 1) -> None:
+    with _counters_lock:
+        _counters[name] += value
+
+
+def counters_snapshot() -> Dict[str, float]:
+    with _counters_lock:
+        return dict(_counters)
+
+
+def record_token_usage(prompt_tokens: int, completion_tokens: int) -> None:
+    """Charges Azure OpenAI token usage to the current request."""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.prompt_tokens += prompt_tokens
+        metrics.completion_tokens += completion_tokens
+    increment_counter("openai_prompt_tokens", prompt_tokens)
+    increment_counter("openai_completion_tokens", completion_tokens)
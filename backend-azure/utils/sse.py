@@ -0,0 +1,71 @@
+# utils/sse.py
+import asyncio
+import time
+from typing import AsyncIterator, Optional
+
+
+def sse_event(data: str, event: Optional[str] = None) -> bytes:
+    """Frames a payload as one Server-Sent Event, one `data:` line per line."""
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in data.split("\n")]
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+async def replay_text(text: str, chunk_chars: int = 64) -> AsyncIterator[str]:
+    """Streams an already complete answer in pieces, like a model would."""
+    for start in range(0, len(text), chunk_chars):
+        yield text[start : start + chunk_chars]
+        await asyncio.sleep(0)
+
+
+async def coalesce_sse(
+    tokens: AsyncIterator[str], max_bytes: int, max_interval_ms: int
+) -> AsyncIterator[bytes]:
+    """
+    Groups streamed tokens into SSE frames. A frame is flushed once it holds
+    `max_bytes` of text or `max_interval_ms` has passed since its first token,
+    whichever comes first, so slow streams still render promptly and fast
+    streams are not sent token by token.
+    """
+    max_interval = max_interval_ms / 1000
+    iterator = tokens.__aiter__()
+    buffer: list[str] = []
+    buffered_bytes = 0
+    frame_started = 0.0
+    pending: Optional[asyncio.Task] = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None
+            if buffer:
+                timeout = max(0.0, frame_started + max_interval - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                yield sse_event("".join(buffer))
+                buffer, buffered_bytes = [], 0
+                continue
+
+            try:
+                token = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if not buffer:
+                frame_started = time.monotonic()
+            buffer.append(token)
+            buffered_bytes += len(token.encode("utf-8"))
+            if buffered_bytes >= max_bytes:
+                yield sse_event("".join(buffer))
+                buffer, buffered_bytes = [], 0
+
+        if buffer:
+            yield sse_event("".join(buffer))
+    finally:
+        if pending is not None:
+            pending.cancel()
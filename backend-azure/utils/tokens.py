@@ -0,0 +1,24 @@
+# utils/tokens.py
+from typing import List
+
+from langchain_core.messages import BaseMessage
+
+# Rough tokens-per-character ratio for English text with cl100k-style encodings
+CHARS_PER_TOKEN = 4
+# Role and separator tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_message_tokens(message: BaseMessage) -> int:
+    content = (
+        message.content if isinstance(message.content, str) else str(message.content)
+    )
+    return estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_messages_tokens(messages: List[BaseMessage]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
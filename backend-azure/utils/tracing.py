@@ -0,0 +1,226 @@
+# utils/tracing.py
+import contextlib
+import logging
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Protocol
+
+from opentelemetry import propagate
+from opentelemetry import trace as otel_trace
+from opentelemetry.trace import Status, StatusCode
+
+logger = logging.getLogger(__name__)
+
+CORRELATION_ID_HEADER = "x-correlation-id"
+
+
+class Span:
+    """
+    A timed pipeline stage with attributes, in OpenTelemetry's data model
+    (hex trace and span ids, parent span id, unix-nano timestamps, status).
+    Every span is mirrored to an OpenTelemetry API span, which is a no-op
+    unless an OpenTelemetry SDK (e.g. the Azure Monitor distro) is configured.
+    """
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        trace_id: str,
+        parent: Optional["Span"],
+        attributes: Dict[str, Any],
+        otel_span: otel_trace.Span,
+    ):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = "UNSET"
+        self.start_time_unix_nano = time.time_ns()
+        self.end_time_unix_nano: Optional[int] = None
+        self._started = time.perf_counter()
+        self._otel = otel_span
+        # Finished spans of the trace, shared with the root for summaries
+        self.finished: List[Span] = parent.finished if parent else []
+
+    @property
+    def duration_ms(self) -> float:
+        if self.end_time_unix_nano is None:
+            return (time.perf_counter() - self._started) * 1000
+        return (self.end_time_unix_nano - self.start_time_unix_nano) / 1e6
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+        self._otel.set_attribute(key, value)
+
+    def add(self, key: str, value: float) -> None:
+        """Adds to a numeric attribute, e.g. request units over several calls."""
+        self.set_attribute(key, self.attributes.get(key, 0) + value)
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = "ERROR"
+        self.attributes["error.type"] = type(error).__name__
+        self._otel.record_exception(error)
+        self._otel.set_status(Status(StatusCode.ERROR, str(error)))
+
+    def end(self) -> None:
+        if self.end_time_unix_nano is not None:
+            return
+        self.end_time_unix_nano = self.start_time_unix_nano + int(
+            (time.perf_counter() - self._started) * 1e9
+        )
+        if self.status == "UNSET":
+            self.status = "OK"
+        self._otel.end()
+        self.finished.append(self)
+        self._tracer._export(self)
+
+    def stage_durations(self) -> Dict[str, float]:
+        """Milliseconds per span name among the finished spans of this trace."""
+        durations: Dict[str, float] = {}
+        for span in self.finished:
+            if span is not self:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration_ms
+        return durations
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time_unix_nano": self.start_time_unix_nano,
+            "end_time_unix_nano": self.end_time_unix_nano,
+            "attributes": dict(self.attributes),
+            "status": self.status,
+        }
+
+
+class SpanExporter(Protocol):
+    def export(self, span: Span) -> None: ...
+
+
+class InMemorySpanExporter:
+    """Keeps finished spans in memory, for tests and benchmarks."""
+
+    def __init__(self):
+        self._spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self, name: Optional[str] = None) -> List[Span]:
+        with self._lock:
+            return [s for s in self._spans if name is None or s.name == name]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_correlation_id: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def correlation_id() -> Optional[str]:
+    return _correlation_id.get()
+
+
+def set_correlation_id(value: Optional[str]) -> None:
+    _correlation_id.set(value)
+
+
+class Tracer:
+    """
+    Creates spans for the current request. Spans started in a task belong to
+    the trace of the span that was current there, so stages run with
+    asyncio.create_task or gather are attributed to the right request.
+    """
+
+    def __init__(self):
+        self.exporters: List[SpanExporter] = []
+        self._otel_tracer = otel_trace.get_tracer("openai-chat-app")
+
+    def add_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters.append(exporter)
+
+    def remove_exporter(self, exporter: SpanExporter) -> None:
+        self.exporters.remove(exporter)
+
+    def start_trace(
+        self, name: str, headers: Optional[Mapping[str, str]] = None, **attributes
+    ) -> Span:
+        """
+        Starts the root span of a request and makes it current. Continues the
+        caller's W3C trace context (`traceparent`) when there is one, and takes
+        the correlation id from the x-correlation-id header or the trace id.
+        """
+        headers = headers or {}
+        otel_context = propagate.extract(headers)
+        remote = otel_trace.get_current_span(otel_context).get_span_context()
+        otel_span = self._otel_tracer.start_span(
+            name, context=otel_context, attributes=attributes
+        )
+        local = otel_span.get_span_context()
+        if local.is_valid:
+            trace_id = format(local.trace_id, "032x")
+        elif remote.is_valid:
+            trace_id = format(remote.trace_id, "032x")
+        else:
+            trace_id = secrets.token_hex(16)
+
+        set_correlation_id(headers.get(CORRELATION_ID_HEADER) or trace_id)
+        span = Span(self, name, trace_id, None, dict(attributes), otel_span)
+        span.set_attribute("correlation.id", correlation_id())
+        _current_span.set(span)
+        return span
+
+    def start_span(self, name: str, **attributes) -> Span:
+        """
+        Starts a child of the current span without making it current, for
+        stages that outlive one block, like a streamed answer.
+        """
+        parent = current_span()
+        otel_context = otel_trace.set_span_in_context(parent._otel) if parent else None
+        otel_span = self._otel_tracer.start_span(
+            name, context=otel_context, attributes=attributes
+        )
+        trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        span = Span(self, name, trace_id, parent, dict(attributes), otel_span)
+        if correlation_id():
+            span.set_attribute("correlation.id", correlation_id())
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        """Times the enclosed block as a child of the current span."""
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def _export(self, span: Span) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                logger.warning(f"Span exporter {type(exporter).__name__} failed: {e}")
+
+
+tracer = Tracer()
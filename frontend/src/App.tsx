@@ -16,24 +16,44 @@ import { Separator } from "@radix-ui/react-separator";
 import { CardsChat } from "./components/chat";
 import { ModeToggle } from "./components/mode-toggle";
 import { useEffect, useState } from "react";
-import { type Chat } from "@/lib/utils";
+import { type Chat, type ChatPage, createChat } from "@/lib/utils";
+
+const fetchChatPage = async (continuation?: string): Promise<ChatPage> => {
+  const params = continuation
+    ? `?continuation=${encodeURIComponent(continuation)}`
+    : "";
+  const data = await fetch(
+    `http://${
+      import.meta.env.VITE_AZURE_FUNCTIONS_ENDPOINT
+    }/api/fetch_chats${params}`
+  );
+  return await data.json();
+};
 
 function App() {
   const [chats, setChats] = useState<Chat[]>();
   const [chatId, setChatId] = useState<number | null>(null);
+  const [continuation, setContinuation] = useState<string | null>(null);
   useEffect(() => {
     const requestChats = async () => {
-      const data = await fetch(
-        `http://${
-          import.meta.env.VITE_AZURE_FUNCTIONS_ENDPOINT
-        }/api/fetch_chats`
-      );
-      const fetchedChats: Chat[] = await data.json();
-      setChatId(fetchedChats[0].id);
-      setChats(fetchedChats);
+      const page = await fetchChatPage();
+      setContinuation(page.continuation);
+      if (page.chats.length === 0) {
+        await createChat(undefined, setChats, setChatId);
+        return;
+      }
+      setChatId(page.chats[0].id);
+      setChats(page.chats);
     };
     requestChats();
   }, []);
+
+  const loadMoreChats = async () => {
+    if (!continuation) return;
+    const page = await fetchChatPage(continuation);
+    setContinuation(page.continuation);
+    setChats((current) => [...(current ?? []), ...page.chats]);
+  };
   return (
     <>
       <ThemeProvider defaultTheme="light" storageKey="vite-ui-theme">
@@ -43,6 +63,7 @@ function App() {
             setChats={setChats}
             chatId={chatId}
             setChatId={setChatId}
+            loadMoreChats={continuation ? loadMoreChats : undefined}
           />
           <SidebarInset>
             <header className="flex h-16 shrink-0 items-center gap-2 border-b px-4">
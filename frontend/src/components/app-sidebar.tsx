@@ -26,12 +26,14 @@ export function AppSidebar({
   setChats,
   chatId,
   setChatId,
+  loadMoreChats,
   ...props
 }: React.ComponentProps<typeof Sidebar> & {
   chats?: Chat[];
   chatId: number | null;
   setChats: React.Dispatch<React.SetStateAction<Chat[] | undefined>>;
   setChatId: React.Dispatch<React.SetStateAction<number | null>>;
+  loadMoreChats?: () => Promise<void>;
 }) {
   const [hoverChat, setHoverChat] = React.useState<number>();
 
@@ -85,6 +87,7 @@ export function AppSidebar({
                     setHoverChat={setHoverChat}
                     hoverChat={hoverChat}
                     setChats={setChats}
+                    loadMoreChats={loadMoreChats}
                   />
                 </CollapsibleContent>
               </SidebarMenuItem>
@@ -15,6 +15,7 @@ interface ChatListProps {
   setHoverChat: React.Dispatch<React.SetStateAction<number | undefined>>;
   hoverChat: number | undefined;
   setChats: React.Dispatch<React.SetStateAction<Chat[] | undefined>>;
+  loadMoreChats?: () => Promise<void>;
 }
 
 export function ChatList({
@@ -24,6 +25,7 @@ export function ChatList({
   setHoverChat,
   hoverChat,
   setChats,
+  loadMoreChats,
 }: ChatListProps) {
   const deleteChat = async (e: React.MouseEvent, chat_id: number) => {
     e.stopPropagation();
@@ -87,6 +89,18 @@ export function ChatList({
           </SidebarMenuSubButton>
         </SidebarMenuSubItem>
       ))}
+      {loadMoreChats && (
+        <SidebarMenuSubItem>
+          <SidebarMenuSubButton
+            className="cursor-pointer text-muted-foreground"
+            onClick={() => {
+              loadMoreChats();
+            }}
+          >
+            Load more
+          </SidebarMenuSubButton>
+        </SidebarMenuSubItem>
+      )}
     </SidebarMenuSub>
   );
 }
@@ -30,6 +30,32 @@ interface ChatResponse {
   files: Array<string>;
 }
 
+// Joins the `data:` lines of one Server-Sent Event back into its payload.
+const parseEventData = (event: string) =>
+  event
+    .split("\n")
+    .filter((line) => line.startsWith("data:"))
+    .map((line) => line.slice(line.startsWith("data: ") ? 6 : 5))
+    .join("\n");
+
+const parseEventName = (event: string) =>
+  event
+    .split("\n")
+    .find((line) => line.startsWith("event:"))
+    ?.slice(6)
+    .trim();
+
+// The backend sends a `busy` event when it cannot start the answer in time.
+const busyMessage = (data: string) => {
+  const { retry_after } = JSON.parse(data);
+  return `The assistant is busy right now, please try again in ${retry_after} seconds.`;
+};
+
+interface IngestionJob {
+  status: string;
+  error?: string | null;
+}
+
 interface ErrorState {
   hasError: boolean;
   message: string;
@@ -159,9 +185,13 @@ export function CardsChat({ chatId }: { chatId: number }) {
 
         if (!response.ok) {
           const errorText = await response.text();
-          const errorMessage = errorText.startsWith("data: ERROR:")
-            ? errorText.replace("data: ERROR:", "").trim()
-            : `API error: ${response.status} ${response.statusText}`;
+          const errorEvent = errorText.trim();
+          const errorMessage =
+            parseEventName(errorEvent) === "busy"
+              ? busyMessage(parseEventData(errorEvent))
+              : errorText.startsWith("data: ERROR:")
+              ? errorText.replace("data: ERROR:", "").trim()
+              : `API error: ${response.status} ${response.statusText}`;
           throw new Error(errorMessage);
         }
 
@@ -170,6 +200,7 @@ export function CardsChat({ chatId }: { chatId: number }) {
 
         const reader = response.body?.getReader();
         const textDecoder = new TextDecoder();
+        let eventBuffer = "";
 
         if (!reader) {
           throw new Error("Failed to get response reader for streaming.");
@@ -182,8 +213,20 @@ export function CardsChat({ chatId }: { chatId: number }) {
             break;
           }
 
-          const decodedValue = textDecoder.decode(value, { stream: true });
-          agentMessage.current += decodedValue;
+          eventBuffer += textDecoder.decode(value, { stream: true });
+          const events = eventBuffer.split("\n\n");
+          eventBuffer = events.pop() ?? "";
+
+          for (const event of events) {
+            const data = parseEventData(event);
+            if (parseEventName(event) === "busy") {
+              throw new Error(busyMessage(data));
+            }
+            if (data.startsWith("ERROR:")) {
+              throw new Error(data.replace("ERROR:", "").trim());
+            }
+            agentMessage.current += data;
+          }
 
           if (!appError.hasError) {
             if (messages[messages.length - 1].role === "user") {
@@ -238,6 +281,25 @@ export function CardsChat({ chatId }: { chatId: number }) {
     return;
   };
 
+  // Polls an ingestion job started by /upload until it completes or fails.
+  const waitForIngestion = async (jobId: string) => {
+    while (true) {
+      const response = await fetch(
+        `http://${
+          import.meta.env.VITE_AZURE_FUNCTIONS_ENDPOINT
+        }/api/upload_status/${jobId}`
+      );
+      if (!response.ok) {
+        return { status: "failed", error: response.statusText };
+      }
+      const job: IngestionJob = await response.json();
+      if (job.status === "completed" || job.status === "failed") {
+        return job;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
   const handleUpload = async () => {
     if (!selectedFile) {
       setAppError({ hasError: true, message: "No file selected for upload." });
@@ -259,6 +321,15 @@ export function CardsChat({ chatId }: { chatId: number }) {
       );
 
       if (response.ok) {
+        const { job_id }: { job_id: string } = await response.json();
+        const job = await waitForIngestion(job_id);
+        if (job.status !== "completed") {
+          setAppError({
+            hasError: true,
+            message: `File processing failed: ${job.error || "Unknown error"}`,
+          });
+          return false;
+        }
         toast.success(`File uploaded successfully`, {
           description: `${selectedFile.name} - ${
             selectedFile.size / (1024 * 1024)
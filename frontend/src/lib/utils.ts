@@ -10,13 +10,18 @@ export interface Chat {
   title: string
 }
 
+export interface ChatPage {
+  chats: Chat[],
+  continuation: string | null
+}
+
 export const createChat = async (chats: Chat[] | undefined, setChats: React.Dispatch<React.SetStateAction<Chat[] | undefined>>, setChatId: React.Dispatch<React.SetStateAction<number | null>>) => {
     const response = await fetch(`http://${import.meta.env.VITE_AZURE_FUNCTIONS_ENDPOINT}/api/create_chat`, {
       method: "POST",
     });
     const chat: Chat = await response.json();
     if (chats) {
-      setChats([...chats, chat]);
+      setChats([chat, ...chats]);
     } else {
       setChats([chat]);
     }